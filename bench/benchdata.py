@@ -0,0 +1,29 @@
+"""Databases for the benchmarks, grown from the sample in data/gamesv008.json"""
+import os
+import sys
+import json
+import copy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+from mblib import games
+
+def sample():
+    with open(os.path.join(ROOT,"data","gamesv008.json")) as f:
+        return json.loads(f.read())
+
+def big_database(n,revision=0):
+    """Database dict of n games in the current format. Past the sample the games are copies with
+    their own gameid and name, and out of any package"""
+    d = sample()
+    big = {"games":{},"multipack":d["multipack"],"source_definitions":d["source_definitions"],"revision":revision,
+        "version":games.DB_VERSION}
+    base = list(d["games"].values())
+    for i in range(n):
+        g = copy.deepcopy(base[i%len(base)])
+        if i>=len(base):
+            g["gameid"] = "%s_%d"%(g["gameid"],i)
+            g["name"] += " %d"%i
+            g["package_data"] = {}
+        big["games"][g["gameid"]] = games.upgrade_record(g)
+    return big
@@ -0,0 +1,75 @@
+"""Offscreen timings of the main game list for databases of 2k, 10k and 50k games: showing the
+list the first time, refreshing it, one game being played, and a name search. Also counts how
+many games had to be built, which should stay around a screenful.
+
+    python bench/game_list.py [games ...]
+
+Nothing is read from or written to the real MyBacklog folder, and syncing and icon loading are
+switched off so no network is used.
+"""
+import os
+import sys
+import time
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+
+import ubjson
+from PyQt5.QtWidgets import QApplication
+
+import benchdata
+from mblib import games, sync
+from mblib.appdirs import appdirs
+from mblib.resources import icons
+from mblib.apis import steamapi
+
+def main(sizes):
+    qapp = QApplication([])
+    #The window loads its icons from paths relative to the repository
+    os.chdir(benchdata.ROOT)
+    steamapi.get_user_id = lambda name: name
+    sync.download = lambda: False
+    sync.upload = lambda: None
+    icons.icon_for_game = lambda *args,**kwargs: None
+    icons.IconLoader.request = lambda *args: None
+    for n in sizes:
+        bench(qapp,n)
+
+def bench(qapp,n):
+    root = tempfile.mkdtemp()
+    os.makedirs(root+"/cache")
+    appdirs.user_data_dir = lambda *args,**kwargs: root
+    import mybacklog
+    window = mybacklog.MyBacklog(qapp)
+    form = window.main_form
+    form.icon_size = 48
+    form.games = games.Games(form.log)
+    form.games.lazy = True
+    form.games.translate_json(ubjson.dumpb(benchdata.big_database(n)))
+    form.games.local = {"game_data":{},"emulators":{}}
+    form.save = lambda: None
+    form.game_options = None
+    window.show()
+    qapp.processEvents()
+    def timed(f):
+        t = time.time()
+        f()
+        qapp.processEvents()
+        return time.time()-t
+    first = timed(form.update_gamelist_widget)
+    refresh = timed(form.update_gamelist_widget)
+    game = form.games.list("priority")[min(500,n-1)]
+    played = timed(lambda: form.operation("played",game,60))
+    form.search_name.blockSignals(True)
+    form.search_name.setText("the")
+    form.search_name.blockSignals(False)
+    search = timed(form.dosearch)
+    built = sum(1 for gameid in form.games.games if form.games.games.is_loaded(gameid))
+    print("%d games: first list %.3fs, refresh %.3fs, one game played %.3fs, search %.3fs, %d games built"%(
+        n,first,refresh,played,search,built))
+    window.hide()
+    window.deleteLater()
+    qapp.processEvents()
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [2000,10000,50000])
@@ -0,0 +1,96 @@
+"""Cold loading of list icons from a local stand-in server that takes latency seconds to answer
+each request: icon_for_game one icon after another, against IconLoader with 1, 4, 8 and 16
+download workers. Counts the connections the server saw and the batches take_loaded() handed over.
+
+    python bench/icon_loading.py [icons] [latency]
+"""
+import os
+import io
+import sys
+import time
+import tempfile
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+
+from PIL import Image
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QPixmap
+
+import benchdata  #puts the repository on sys.path
+from mblib import games
+from mblib.resources import icons
+
+def serve(latency):
+    """(port,connections) of a server answering every path with a 460x215 jpeg"""
+    buf = io.BytesIO()
+    Image.linear_gradient("L").resize((460,215)).convert("RGB").save(buf,"JPEG")
+    image = buf.getvalue()
+    connections = [0]
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        def setup(self):
+            connections[0] += 1
+            super().setup()
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type","image/jpeg")
+            self.send_header("Content-Length",str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+        def log_message(self,*args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1",0),Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server.server_address[1],connections
+
+def main(n,latency):
+    qapp = QApplication([])
+    port,connections = serve(latency)
+    def game_list(tag):
+        return [games.Game(name="game %d"%i,gameid="g%d"%i,icon_url="http://127.0.0.1:%d/%s/%d.jpg"%(port,tag,i)) for i in range(n)]
+    def fresh_root():
+        root = tempfile.mkdtemp()
+        os.makedirs(root+"/cache/icons")
+        return root
+
+    root = fresh_root()
+    connections[0] = 0
+    cache = {}
+    t = time.time()
+    #icon_for_game prints every download
+    with contextlib.redirect_stdout(io.StringIO()):
+        for game in game_list("serial"):
+            icons.icon_for_game(game,48,cache,root)
+    t = time.time()-t
+    print("icon_for_game       %d icons %.2fs %4.0f icons/s %3d connections"%(n,t,n/t,connections[0]))
+
+    for workers in (1,4,8,16):
+        root = fresh_root()
+        connections[0] = 0
+        loader = icons.IconLoader(root,workers)
+        cache = {}
+        loaded = 0
+        batches = 0
+        t = time.time()
+        for game in game_list("loader%d"%workers):
+            loader.request(game.gameid,game,48)
+        while loaded<n and not loader.failed:
+            time.sleep(0.1)
+            batch = loader.take_loaded()
+            if batch:
+                batches += 1
+                loaded += len(batch)
+                for key,fpath,size,image in batch:
+                    cache[(fpath,size)] = QPixmap.fromImage(image)
+        t = time.time()-t
+        print("IconLoader %2d workers %d icons %.2fs %4.0f icons/s %3d connections, %d batches, %d failed"%(
+            workers,loaded,t,loaded/t,connections[0],batches,loader.failed))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv)>1 else 300,float(sys.argv[2]) if len(sys.argv)>2 else 0.03)
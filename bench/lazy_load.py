@@ -0,0 +1,30 @@
+"""Time to the first row of the game list for a big database, with every Game built while
+loading (eager) and with Games.lazy building them as they are read.
+
+    python bench/lazy_load.py [games]
+"""
+import sys
+import time
+
+import ubjson
+
+import benchdata
+from mblib import games
+
+def main(n):
+    data = ubjson.dumpb(benchdata.big_database(n))
+    t = time.time()
+    ubjson.loadb(data)
+    print("decoding the file alone: %.3fs"%(time.time()-t))
+    for lazy in (False,True):
+        g = games.Games()
+        g.lazy = lazy
+        t = time.time()
+        g.translate_json(data)
+        first = g.list("priority")[0]
+        t = time.time()-t
+        built = sum(1 for gameid in g.games if g.games.is_loaded(gameid))
+        print("%s: first row %.3fs, %d of %d games built"%("lazy" if lazy else "eager",t,built,len(g.games)))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv)>1 else 10000)
@@ -0,0 +1,55 @@
+"""Re-importing the sample database as an importer would hand it over, with 10% of the games
+played since and 2% of them new: add_games, one update_game per game, against merge_games.
+
+    python bench/merge_import.py
+"""
+import io
+import time
+import contextlib
+
+import ubjson
+
+import benchdata
+from mblib import games
+
+def fresh(data):
+    g = games.Games()
+    g.local = {"game_data":{},"emulators":{}}
+    g.translate_json(data)
+    return g
+
+def imported(g):
+    result = []
+    for i,game in enumerate(list(g.games.values())):
+        game = game.copy()
+        game.games = None
+        if i%10 == 0:
+            game.playtime += 60
+        if i%50 == 0:
+            game.sources = [{"source":"steam","id":"new%d"%i}]
+            game.gameid = "new%d"%i
+        result.append(game)
+    return result
+
+def records(g):
+    return dict((gameid,dict((k,v) for k,v in g.games[gameid].dict().items() if k != "data_changed_date")) for gameid in g.games)
+
+def main():
+    data = ubjson.dumpb(benchdata.big_database(len(benchdata.sample()["games"])))
+    a = fresh(data)
+    b = fresh(data)
+    import_a,import_b = imported(a),imported(b)
+    #add_games prints for every game, into memory here so the terminal isn't timed
+    with contextlib.redirect_stdout(io.StringIO()):
+        t = time.perf_counter()
+        a.add_games(import_a)
+        add_time = time.perf_counter()-t
+    t = time.perf_counter()
+    report = b.merge_games(import_b)
+    merge_time = time.perf_counter()-t
+    print("%d games: add_games %.3fs, merge_games %.3fs"%(len(import_a),add_time,merge_time))
+    print("added %d, updated %d, unchanged %d, same database: %s"%(
+        len(report["added"]),len(report["updated"]),report["unchanged"],records(a)==records(b)))
+
+if __name__ == "__main__":
+    main()
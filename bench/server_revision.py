@@ -0,0 +1,81 @@
+"""Load test of the sync server's revision requests. The hug app is served by a threaded wsgiref
+server, and client threads send games_revision and then bump_revision for a few seconds each.
+It also times reading the revision by decoding the database, as the server did before
+revision.json, against reading it from revision.json.
+
+    python bench/server_revision.py [games] [seconds] [threads]
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server,WSGIRequestHandler,WSGIServer
+
+import hug
+import requests
+import ubjson
+
+import benchdata
+from mblib import games
+from mblib.server import jsonapi
+
+class Server(ThreadingMixIn,WSGIServer):
+    daemon_threads = True
+
+class Handler(WSGIRequestHandler):
+    def log_message(self,*args):
+        pass
+
+def load_test(url,method,seconds,threads):
+    count = [0]
+    latencies = []
+    stop = time.time()+seconds
+    def client():
+        session = requests.Session()
+        while time.time()<stop:
+            t = time.time()
+            r = getattr(session,method)(url)
+            latencies.append(time.time()-t)
+            assert "server_revision" in r.text,r.text
+            count[0] += 1
+    clients = [threading.Thread(target=client) for i in range(threads)]
+    t = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    t = time.time()-t
+    latencies.sort()
+    return "%.0f req/s, median %.1fms"%(count[0]/t,latencies[len(latencies)//2]*1000)
+
+def main(n,seconds,threads):
+    #The server keeps its users under the working directory
+    os.chdir(tempfile.mkdtemp())
+    server = make_server("127.0.0.1",0,hug.API(jsonapi).http.server(),server_class=Server,handler_class=Handler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    url = "http://127.0.0.1:%d/"%server.server_port
+    gdb = games.Games()
+    gdb.translate_json(ubjson.dumpb(benchdata.big_database(n,revision=5)))
+    gdb.save("upload.gz")
+    with open("upload.gz","rb") as f:
+        r = requests.put(url+"game_database?user=bench&revision=5",data=f.read(),headers={"Content-Type":"application/ubjson"})
+    assert "success" in r.text,r.text
+
+    user = jsonapi.User("bench")
+    t = time.time()
+    user.load().revision
+    decode = time.time()-t
+    t = time.time()
+    user.revision()
+    index = time.time()-t
+    print("%d games: revision by decoding the database %.1fms, from revision.json %.2fms"%(n,decode*1000,index*1000))
+    print("games_revision, %d threads: %s"%(threads,load_test(url+"games_revision?user=bench","get",seconds,threads)))
+    print("bump_revision, %d threads: %s"%(threads,load_test(url+"bump_revision?user=bench","post",seconds,threads)))
+    revision = requests.get(url+"games_revision?user=bench").json()["server_revision"]
+    print("final revision %s, database agrees: %s"%(revision,user.load().revision == revision))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 3000,float(args[1]) if len(args)>1 else 5,int(args[2]) if len(args)>2 else 8)
@@ -0,0 +1,73 @@
+"""A cold Steam import of N owned apps whose store pages come from a local stand-in store,
+reached as an http proxy. Each page takes 20ms and a share of the answers are 429s with a
+Retry-After. Run it again with the same cache folder to time an import that is served from the
+http cache.
+
+    python bench/steam_scrape.py [apps] [rate] [cache folder]
+"""
+import os
+import io
+import sys
+import time
+import random
+import tempfile
+import threading
+import collections
+import contextlib
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+import benchdata  #puts the repository on sys.path
+from mblib.apis import steamapi
+
+PAGE = ('<html>'+'x'*20000+'<div class="popular_tags"><a>RPG</a></div>'
+    '<div id="category_block"><a>Online Co-op</a></div></html>').encode()
+
+def serve(delay=0.02,fail=0.03):
+    stats = collections.Counter()
+    connections = set()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+        def do_GET(self):
+            connections.add(self.client_address)
+            stats["requests"] += 1
+            time.sleep(delay)
+            if random.random()<fail:
+                stats["429"] += 1
+                self.send_response(429)
+                self.send_header("Retry-After","0.2")
+                self.send_header("Content-Length","0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length",str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        def log_message(self,*args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1",0),Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server.server_address[1],stats,connections
+
+class Log:
+    def write(self,*args):
+        pass
+
+def main(n,rate,root):
+    port,stats,connections = serve()
+    os.environ["http_proxy"] = "http://127.0.0.1:%d"%port
+    os.environ["no_proxy"] = ""
+    os.makedirs(root+"/cache",exist_ok=True)
+    steamapi.get_games = lambda *args: [{"appid":i,"name":"Game %d"%i,"playtime_forever":0} for i in range(n)]
+    t = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = steamapi.import_steam(cache_root=root,logger=Log(),rate=rate)
+    t = time.time()-t
+    print("%d apps at %s pages/s: %.1fs, %d with a genre; %d requests, %d 429s, %d connections"%(
+        n,rate,t,sum(1 for game in db.values() if game.genre),stats["requests"],stats["429"],len(connections)))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 3000,float(args[1]) if len(args)>1 else steamapi.SCRAPE_RATE,
+        args[2] if len(args)>2 else tempfile.mkdtemp())
@@ -1,9 +1,13 @@
 #!python3
 import time
+import asyncio
+import threading
 import requests
 import re
 import os
 from .. import games
+from mblib import httpcache
+from mblib.apis import scraper
 import json
 
 def get_gog_games_from_google():
@@ -75,58 +79,10 @@ def get_gog_games_html(html):
         gog_games[d["gameindex"]] = d
     return gog_games
 
-class Browser:
-    def __init__(self):
-        self.cookies = {}
-        self.headers = {"Accept":"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8","Accept-Encoding":"gzip, deflate","Accept-Language":"en-us,ko;q=0.7,en;q=0.3",
-            "User-Agent":"Mozilla/5.0 (Macintosh; Intel Mac OS X 10.6; rv:28.0) Gecko/20100101 Firefox/28.0",
-            "Referer":"https://www.humblebundle.com/",
-            "X-Requested-With":"XMLHttpRequest"}
-    def post(self,url,datax={},params={}):
-        self.json = {}
-        self.text = ""
-        answer = requests.post(url,data=datax,params=params,cookies=self.cookies,headers=self.headers,allow_redirects=True)
-        self.answer = answer
-        self.cookies.update(answer.cookies)
-        try:
-            self.json = answer.json()
-        except:
-            pass
-        try:
-            self.text = answer.text
-            self.url = answer.url
-        except:
-            pass
-    def get(self,url,params={},cache=False,cache_root=""):
-        self.json = {}
-        self.text = ""
-        if cache:
-            if not os.path.exists(cache_root+"/cache/gogapi"):
-                os.mkdir(cache_root+"/cache/gogapi")
-        cache_url = cache_root+"/cache/gogapi/"+url.replace(":","").replace("/","").replace("?","QU").replace("&","AN")
-        if not cache or not os.path.exists(cache_url):
-            answer = requests.get(url,params=params,cookies=self.cookies,headers=self.headers)
-            self.cookies.update(answer.cookies)
-            try:
-                self.json = answer.json()
-            except:
-                pass
-            try:
-                self.text = answer.text
-                self.url = answer.url
-            except:
-                pass
-            if cache:
-                f = open(cache_url,"w")
-                f.write(json.dumps({"json":self.json,"text":self.text,"url":self.url}))
-                f.close()
-        else:
-            f = open(cache_url)
-            d = json.loads(f.read())
-            f.close()
-            self.json = d["json"]
-            self.text = d["text"]
-            self.url = d["url"]
+class Browser(scraper.Browser):
+    cache_name = "gogapi"
+    def legacy_key(self,url):
+        return url.replace(":","").replace("/","").replace("?","QU").replace("&","AN")
 
 #Format:
 """{"products":[
@@ -159,7 +115,8 @@ class Gog:
         self.username = username
         self.password = password
         
-    def get_shelf(self,multipack,gog_cookie_info):
+    def login(self,gog_cookie_info):
+        """A Browser logged in with the cookies of the embedded browser"""
         if not self.username or not self.password:
             raise BadAccount()
         print(time.time())
@@ -201,64 +158,84 @@ class Gog:
             raise BadAccount()
             
         self.app.log.write("gog logged in: success")
+        return b
+
+    async def get_shelf(self,runtime,emit,multipack,gog_cookie_info):
+        """Games on the gog shelf, an importer for importer.ImportRuntime. Page 1 tells how many
+        pages there are, the rest are then fetched at once. They are still read in page order, so
+        games and multipacks come out the same however the fetches finish. emit gets the games of
+        each page as it is read, multipacks and their contents among them where they are listed"""
+        b = await runtime.fetch("gog",self.login,gog_cookie_info)
 
         url = "https://www.gog.com/account/getFilteredProducts?mediaType=1&page=%(page)s&sortBy=date_purchased"
+        def get_page(page):
+            self.app.log.write("gog download page: %s"%page)
+            print("getting page",page)
+            return b.fetch(url%{"page":page},cache=False,cache_root=self.app.config["root"])["json"]
 
+        first = await runtime.fetch("gog",get_page,1)
+        pages = [asyncio.ensure_future(runtime.fetch("gog",get_page,page)) for page in range(2,first["totalPages"]+1)]
         imported_games = []
         packs = {}
-        page = 1
-        while 1:
-            self.app.log.write("gog download page: %s"%page)
-            print("getting page",page)
-            b.get(url%{"page":page},cache=False,cache_root=self.app.config["root"])
-            for game_data in b.json["products"]:
-                if not game_data["isGame"]:
-                    continue
-                #print(game_data)
-                gameid = str(game_data["slug"])
-                gameid2 = str(game_data["id"])
-                gamename = game_data["title"]
-                #Add a formatter to the image to get the right size
-                #_392 = big icon
-                #_bg_1120.jpg = background of game page
-                gameicon = "http:"+game_data["image"].replace("\\/","/")+"_392.jpg"
-                genre = game_data["category"].lower()
-                game = games.Game(name=gamename,icon_url=gameicon,import_date=games.now(),genre=genre)
-                game.sources = [{"source":"gog","id":gameid,"id2":gameid2,"gog_data":game_data}]
+        try:
+            for page in [None]+pages:
+                data = first if page is None else await page
+                page_games = self.read_page(data,multipack,packs)
+                imported_games.extend(page_games)
+                emit(page_games)
+        finally:
+            for page in pages:
+                page.cancel()
+        return imported_games
 
-                if gameid in multipack:
-                    if gameid not in packs:
-                        package = games.Game(name=gamename,icon_url=gameicon,import_date=games.now())
-                        package.sources = [{"source":"gog","id":gameid,"id2":gameid2}]
-                        package.package_data = {
-                            "type":"bundle",
-                            "contents":[],
-                            "source_info":package.create_package_data()
-                        }
-                        packs[gameid] = package
-                        package.generate_gameid()
-                        imported_games.append(package)
-                    package = packs[gameid]
-                    for subgamename in multipack[gameid]:
-                        subgame = game.copy()
-                        subgame.name = subgamename
-                        print("packaging",subgamename,"into",subgame.gameid,subgame.create_package_data())
-                        subgame.package_data = {
-                            "type":"content",
-                            "parent":{"gameid":package.gameid,"name":package.name},
-                            "source_info":subgame.create_package_data()
-                        }
-                        subgame.generate_gameid()
-                        package.package_data["contents"].append({"gameid":subgame.gameid,"name":subgame.name})
-                        imported_games.append(subgame)
-                else:
-                    game.generate_gameid()
-                    imported_games.append(game)
+    def read_page(self,data,multipack,packs):
+        """Games of one shelf page. A game in a multipack is replaced by its contents, after the
+        package the first time one of its games is seen. packs keeps the packages by gog id"""
+        page_games = []
+        for game_data in data["products"]:
+            if not game_data["isGame"]:
+                continue
+            #print(game_data)
+            gameid = str(game_data["slug"])
+            gameid2 = str(game_data["id"])
+            gamename = game_data["title"]
+            #Add a formatter to the image to get the right size
+            #_392 = big icon
+            #_bg_1120.jpg = background of game page
+            gameicon = "http:"+game_data["image"].replace("\\/","/")+"_392.jpg"
+            genre = game_data["category"].lower()
+            game = games.Game(name=gamename,icon_url=gameicon,import_date=games.now(),genre=genre)
+            game.sources = [{"source":"gog","id":gameid,"id2":gameid2,"gog_data":game_data}]
 
-            if page == b.json["totalPages"]:
-                break
-            page += 1
-        return imported_games
+            if gameid in multipack:
+                if gameid not in packs:
+                    package = games.Game(name=gamename,icon_url=gameicon,import_date=games.now())
+                    package.sources = [{"source":"gog","id":gameid,"id2":gameid2}]
+                    package.package_data = {
+                        "type":"bundle",
+                        "contents":[],
+                        "source_info":package.create_package_data()
+                    }
+                    packs[gameid] = package
+                    package.generate_gameid()
+                    page_games.append(package)
+                package = packs[gameid]
+                for subgamename in multipack[gameid]:
+                    subgame = game.copy()
+                    subgame.name = subgamename
+                    print("packaging",subgamename,"into",subgame.gameid,subgame.create_package_data())
+                    subgame.package_data = {
+                        "type":"content",
+                        "parent":{"gameid":package.gameid,"name":package.name},
+                        "source_info":subgame.create_package_data()
+                    }
+                    subgame.generate_gameid()
+                    package.package_data["contents"].append({"gameid":subgame.gameid,"name":subgame.name})
+                    page_games.append(subgame)
+            else:
+                game.generate_gameid()
+                page_games.append(game)
+        return page_games
 
 if __name__ == "__main__":
     better_get_shelf()
@@ -1,69 +1,27 @@
 #!python3
 import time
+import asyncio
+import threading
+import hashlib
 import requests
 import re
 import os
-from mblib import games
+from mblib import games,httpcache
+from mblib.apis import scraper
 import json
+import ast
 
 class ApiError(Exception):
     pass
 
-class Browser:
-    def __init__(self):
-        self.cookies = {}
-        self.headers = {"Accept":"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8","Accept-Encoding":"gzip, deflate","Accept-Language":"en-us,ko;q=0.7,en;q=0.3",
-            "User-Agent":"Mozilla/5.0 (Macintosh; Intel Mac OS X 10.6; rv:28.0) Gecko/20100101 Firefox/28.0",
-            "Referer":"https://www.humblebundle.com/",
-            "X-Requested-With":"XMLHttpRequest"}
-    def post(self,url,datax={},params={}):
-        self.json = {}
-        self.text = ""
-        answer = requests.post(url,data=datax,params=params,cookies=self.cookies,headers=self.headers,allow_redirects=True)
-        self.answer = answer
-        self.cookies.update(answer.cookies)
-        try:
-            self.json = answer.json()
-        except:
-            pass
-        try:
-            self.text = answer.text
-            self.url = answer.url
-        except:
-            pass
-    def get(self,url,params={},cache=False,cache_root=""):
-        self.json = {}
-        self.text = ""
-        if cache:
-            if not os.path.exists(cache_root+"/cache/humble"):
-                os.mkdir(cache_root+"/cache/humble")
-        if not cache or not os.path.exists(cache_root+"/cache/humble/"+url.replace(":","").replace("/","")):
-                answer = requests.get(url,params=params,cookies=self.cookies,headers=self.headers)
-                self.cookies.update(answer.cookies)
-                try:
-                    self.json = answer.json()
-                except:
-                    pass
-                try:
-                    self.text = answer.text
-                    self.url = answer.url
-                except:
-                    pass
-                if cache:
-                    f = open(cache_root+"/cache/humble/"+url.replace(":","").replace("/",""),"w")
-                    f.write(json.dumps({"json":self.json,"text":self.text,"url":self.url}))
-                    f.close()
-        else:
-            f = open(cache_root+"/cache/humble/"+url.replace(":","").replace("/",""))
-            d = json.loads(f.read())
-            f.close()
-            self.json = d["json"]
-            self.text = d["text"]
-            self.url = d["url"]
+class Browser(scraper.Browser):
+    cache_name = "humble"
+    cache_ttl = 30*httpcache.DAY
 
 import time
 
-def get_humble_gamelist(log,username,password,cache_root):
+def login(log,username,password,cache_root):
+    """A Browser logged in to humble, and the gamekeys of the orders on the account"""
     b = Browser()
     logged_in = False
     b.get("https://www.humblebundle.com/")
@@ -71,8 +29,13 @@ def get_humble_gamelist(log,username,password,cache_root):
     if not logged_in:
         try:
             f = open(cache_root+"/cache/hcookies","r")
-            b.cookies = eval(f.read())
+            text = f.read()
             f.close()
+            try:
+                b.cookies = json.loads(text)
+            except ValueError:
+                #Saved with repr() by older versions
+                b.cookies = ast.literal_eval(text)
         except:
             pass
         b.get("https://www.humblebundle.com/home")
@@ -93,11 +56,10 @@ def get_humble_gamelist(log,username,password,cache_root):
         print (b.cookies)
 
     f = open(cache_root+"/cache/hcookies","w")
-    f.write(repr(b.cookies))
+    f.write(json.dumps(b.cookies))
     f.close()
 
     #Should be logged in now
-    api_get_order = "https://www.humblebundle.com/api/v1/order/%(key)s"
     #print (b.url,b.text)
     b.get("https://www.humblebundle.com/home")
     if "error_id" in b.text:
@@ -108,37 +70,81 @@ def get_humble_gamelist(log,username,password,cache_root):
     except:
         raise ApiError()
     print (keys)
-    imported_games = []
-    log.write("humble download info for %s packages"%len(keys.split(",")))
-    for key in keys.split(","):
-        key = re.findall("\"(.*?)\"",key)[0]
-        b.get(api_get_order%{"key":key},cache=True,cache_root=cache_root)
-        print (b.json)
-        hdata = b.json
-        package = games.Game(name=hdata["product"]["human_name"],import_date=games.now())
-        package.sources = [{"source":"humble","id":str(hdata["product"]["machine_name"]),"package":hdata["gamekey"]}]
-        package.package_data = {
-            "type":"bundle",
-            "contents":[],
-            "source_info":package.create_package_data()
+    return b,[re.findall("\"(.*?)\"",key)[0] for key in keys.split(",")]
+
+def read_order(hdata):
+    """The bundle game of an order followed by the games in it"""
+    package = games.Game(name=hdata["product"]["human_name"],import_date=games.now())
+    package.sources = [{"source":"humble","id":str(hdata["product"]["machine_name"]),"package":hdata["gamekey"]}]
+    package.package_data = {
+        "type":"bundle",
+        "contents":[],
+        "source_info":package.create_package_data()
+    }
+    package.generate_gameid()
+    order_games = [package]
+    for sub in hdata["subproducts"]:
+        game = games.Game(name=sub["human_name"],
+                                    website=sub["url"],
+                                    icon_url=sub["icon"],
+                                    import_date=games.now())
+        game.sources = [{"source":"humble","id":str(sub["machine_name"]),"package":hdata["gamekey"]}]
+        game.package_data = {
+                "type":"content",
+                "parent":{"gameid":package.gameid,"name":package.name},
+                "source_info":game.create_package_data()
         }
-        package.generate_gameid()
-        imported_games.append(package)
-        log.write("humble download info for %s products"%len(hdata["subproducts"]))
-        for sub in hdata["subproducts"]:
-            game = games.Game(name=sub["human_name"],
-                                        website=sub["url"],
-                                        icon_url=sub["icon"],
-                                        import_date=games.now())
-            game.sources = [{"source":"humble","id":str(sub["machine_name"]),"package":hdata["gamekey"]}]
-            game.package_data = {
-                    "type":"content",
-                    "parent":{"gameid":package.gameid,"name":package.name},
-                    "source_info":game.create_package_data()
-            }
-            game.generate_gameid()
-            imported_games.append(game)
-            package.package_data["contents"].append({"gameid":game.gameid,"name":game.name})
+        game.generate_gameid()
+        order_games.append(game)
+        package.package_data["contents"].append({"gameid":game.gameid,"name":game.name})
+    return order_games
+
+def order_hash(hdata):
+    return hashlib.md5(json.dumps(hdata,sort_keys=True).encode("utf8")).hexdigest()
+
+async def get_humble_gamelist(runtime,emit,log,username,password,cache_root,known=None):
+    """Games in every humble order, an importer for importer.ImportRuntime. The orders are fetched
+    several at a time and emit gets each one, bundle and contents, in the order of the account.
+    cache/humble_orders.json keeps the source ids of the games each order was read into, by
+    gamekey. Merging can give a game another gameid, but it is still found by its source id, so an
+    order whose response hasn't changed since is left out if known(source id) is true for all of
+    them, and an import only merges orders that are new or changed. Returns the games emitted"""
+    b,keys = await runtime.fetch("humble",login,log,username,password,cache_root)
+    api_get_order = "https://www.humblebundle.com/api/v1/order/%(key)s"
+    log.write("humble download info for %s packages"%len(keys))
+    httpcache.open_cache(cache_root,"humble",30*httpcache.DAY).preload()
+    orders_path = cache_root+"/cache/humble_orders.json"
+    try:
+        with open(orders_path) as f:
+            read_orders = json.loads(f.read())
+    except (OSError,ValueError):
+        read_orders = {}
+    def get_order(key):
+        hdata = b.fetch(api_get_order%{"key":key},cache=True,cache_root=cache_root)["json"]
+        return hdata,order_hash(hdata)
+    fetches = [asyncio.ensure_future(runtime.fetch("humble",get_order,key)) for key in keys]
+    imported_games = []
+    unchanged = 0
+    try:
+        for key,fetch in zip(keys,fetches):
+            hdata,h = await fetch
+            print (hdata)
+            last = read_orders.get(key,None)
+            if known and last and last["hash"] == h and "sources" in last and all(known(sid) for sid in last["sources"]):
+                unchanged += 1
+                continue
+            order_games = read_order(hdata)
+            log.write("humble download info for %s products"%len(hdata["subproducts"]))
+            read_orders[key] = {"hash":h,"sources":[games.source_id(g.sources[0]) for g in order_games]}
+            imported_games.extend(order_games)
+            emit(order_games)
+    finally:
+        for fetch in fetches:
+            fetch.cancel()
+        with open(orders_path+".tmp","w") as f:
+            f.write(json.dumps(read_orders))
+        os.replace(orders_path+".tmp",orders_path)
+    log.write("humble: %s orders unchanged"%unchanged)
     for g in imported_games:
         print (g.name,g.gameid,g.package_data.keys(),g.icon_url)
     return imported_games
@@ -148,8 +154,19 @@ class Humble:
         self.app = app
         self.username = username
         self.password = password
-    def get_gamelist(self):
-        return get_humble_gamelist(self.app.log,self.username,self.password,self.app.config["root"])
+    def get_gamelist(self,runtime,emit):
+        known = lambda sid: sid in self.app.games.source_map
+        return get_humble_gamelist(runtime,emit,self.app.log,self.username,self.password,self.app.config["root"],known)
 
 if __name__ == "__main__":
-    get_humble_gamelist()
+    #python -m mblib.apis.humbleapi username password [root], root holds the cache folder
+    import sys
+    from mblib import syslog
+    from mblib.apis.importer import ImportRuntime
+    log = syslog.SysLog()
+    log.add_callback(print)
+    root = sys.argv[3] if len(sys.argv)>3 else "."
+    os.makedirs(root+"/cache",exist_ok=True)
+    runtime = ImportRuntime(lambda name,batch: None,lambda name,error: error and print("humble failed:",error))
+    runtime.start("humble",lambda runtime,emit: get_humble_gamelist(runtime,emit,log,sys.argv[1],sys.argv[2],root))
+    runtime.wait()
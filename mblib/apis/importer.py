@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import concurrent.futures
+
+#Requests in flight at once per service, more than this and the stores start answering 429
+LIMITS = {"steam":4,"gog":4,"humble":8}
+
+class ImportRuntime:
+    """Runs the importers of every service side by side on one asyncio loop, kept on its own thread.
+    An importer is a coroutine function importer(runtime,emit). It fetches with
+    await runtime.fetch(service,func,...), which runs the blocking func on a worker thread while
+    at most limits[service] fetches of that service are running, and hands the games it has
+    finished to emit(games) as soon as it has them instead of in one list at the end.
+    Every batch goes to merge(name,games) and, once an importer is done, finished(name,error)
+    is called with the exception it raised or None. Both are called on the loop thread, in the
+    order the batches were emitted and finished() after the last batch of its importer. The GUI
+    thread owns the database, so they must not change it here: hand the work over to the GUI
+    thread, by emitting a queued Qt signal, and return right away"""
+    def __init__(self,merge,finished,limits=None,workers=16):
+        self.merge = merge
+        self.finished = finished
+        self.limits = dict(LIMITS)
+        self.limits.update(limits or {})
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.loop = asyncio.new_event_loop()
+        self.semaphores = {}
+        self.running = {}       #name:concurrent Future of importers not done yet
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop,args=(ready,),daemon=True)
+        self.thread.start()
+        ready.wait()
+    def run_loop(self,ready):
+        asyncio.set_event_loop(self.loop)
+        ready.set()
+        self.loop.run_forever()
+    def start(self,name,importer):
+        """Run importer under name, unless one by that name is still running.
+        Returns a concurrent.futures.Future that is done after finished() was called for it"""
+        if name in self.running and not self.running[name].done():
+            return self.running[name]
+        self.running[name] = asyncio.run_coroutine_threadsafe(self.run_importer(name,importer),self.loop)
+        return self.running[name]
+    def wait(self,timeout=None):
+        """Block until every importer started so far is done"""
+        concurrent.futures.wait(list(self.running.values()),timeout)
+    async def fetch(self,service,func,*args,**kwargs):
+        """func(*args,**kwargs) on a worker thread, counted against the limit of service"""
+        if service not in self.semaphores:
+            self.semaphores[service] = asyncio.Semaphore(self.limits.get(service,4))
+        async with self.semaphores[service]:
+            return await self.loop.run_in_executor(self.executor,lambda: func(*args,**kwargs))
+    async def run_importer(self,name,importer):
+        def emit(games):
+            #Merges are queued in the order they are emitted, from the loop or from a worker thread
+            games = list(games)
+            if games:
+                self.loop.call_soon_threadsafe(self.call,self.merge,name,games)
+        error = None
+        try:
+            await importer(self,emit)
+        except Exception as e:
+            error = e
+        #Queued behind every batch the importer emitted
+        done = self.loop.create_future()
+        self.loop.call_soon(self.call,self.finished,name,error)
+        self.loop.call_soon(done.set_result,None)
+        await done
+    def call(self,func,*args):
+        try:
+            func(*args)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+def blocking(service,func):
+    """An importer for a blocking func(emit), run as one fetch of service"""
+    async def importer(runtime,emit):
+        await runtime.fetch(service,func,emit)
+    return importer
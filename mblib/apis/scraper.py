@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import random
+import threading
+import queue
+
+import requests
+
+from mblib import httpcache
+
+class TokenBucket:
+    """Lets through rate takes a second on average, and up to burst at once after a quiet spell"""
+    def __init__(self,rate,burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+    def take(self):
+        """Wait for a token"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,self.tokens+(now-self.last)*self.rate)
+                self.last = now
+                if self.tokens>=1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+class RateLimitedSession(requests.Session):
+    """A requests.Session that takes a token from bucket before every request it sends"""
+    def __init__(self,bucket,pool_size=10):
+        super(RateLimitedSession,self).__init__()
+        self.bucket = bucket
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,pool_maxsize=pool_size)
+        self.mount("http://",adapter)
+        self.mount("https://",adapter)
+    def request(self,*args,**kwargs):
+        self.bucket.take()
+        return super(RateLimitedSession,self).request(*args,**kwargs)
+
+def retry_after(error):
+    """Seconds a 429/503 answer asked us to wait, or None"""
+    response = getattr(error,"response",None)
+    if response is not None:
+        try:
+            return float(response.headers.get("Retry-After",""))
+        except ValueError:
+            pass
+
+class Scraper:
+    """Runs work(item,session) for a list of items on workers threads. They share session, which
+    keeps its connections open and spaces every request they make to rate a second. An item whose
+    work raises a requests error is retried retries times, waiting backoff seconds and twice as long
+    each time after. Items still to do are saved to queue_path as the run goes, so a run that is
+    interrupted resumes with them, and items that kept failing are left alone for retry_delay
+    seconds instead of holding up every import"""
+    def __init__(self,queue_path,work,workers=8,rate=2,burst=10,retries=4,backoff=1.0,retry_delay=24*60*60,logger=None):
+        self.queue_path = queue_path
+        self.work = work
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_delay = retry_delay
+        self.logger = logger
+        self.session = RateLimitedSession(TokenBucket(rate,burst),workers)
+        self.lock = threading.Lock()
+        self.pending = []       #items not done yet, in the order they are done
+        self.failed = {}        #item:time to try it again
+        self.results = {}
+        self.saved = 0
+    def log(self,text):
+        if self.logger:
+            self.logger.write(text)
+        else:
+            print(text)
+    def load(self):
+        try:
+            with open(self.queue_path) as f:
+                d = json.loads(f.read())
+            return d["pending"],d["failed"]
+        except (OSError,ValueError,KeyError):
+            return [],{}
+    def save(self,min_interval=0):
+        with self.lock:
+            if time.time()-self.saved<min_interval:
+                return
+            self.saved = time.time()
+            data = json.dumps({"pending":self.pending,"failed":self.failed})
+        with open(self.queue_path+".tmp","w") as f:
+            f.write(data)
+        os.replace(self.queue_path+".tmp",self.queue_path)
+    def run(self,items):
+        """{item:result of work} for items. Items that failed, or are waiting to be tried again, are left out"""
+        items = list(dict.fromkeys(items))
+        pending,failed = self.load()
+        if pending:
+            self.log("Resuming with %s items left from the last run"%len([i for i in pending if i in items]))
+        #Items an interrupted run left first, the rest are new or already cached
+        order = dict((item,n) for n,item in enumerate(pending))
+        items.sort(key=lambda item:order.get(item,len(order)))
+        now = time.time()
+        self.failed = dict((item,t) for item,t in failed.items() if t>now and item in items)
+        self.pending = [item for item in items if item not in self.failed]
+        if self.failed:
+            self.log("Skipping %s items that failed recently"%len(self.failed))
+        self.results = {}
+        self.save()
+        work_queue = queue.Queue()
+        for item in list(self.pending):
+            work_queue.put(item)
+        total = len(self.pending)
+        threads = [threading.Thread(target=self.work_loop,args=(work_queue,total),daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.save()
+        return self.results
+    def work_loop(self,work_queue,total):
+        while True:
+            try:
+                item = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            result = self.attempt(item)
+            with self.lock:
+                self.pending.remove(item)
+                if result is not None:
+                    self.results[item] = result
+                else:
+                    self.failed[item] = time.time()+self.retry_delay
+                done = total-len(self.pending)
+            self.log("Read data for item %s of %s"%(done,total))
+            self.save(2)
+    def attempt(self,item):
+        """work(item) retried with backoff, None if it never worked"""
+        for attempt in range(self.retries+1):
+            try:
+                return self.work(item,self.session)
+            except requests.RequestException as error:
+                if attempt == self.retries:
+                    self.log("Giving up on %s: %s"%(item,error))
+                    return None
+                wait = retry_after(error)
+                if wait is None:
+                    wait = self.backoff*2**attempt*random.uniform(0.5,1.5)
+                time.sleep(wait)
+            except Exception:
+                #Retrying won't fix a bug, note it and move on
+                import traceback
+                traceback.print_exc()
+                return None
+
+class Browser:
+    """A logged in account on a store. get() and post() keep the answer on the browser, fetch()
+    returns it instead, so several fetches can run at once over the one session. Subclasses name
+    the http cache they use with cache_name and cache_ttl, and legacy_key() gives the file an
+    older version cached url in"""
+    cache_name = None
+    cache_ttl = 7*httpcache.DAY
+    def __init__(self):
+        self.cookies = {}
+        #fetch() runs on several threads, each request is sent a copy of the cookies taken under this
+        self.cookies_lock = threading.Lock()
+        #One pool of connections for every request
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=10)
+        self.session.mount("http://",adapter)
+        self.session.mount("https://",adapter)
+        self.headers = {"Accept":"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8","Accept-Encoding":"gzip, deflate","Accept-Language":"en-us,ko;q=0.7,en;q=0.3",
+            "User-Agent":"Mozilla/5.0 (Macintosh; Intel Mac OS X 10.6; rv:28.0) Gecko/20100101 Firefox/28.0",
+            "Referer":"https://www.humblebundle.com/",
+            "X-Requested-With":"XMLHttpRequest"}
+    def post(self,url,datax={},params={}):
+        self.json = {}
+        self.text = ""
+        answer = self.session.post(url,data=datax,params=params,cookies=self.cookie_jar(),headers=self.headers,allow_redirects=True)
+        self.answer = answer
+        with self.cookies_lock:
+            self.cookies.update(answer.cookies)
+        try:
+            self.json = answer.json()
+        except:
+            pass
+        try:
+            self.text = answer.text
+            self.url = answer.url
+        except:
+            pass
+    def get(self,url,params={},cache=False,cache_root=""):
+        self.json = {}
+        self.text = ""
+        d = self.fetch(url,params,cache,cache_root)
+        self.json = d["json"]
+        self.text = d["text"]
+        self.url = d["url"]
+    def cookie_jar(self):
+        with self.cookies_lock:
+            return dict(self.cookies)
+    def legacy_key(self,url):
+        return url.replace(":","").replace("/","")
+    def fetch(self,url,params={},cache=False,cache_root=""):
+        """{"json","text","url"} of url. Unlike get() it leaves the browser alone, so several can run at once"""
+        cookies = self.cookie_jar()
+        def parse(answer):
+            with self.cookies_lock:
+                self.cookies.update(answer.cookies)
+            d = {"json":{},"text":"","url":getattr(self,"url","")}
+            try:
+                d["json"] = answer.json()
+            except:
+                pass
+            try:
+                d["text"] = answer.text
+                d["url"] = answer.url
+            except:
+                pass
+            return d
+        if cache:
+            http_cache = httpcache.open_cache(cache_root,self.cache_name,self.cache_ttl)
+            http_cache.adopt_legacy(url,self.legacy_key(url),json.loads)
+            return http_cache.get(url,parse,session=self.session,params=params,cookies=cookies,headers=self.headers)
+        return parse(self.session.get(url,params=params,cookies=cookies,headers=self.headers))
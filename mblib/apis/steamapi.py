@@ -1,14 +1,15 @@
 #!python3
 import re,os,time
+import ast,json
 import random
-from concurrent import futures
 import codecs
 
 import requests
 from bs4 import BeautifulSoup
 
-from mblib.apis import vdf
+from mblib.apis import vdf,scraper
 from mblib.resources import icons
+from mblib import httpcache
 
 try:
     from .. import games
@@ -21,6 +22,13 @@ MY_STEAM_ID = ""
 
 STEAM_GAMES_URL = "http://api.steampowered.com/IPlayerService/GetOwnedGames/v0001/?key=%(apikey)s&steamid=%(steamid)s&format=json&include_appinfo=1&include_played_free_games=1"
 USER_DATA_URL = "http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/?key=%(apikey)s&steamids=%(steamid)s&format=json"
+#Tags and categories of a store page are checked again after this many seconds
+APP_PAGE_TTL = 30*httpcache.DAY
+#Store pages fetched a second on average when the config has no steam_scrape_rate. The store
+#answers 429 when pushed harder, those are retried with backoff but slow everything down.
+#Only the genres wait on the scrape, the games are merged before it starts, and pages
+#stay cached for APP_PAGE_TTL, so only the first import of a big library takes long
+SCRAPE_RATE = 2
 
 def vg(dat,key):
     try:
@@ -65,8 +73,13 @@ def login_for_chat():
     sess.headers["Referer"] = "http://steamcommunity.com/trade/1"
     try:
         f = open("cache/steamcookies",encoding="utf8")
-        cookies = eval(f.read())
+        text = f.read()
         f.close()
+        try:
+            cookies = json.loads(text)
+        except ValueError:
+            #Saved with repr() by older versions
+            cookies = ast.literal_eval(text)
     except:
         cookies = {}
     print(cookies)
@@ -115,7 +128,7 @@ def login_for_chat():
     sess.post("https://steamcommunity.com/",data={})
     cookies = sess.cookies
     f = open("cache/steamcookies","w",encoding="utf8")
-    f.write(repr(requests.utils.dict_from_cookiejar(cookies)))
+    f.write(json.dumps(requests.utils.dict_from_cookiejar(cookies)))
     f.close()
     return sess
 
@@ -165,18 +178,18 @@ def get_user_id(custom_name):
     else:
         return custom_name
 
-def scrape_app_page(appid,cache_root="",logger=None):
+def scrape_app_page(appid,cache_root="",logger=None,session=None):
     url = "http://store.steampowered.com/app/"+str(appid)
 
-    if not os.path.exists(cache_root+"/cache/steamapi"):
-        os.mkdir(cache_root+"/cache/steamapi")
-    cache_url = cache_root+"/cache/steamapi/"+url.replace(":","").replace("/","").replace("?","QU").replace("&","AN")
-    dat = {}
-    if not os.path.exists(cache_url):
-        r = requests.get(url)
+    cache = httpcache.open_cache(cache_root,"steamapi",APP_PAGE_TTL)
+    cache.adopt_legacy(url,url.replace(":","").replace("/","").replace("?","QU").replace("&","AN"),ast.literal_eval)
+    def parse(r):
+        if r.status_code == 429 or r.status_code>=500:
+            #Worth trying again later
+            r.raise_for_status()
         html = r.text
         if "agecheck" in r.url:
-            r = requests.post("http://store.steampowered.com/agecheck/app/"+str(appid)+"/",{
+            r = (session or requests).post("http://store.steampowered.com/agecheck/app/"+str(appid)+"/",{
                     "snr":"1_agecheck_agecheck__age-gate",
                     "ageDay":str(random.randint(1,28)),
                     "ageMonth":random.choice(["February","September"]),
@@ -204,17 +217,9 @@ def scrape_app_page(appid,cache_root="",logger=None):
 
         dat = {"tags":tags,"categories":categories,"vr":vr}
 
-        f = open(cache_url,"w")
-        f.write(repr(dat))
-        f.close()
-
         print("Caching data for:"+appid)
-        time.sleep(0.1)
-    else:
-        f = open(cache_url)
-        dat = eval(f.read())
-        f.close()
-    return dat
+        return dat
+    return cache.get(url,parse,session=session)
 
 def get_games(apikey=MY_API_KEY,userid=MY_STEAM_ID):
     url = STEAM_GAMES_URL
@@ -227,7 +232,10 @@ def get_games(apikey=MY_API_KEY,userid=MY_STEAM_ID):
         raise ApiError()
     return data
 
-def import_steam(apikey=MY_API_KEY,userid=MY_STEAM_ID,cache_root=".",user_data=None,logger=None):
+def import_steam(apikey=MY_API_KEY,userid=MY_STEAM_ID,cache_root=".",user_data=None,logger=None,emit=None,rate=None):
+    """{appid:Game} of the games userid owns. If emit is given the games are handed to it before
+    their store pages are read, and the ones the pages added a genre to again after. Store pages are
+    fetched at rate a second, SCRAPE_RATE if it isn't given"""
     #apps = load_userdata()["UserLocalConfigStore"]["Software"]["valve"]["Steam"]["apps"]
     apps = {}
     if user_data:
@@ -249,7 +257,7 @@ def import_steam(apikey=MY_API_KEY,userid=MY_STEAM_ID,cache_root=".",user_data=N
         if app:
             lp = app.get("lastplayed",None)
             if lp:
-                lastplayed=games.sec_to_ts(int(lp))
+                lastplayed=int(lp)
         #print(g)
         game = games.Game(name=g["name"],
                             minutes=g["playtime_forever"],
@@ -265,10 +273,9 @@ def import_steam(apikey=MY_API_KEY,userid=MY_STEAM_ID,cache_root=".",user_data=N
         game.generate_gameid()
         db[str(g["appid"])] = game
 
-    def get_extra_data(game):
-        logger.write("scraping data...")
-        extra_data = scrape_app_page(game.sources[0]["id"],cache_root,logger=logger)
-        logger.write("scraped data:"+"".join(extra_data.keys()))
+    def scrape(appid,session):
+        return scrape_app_page(appid,cache_root,logger=logger,session=session)
+    def get_extra_data(game,extra_data):
         genre = ""
         for cat in extra_data["categories"]:
             if "co-op" in cat.lower() and not genre:
@@ -279,21 +286,21 @@ def import_steam(apikey=MY_API_KEY,userid=MY_STEAM_ID,cache_root=".",user_data=N
             genre += "; vr_"+vr
         if genre:
             game.genre = genre
+            return True
 
-    num_data = len(db)
-
-    game_tasks = [game for game in db.values()]
-    i = 0
-    while game_tasks:
-        next_set = game_tasks[:100]
-        game_tasks = game_tasks[100:]
-        with futures.ThreadPoolExecutor(50) as executor:
-            tasks = [executor.submit(get_extra_data,game) for game in next_set]
-            for cf in futures.as_completed(tasks):
-                cf.result()
-                if logger:
-                    logger.write("Read data for game %s of %s"%(i+1,num_data))
-                i+=1
+    if emit:
+        #Copies, the scrape below still changes the originals
+        emit([game.copy() for game in db.values()])
+    httpcache.open_cache(cache_root,"steamapi",APP_PAGE_TTL).preload()
+    #Pages that fail are skipped and tried again by a later import
+    pages = scraper.Scraper(cache_root+"/cache/steam_scrape_queue.json",scrape,rate=rate or SCRAPE_RATE,logger=logger)
+    extra_data = pages.run(list(db.keys()))
+    changed = []
+    for appid,game in db.items():
+        if appid in extra_data and get_extra_data(game,extra_data[appid]):
+            changed.append(game)
+    if emit:
+        emit(changed)
 
     return db
 
@@ -368,16 +375,20 @@ class Steam:
                 i+=1
         print("found steam paths:",paths)
         return paths
-    def import_steam(self):
+    def import_steam(self,emit=None):
         games = {}
+        rate = self.app.config.get("steam_scrape_rate",SCRAPE_RATE)
         try:
-            games = import_steam(self.api_key,self.user_id,self.app.config["root"],self.userdata,self.app.log)
+            games = import_steam(self.api_key,self.user_id,self.app.config["root"],self.userdata,self.app.log,emit,rate)
         except ApiError:
             user_id = get_user_id(self.profile_name)
-            games = import_steam(self.api_key,user_id,self.app.config["root"],self.userdata,self.app.log)
+            games = import_steam(self.api_key,user_id,self.app.config["root"],self.userdata,self.app.log,emit,rate)
             if user_id != self.user_id:
                 self.user_id = user_id
+        owned = set(games.keys())
         self.update_local_games(games)
+        if emit:
+            emit([game for appid,game in games.items() if appid not in owned])
         return list(games.values())
     def update_local_games(self,db):
         paths = self.get_steamapp_paths()
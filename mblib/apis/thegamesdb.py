@@ -7,6 +7,8 @@ import requests
 import urllib
 import xml.etree.cElementTree as etree
 
+from mblib import httpcache
+
 gamelistep = "http://thegamesdb.net/api/GetGamesList.php"
 gameep = "http://thegamesdb.net/api/GetGame.php"
 
@@ -86,18 +88,10 @@ def _process_filedb():
 def find_game(name,platform,cache_root="..\.."):
     for platform in platforms[platform]:
         print("search for platform",platform["sys"])
-        ckey = cache_root+"/cache/thegamesdb/fg"+name.replace(" ","_").replace(":","-").replace("/","_slsh_")
-        if os.path.exists(ckey):
-            print("from cache")
-            xml = open(ckey).read()
-        else:
-            print("look up",ckey)
-            print({"name":'"'+name+'"',"platform":platform["sys"]})
-            r = requests.get(gamelistep,params={"name":'"'+name+'"',"platform":platform["sys"]})
-            xml = r.text
-            print(xml)
-            with open(ckey,"w",encoding="utf8") as f:
-                f.write(xml)
+        params = {"name":'"'+name+'"',"platform":platform["sys"]}
+        cache = httpcache.open_cache(cache_root,"thegamesdb",30*httpcache.DAY)
+        cache.adopt_legacy(httpcache.cache_key(gamelistep,params),"fg"+name.replace(" ","_").replace(":","-").replace("/","_slsh_"),lambda xml:xml)
+        xml = cache.get(gamelistep,lambda r:r.text,params=params)
         root = etree.XML(xml)
         list = [to_dict(game) for game in root]
         if not list:
@@ -117,14 +111,10 @@ def find_game(name,platform,cache_root="..\.."):
         return list[0]
 
 def get_game_info(game_id,cache_root="..\.."):
-    ckey = cache_root+"/cache/thegamesdb/gi"+str(game_id)
-    if os.path.exists(ckey):
-        xml = open(ckey).read()
-    else:
-        r = requests.get(gameep,params={"id":game_id})
-        xml = r.text
-        with open(ckey,"w",encoding="utf8") as f:
-            f.write(xml)
+    params = {"id":game_id}
+    cache = httpcache.open_cache(cache_root,"thegamesdb",30*httpcache.DAY)
+    cache.adopt_legacy(httpcache.cache_key(gameep,params),"gi"+str(game_id),lambda xml:xml)
+    xml = cache.get(gameep,lambda r:r.text,params=params)
     root = etree.XML(xml)
     return to_dict(root)
     
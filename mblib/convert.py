@@ -380,20 +380,33 @@ def v007_to_v008(gdb_inp,ldb_inp):
     print(collisions,len(gdb_inp["games"])-collisions)
     return out_games,out_local
 
+def v008_to_v009(gdb_inp):
+    """
+    Converts the date fields (lastplayed, import_date, finish_date, data_changed_date, priority_date)
+    from "%H:%M:%S %Y-%m-%d" strings to integer epoch seconds. Empty dates become 0.
+
+    "lastplayed": "13:32:54 2015-01-19"
+
+    >>>
+
+    "lastplayed": 1421692374
+    """
+    out_games = copy.deepcopy(gdb_inp)
+    out_games["version"] = 9
+    print("starting:",len(gdb_inp["games"]))
+    ran = 0
+    for key in out_games["games"]:
+        ran += 1
+        games.upgrade_record(out_games["games"][key])
+    print("looped",ran,"times")
+    return out_games
+
 import json
-f = open("../data/gamesv007.json")
+f = open("../data/gamesv008.json")
 gdb = json.loads(f.read())
 f.close()
 
-l = open("../data/localv001.json")
-ldb = json.loads(l.read())
-l.close()
-
-gdb,ldb = v007_to_v008(gdb,ldb)
-g = open("../data/gamesv008.json","w")
+gdb = v008_to_v009(gdb)
+g = open("../data/gamesv009.json","w")
 g.write(json.dumps(gdb,indent=4,sort_keys=True))
-g.close()
-
-l = open("../data/localv002.json","w")
-l.write(json.dumps(ldb,indent=4,sort_keys=True))
-l.close()
\ No newline at end of file
+g.close()
\ No newline at end of file
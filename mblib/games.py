@@ -6,22 +6,37 @@ import json
 import ubjson
 import gzip
 import hmac
+import hashlib
 import copy
 import io
-from mblib import sources,syslog
+import struct
+import threading
+import collections.abc
+import bisect
+from mblib import sources,syslog,search
 
+#Database format version, 9 stores timestamps as epoch seconds instead of strings in fmt
+DB_VERSION = 9
+#Timestamp format used by databases before version 9
 fmt = "%H:%M:%S %Y-%m-%d"
+#Game fields holding a timestamp
+TIME_FIELDS = ("lastplayed","data_changed_date","import_date","finish_date","priority_date")
 def now():
-    t = time.localtime()
-    return time.strftime(fmt,t)
-def stot(s):
-    """From a string, return a struct_time"""
-    if not s or s == "None":
-        return time.localtime(0)
+    return int(time.time())
+def to_seconds(value):
+    """Epoch seconds from a stored timestamp, which may be a string in fmt from an older database.
+    0 means no timestamp"""
+    if isinstance(value,(int,float)):
+        return value
+    if not value or value == "None":
+        return 0
     try:
-        return time.strptime(s,fmt)
+        return int(time.mktime(time.strptime(value,fmt)))
     except:
-        return time.localtime(0)
+        return 0
+def stot(s):
+    """From a timestamp, return a struct_time"""
+    return time.localtime(to_seconds(s))
 def ttos(t):
     """From a struct_time object, return a string"""
     return time.strftime(fmt,t)
@@ -30,7 +45,126 @@ def sec_to_ts(sec):
     return ttos(time.localtime(sec))
 def ts_to_sec(ts):
     """Convert an amount of seconds as a string into a time delta"""
-    return time.mktime(stot(ts))
+    return to_seconds(ts)
+#Stand-in dates used to sort games that have never been added/changed
+UNKNOWN_ADDED = to_seconds("23:39:03 1970-07-16")
+UNKNOWN_CHANGED = to_seconds("23:39:03 1980-07-16")
+
+def upgrade_record(d):
+    """Convert the timestamps of a saved game from an older database to epoch seconds"""
+    for key in TIME_FIELDS:
+        if key in d:
+            d[key] = to_seconds(d[key])
+    return d
+
+#Number of journal flushes before save() folds the journal back into the snapshot
+JOURNAL_COMPACT_RECORDS = 200
+
+def journal_path(game_db_file):
+    return game_db_file+".journal"
+
+#Bytes read or written at a time when a database file is streamed
+CHUNK_SIZE = 64*1024
+
+def file_hash(path):
+    """sha256 hex digest of the file at path, read a chunk at a time"""
+    sha = hashlib.sha256()
+    with open(path,"rb") as f:
+        while 1:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                return sha.hexdigest()
+            sha.update(data)
+
+def append_journal(game_db_file,data):
+    """Append one ubjson encoded record to the journal of game_db_file"""
+    with open(journal_path(game_db_file),"ab") as f:
+        f.write(struct.pack(">I",len(data))+data)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_atomic(path,data,compress=False):
+    """Write data to path through a temporary file that is synced to disk and renamed over it,
+    so a crash part way leaves the old file rather than half of the new one"""
+    tmp = path+".tmp"
+    with open(tmp,"wb") as f:
+        if compress:
+            with gzip.GzipFile(fileobj=f,mode="wb") as gz:
+                gz.write(data)
+        else:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
+    if hasattr(os,"O_DIRECTORY"):
+        #Make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(path)),os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class Saver:
+    """Write-behind for a save function. request() returns at once, and save runs on a thread of its
+    own delay seconds after the last request, but never more than max_delay after the first one it
+    hasn't written yet. A burst of changes is written once and the caller never waits on the disk"""
+    def __init__(self,save,delay=0.5,max_delay=2.0):
+        self.save = save
+        self.delay = delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.first = None       #time of the first request not saved yet
+        self.last = None
+        self.saving = False
+        self.requests = 0
+        self.saves = 0
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+    def request(self):
+        with self.cond:
+            now = time.time()
+            if self.first is None:
+                self.first = now
+            self.last = now
+            self.requests += 1
+            self.cond.notify_all()
+    def pending(self):
+        with self.cond:
+            return self.first is not None or self.saving
+    def run(self):
+        while 1:
+            with self.cond:
+                if self.first is None or self.saving:
+                    self.cond.wait()
+                    continue
+                wait = min(self.last+self.delay,self.first+self.max_delay)-time.time()
+                if wait>0:
+                    self.cond.wait(wait)
+                    continue
+                self.first = self.last = None
+                self.saving = True
+            self.write()
+    def write(self):
+        try:
+            self.save()
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            with self.cond:
+                self.saving = False
+                self.saves += 1
+                self.cond.notify_all()
+    def flush(self):
+        """Save now if anything is waiting, and return once it is on disk"""
+        with self.cond:
+            while self.saving:
+                self.cond.wait()
+            if self.first is None:
+                return
+            self.first = self.last = None
+            self.saving = True
+        self.write()
 
 PRIORITIES = {-1:"now playing",0:"unprioritized",1:"soon",2:"later",3:"much later",5:"next year",99:"probably never"}
 
@@ -41,6 +175,21 @@ BAD_GAMEID = InvalidId("Do not save me")
 def get_source(s):
     return sources.all[s]
     
+def strip_name(name):
+    """Lowercase name with only letters, digits and underscores for spaces"""
+    if not name:
+        return ""
+    s = [x.lower() for x in name if x.lower() in "abcdefghijklmnopqrstuvwxyz1234567890 "]
+    return "".join(s).replace(" ","_")
+
+def package_refs(package_data):
+    """gameids a game's package_data points at, its contents for a bundle or its parent for content"""
+    refs = [child["gameid"] for child in package_data.get("contents",[])]
+    parent = package_data.get("parent",{})
+    if parent and parent.get("gameid"):
+        refs.append(parent["gameid"])
+    return refs
+
 def source_id(s):
     id = (0, "")
     for k in s:
@@ -51,13 +200,16 @@ def source_id(s):
             restpart = int(restpart)
             if restpart>id[0]:
                 id = (restpart,k)
-    return s["source"] + "_" + s.get(id[1],"")
+    return s["source"] + "_" + str(s.get(id[1],""))
 
 class Game:
     args = [("name","s"),("playtime","f"),("lastplayed","d"),("genre","s"),("icon_url","s"),("logo_url","s"),
     ("notes","s"),("priority","p"),("priority_date","d"),("website","s"),("import_date","d"),("finish_date","d")]
+    #Fields written to the database by dict(), icon_url and logo_url from args are stored in images
+    savekeys = ("gameid","name","playtime","finished","hidden","package_data","lastplayed","data_changed_date",
+    "import_date","finish_date","sources","genre","images","notes","priority","priority_date","local_files","website")
+    __slots__ = savekeys+("games","widget_name")
     def __init__(self,**kwargs):
-        dontsavekeys = set(dir(self))
         self.gameid = BAD_GAMEID
 
         self.name = ""
@@ -65,25 +217,27 @@ class Game:
         self.finished = 0
         self.hidden = 0
         self.package_data = {}
-        self.lastplayed = ""   #timestamp in fmt
-        self.data_changed_date = ""
-        self.import_date = ""
-        self.finish_date = ""
+        self.lastplayed = 0   #timestamps in epoch seconds, 0 for never
+        self.data_changed_date = 0
+        self.import_date = 0
+        self.finish_date = 0
         self.sources = []
         self.genre = ""
         self.images = []
         self.notes = ""
         self.priority = 0
-        self.priority_date = ""
+        self.priority_date = 0
         self.local_files = []
 
         self.website = ""
-        self.savekeys = set(dir(self)) - dontsavekeys
+        self.widget_name = ""
         for k in kwargs:
             if k == "icon_url":
                 self.images.append({"size":"icon","url":kwargs[k]})
             elif k == "logo_url":
                 self.images.append({"size":"logo","url":kwargs[k]})
+            elif k in TIME_FIELDS:
+                setattr(self,k,to_seconds(kwargs[k]))
             elif hasattr(self,k):
                 setattr(self,k,kwargs[k])
         if "minutes" in kwargs:
@@ -95,7 +249,15 @@ class Game:
         if key=="hidden" and value not in [0,1]:
             return False,[0,1]
         setattr(self,key,value)
+        self.touch()
         return True,None
+    def touch(self):
+        """Let the owning Games know this game needs to be written on next save"""
+        if self.games:
+            self.games.touch(self)
+    def seconds(self,key):
+        """Timestamp field key as epoch seconds"""
+        return to_seconds(getattr(self,key))
     @property
     def icon_url(self):
         for image in self.images:
@@ -122,11 +284,7 @@ class Game:
         self.images.append({"size":"logo","url":url})
     @property
     def name_stripped(self):
-        if not self.name:
-            return ""
-        s = [x.lower() for x in self.name if x.lower() in "abcdefghijklmnopqrstuvwxyz1234567890 "]
-        s = "".join(s).replace(" ","_")
-        return s
+        return strip_name(self.name)
     @property
     def name_ascii(self):
         if not self.name:
@@ -135,7 +293,7 @@ class Game:
         return s
     def generate_gameid(self):
         """Used to generate the intial gameid, before collisions are checked when checking into the db"""
-        pool = hmac.new(b"")
+        pool = hmac.new(b"",digestmod="md5")
         if self.sources:
             for s in self.sources:
                 pool.update(bytes(s["source"],"utf8"))
@@ -181,12 +339,15 @@ class Game:
         self.lastplayed = now()
         self.playtime += elapsed_time
         self.priority = -1
+        self.touch()
     def finish(self):
         self.finished = 1
-        self.finish_date = games.now()
+        self.finish_date = now()
+        self.touch()
     def unfinish(self):
         self.finished = 0
-        self.finish_date = ""
+        self.finish_date = 0
+        self.touch()
     def display_print(self):
         print (self.name)
         print ("  %.2d:%.2d"%self.hours_minutes)
@@ -220,13 +381,9 @@ class Game:
         self.playtime = t
     @property
     def last_played_nice(self):
-        if not self.lastplayed or self.lastplayed == "None":
+        if not self.seconds("lastplayed"):
             return "never"
-        try:
-            t = time.strptime(self.lastplayed,fmt)
-            return time.strftime("%a, %d %b %Y %H:%M:%S",t)
-        except:
-            return "error"
+        return time.strftime("%a, %d %b %Y %H:%M:%S",stot(self.lastplayed))
     @property
     def download_link(self):
         for s in self.sources:
@@ -319,8 +476,6 @@ class Game:
         match1 = self.source_match
         match2 = other_game.source_match
 
-        print(match1,match2)
-
         if self.is_package != other_game.is_package:
             return False
         if self.is_in_package != other_game.is_in_package:
@@ -390,6 +545,9 @@ class Game:
     def update_dynamic_fields(self):
         if not self.website and self.sources and get_source(self.sources[0]["source"]).generate_website:
             self.website = get_source(self.sources[0]["source"]).generate_website(self,self.sources[0])
+            #Changed in place, a journaled save only writes games that were touched
+            if self.website:
+                self.touch()
     def get_source(self,source_type):
         for s in self.sources:
             if s["source"]==source_type:
@@ -410,6 +568,8 @@ test1 = Game(name="blah")
 test2 = test1.copy()
 test2.name = "blah2"
 assert test1.name!=test2.name
+assert set(test1.dict()) == set(Game.savekeys)
+assert [k for k,t in Game.args if k not in Game.savekeys] == ["icon_url","logo_url"]
 
 def changed(da,db):
     """Helper for update action, returns difference of 2 dicts"""
@@ -442,22 +602,216 @@ def nicediff(diff):
         s+=k+":"+str(n[k]["v"])+"  "
     return s
 
+class GameMap(collections.abc.MutableMapping):
+    """gameid:Game mapping which holds the decoded records from the database and only
+    builds the Game for a record the first time it is accessed"""
+    def __init__(self,games):
+        self.games = games
+        self.data = {}
+    def __getitem__(self,gameid):
+        game = self.data[gameid]
+        if not isinstance(game,Game):
+            game = self.games.hydrate(game)
+            self.data[gameid] = game
+        return game
+    def __setitem__(self,gameid,game):
+        self.data[gameid] = game
+    def __delitem__(self,gameid):
+        del self.data[gameid]
+    def __iter__(self):
+        return iter(self.data)
+    def __len__(self):
+        return len(self.data)
+    def __contains__(self,gameid):
+        return gameid in self.data
+    def is_loaded(self,gameid):
+        return isinstance(self.data[gameid],Game)
+    def raw(self,gameid):
+        """The record gameid was loaded from, or None if it has already become a Game"""
+        game = self.data[gameid]
+        if not isinstance(game,Game):
+            return game
+    def field(self,gameid,key,default=""):
+        """Read a saved field of a game without building the Game"""
+        game = self.data[gameid]
+        if isinstance(game,Game):
+            return getattr(game,key)
+        return game.get(key,default)
+    def seconds(self,gameid,key):
+        """Timestamp field key of a game as epoch seconds"""
+        game = self.data[gameid]
+        if isinstance(game,Game):
+            return game.seconds(key)
+        return to_seconds(game.get(key,0))
+
+class GameList(collections.abc.Sequence):
+    """Ordered list of games from a GameMap, each Game is built when its row is read"""
+    def __init__(self,game_map,gameids):
+        self.game_map = game_map
+        self.gameids = gameids
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self.game_map[gameid] for gameid in self.gameids[i]]
+        return self.game_map[self.gameids[i]]
+    def __len__(self):
+        return len(self.gameids)
+
 class Games:
     def __init__(self,log=None):
         self.revision = 0
-        self.games = {}
-        self.source_map = {}
+        self.version = DB_VERSION
+        self.lazy = False          #If True, Game objects are only built from loaded data when first accessed
+        self.games = GameMap(self)
+        #Indexes kept up to date by touch() and forget()
+        self.source_map = {}       #source_id:[gameid] of games with that source
+        self.package_map = {}      #gameid:[gameid] of games whose package_data references that gameid
+        self.name_map = {}         #lowercase name:[gameid]
+        self.index_keys = {}       #gameid:(source_ids,package refs,name) the game is currently filed under
+        self.orderings = {}        #sort:[(sort key,gameid)] kept sorted, built the first time list(sort) is called
+        self.order_keys = {}       #sort:{gameid:sort key}
+        self.search_index = None   #search.SearchIndex, built the first time search() is called
+        self.search_lock = threading.RLock() #search() may run on another thread while games change
         self.multipack = {}
         self.local = {}
         self.source_definitions = {}
         self.log = log or syslog.SysLog()
+
+        self.journal = False       #If True, save() appends changed games to a journal instead of rewriting the db
+        self.dirty = set()         #gameids changed since the last save
+        self.deleted = set()       #gameids removed since the last save
+        self.journal_records = 0
+        self.journal_meta = None
+        self.save_lock = threading.Lock()
+        self.generation = 0        #Counts snapshots, so a journal older than the snapshot is never replayed onto it
+
+        self.unsynced = set()      #gameids changed since the last sync upload
+        self.unsynced_deleted = set()
+    def touch(self,game):
+        """Mark game as changed since the last save"""
+        self.dirty.add(game.gameid)
+        self.deleted.discard(game.gameid)
+        self.unsynced.add(game.gameid)
+        self.unsynced_deleted.discard(game.gameid)
+        self.index_game(game.gameid)
+        self.reorder(game.gameid)
+    def forget(self,gameid):
+        """Mark gameid as removed since the last save"""
+        self.dirty.discard(gameid)
+        self.deleted.add(gameid)
+        self.unsynced.discard(gameid)
+        self.unsynced_deleted.add(gameid)
+        self.unindex_game(gameid)
+        self.reorder(gameid)
+    def index_game(self,gameid):
+        """File gameid under its current sources, package references and name"""
+        self.unindex_game(gameid)
+        if gameid not in self.games:
+            return
+        keys = ([source_id(s) for s in self.games.field(gameid,"sources",[])],
+                package_refs(self.games.field(gameid,"package_data",{})),
+                self.games.field(gameid,"name").lower().strip())
+        for index,index_keys in self.indexes(keys):
+            for key in index_keys:
+                if key not in index:
+                    index[key] = []
+                if gameid not in index[key]:
+                    index[key].append(gameid)
+        self.index_keys[gameid] = keys
+        if self.search_index is not None and gameid != BAD_GAMEID:
+            self.index_search(gameid)
+    def unindex_game(self,gameid):
+        if self.search_index is not None:
+            with self.search_lock:
+                self.search_index.remove(gameid)
+        if gameid not in self.index_keys:
+            return
+        keys = self.index_keys.pop(gameid)
+        for index,index_keys in self.indexes(keys):
+            for key in index_keys:
+                if gameid in index.get(key,[]):
+                    index[key].remove(gameid)
+                    if not index[key]:
+                        del index[key]
+    def indexes(self,keys):
+        return [(self.source_map,keys[0]),(self.package_map,keys[1]),(self.name_map,[keys[2]])]
+    def build_index(self):
+        """Rebuild all indexes from scratch, only needed after loading"""
+        self.source_map = {}
+        self.package_map = {}
+        self.name_map = {}
+        self.index_keys = {}
+        self.orderings = {}
+        self.order_keys = {}
+        self.search_index = None
+        for gameid in self.games:
+            self.index_game(gameid)
+    def index_search(self,gameid):
+        f = self.games.field
+        package_data = f(gameid,"package_data",{})
+        texts = {"name":f(gameid,"name")+"\n"+package_data.get("parent",{}).get("name",""),
+                 "genre":f(gameid,"genre"),
+                 "source":" ".join([s["source"] for s in f(gameid,"sources",[])])}
+        tags = []
+        if f(gameid,"hidden",0):
+            tags.append("hidden")
+        if f(gameid,"finished",0):
+            tags.append("finished")
+        if package_data.get("type","")=="bundle":
+            tags.append("package")
+        with self.search_lock:
+            self.search_index.add(gameid,texts,tags)
+    def search(self,query,field="name"):
+        """set of gameids matching query in field (name, genre or source), see search.parse_query"""
+        with self.search_lock:
+            if self.search_index is None:
+                self.search_index = search.SearchIndex()
+                for gameid in list(self.games.data):
+                    if gameid != BAD_GAMEID:
+                        self.index_search(gameid)
+            return self.search_index.search(query,field)
+    def playtime(self,gameids):
+        """Total playtime of gameids"""
+        played = 0
+        for gameid in gameids:
+            try:
+                played += self.games.field(gameid,"playtime",0)
+            except KeyError:
+                pass
+        return played
+    def sort_key(self,sort,gameid):
+        f = self.games.field
+        seconds = self.games.seconds
+        if sort=="priority":
+            finished = f(gameid,"finished",0)
+            if finished:
+                return (finished,0,-seconds(gameid,"lastplayed"),f(gameid,"name"))
+            #return (finished,f(gameid,"priority",0),-seconds(gameid,"lastplayed"),f(gameid,"name"))
+            return (finished,1,-seconds(gameid,"lastplayed"),f(gameid,"name"))
+        elif sort=="added":
+            if f(gameid,"import_date"):
+                return -seconds(gameid,"import_date")
+            return -UNKNOWN_ADDED
+        elif sort=="changed":
+            if f(gameid,"data_changed_date"):
+                return -seconds(gameid,"data_changed_date")
+            return -UNKNOWN_CHANGED
+    def reorder(self,gameid):
+        """Move gameid to its current place in each ordering that has been built"""
+        if gameid == BAD_GAMEID:
+            return
+        for sort in self.orderings:
+            ordering = self.orderings[sort]
+            keys = self.order_keys[sort]
+            if gameid in keys:
+                del ordering[bisect.bisect_left(ordering,(keys[gameid],gameid))]
+                del keys[gameid]
+            if gameid in self.games:
+                keys[gameid] = self.sort_key(sort,gameid)
+                bisect.insort(ordering,(keys[gameid],gameid))
     def find(self,search):
         if search in self.games:
             return self.games[search]
-        def match(search,game):
-            if search.lower().strip()==game.name.lower().strip():
-                return True
-        possible = [g for g in self.games.values() if match(search,g)]
+        possible = [self.games[gameid] for gameid in self.name_map.get(search.lower().strip(),[])]
         print(possible)
         if possible:
             return possible[0]
@@ -476,9 +830,17 @@ class Games:
         d = f.read()
         f.close()
         self.translate_json(d)
+        if filename:
+            self.replay_journal(filename)
         sources.register_sources(self.source_definitions)
+    def hydrate(self,d):
+        """Build a Game attached to this database from a saved record"""
+        game = Game(**d)
+        game.games = self
+        game.inject_local_data(self.local.get("game_data",{}))
+        return game
     def translate_json(self,d):
-        self.games = {}
+        self.games = GameMap(self)
         #Attempt to read bjson
         try:
             load_data = ubjson.loadb(d)
@@ -486,10 +848,14 @@ class Games:
             import traceback
             traceback.print_exc()
             load_data = json.loads(d)
+        #Databases older than DB_VERSION are upgraded as they are read
+        self.version = load_data.get("version",8)
         for k in load_data["games"]:
-            self.games[k] = Game(**load_data["games"][k])
-            self.games[k].games = self
-            self.games[k].inject_local_data(self.local.get("game_data",{}))
+            if self.version<DB_VERSION:
+                upgrade_record(load_data["games"][k])
+            self.games[k] = load_data["games"][k]
+            if not self.lazy:
+                self.games[k]
         if not self.multipack:
             self.multipack = load_data.get("multipack",{})
         self.source_definitions.update(sources.default_definitions.copy())
@@ -500,6 +866,50 @@ class Games:
             self.source_definitions[source].update(loaded_defs[source])
         self.log.write("source definitions: ",self.source_definitions)
         self.revision = load_data.get("revision",self.revision)
+        self.generation = load_data.get("generation",0)
+        self.dirty = set()
+        self.deleted = set()
+        self.journal_meta = self.meta_data()
+        self.build_index()
+    def read_journal(self,game_db_file):
+        """Yield each batch of records appended to the journal, stops at a torn final write"""
+        path = journal_path(game_db_file)
+        if not os.path.exists(path):
+            return
+        with open(path,"rb") as f:
+            while 1:
+                head = f.read(4)
+                if len(head)<4:
+                    return
+                size = struct.unpack(">I",head)[0]
+                data = f.read(size)
+                if len(data)<size:
+                    print("Warning, incomplete journal record ignored:",path)
+                    return
+                yield ubjson.loadb(data)
+    def replay_journal(self,game_db_file):
+        """Apply journaled changes on top of the snapshot that was just loaded"""
+        self.journal_records = 0
+        for batch in self.read_journal(game_db_file):
+            if batch.get("generation",self.generation) != self.generation:
+                #Left by a crash between writing a snapshot and removing the journal it replaced
+                continue
+            self.journal_records += 1
+            for gameid in batch.get("deleted",[]):
+                if gameid in self.games:
+                    del self.games[gameid]
+            for d in batch.get("games",[]):
+                self.games[d["gameid"]] = upgrade_record(d)
+                if not self.lazy:
+                    self.games[d["gameid"]]
+            if "multipack" in batch:
+                self.multipack = batch["multipack"]
+            if "source_definitions" in batch:
+                self.source_definitions = batch["source_definitions"]
+            self.revision = batch.get("revision",self.revision)
+        self.journal_meta = self.meta_data()
+        if self.journal_records:
+            self.build_index()
     def load_local(self,file):
         if not os.path.exists(file):
             print("Warning, no local save file to load:",file)
@@ -512,41 +922,119 @@ class Games:
         self.local = {"game_data":{},"emulators":{}}
         load_data = json.loads(d)
         self.local.update(load_data)
-    def save_games_data(self):
+    def meta_data(self):
+        return copy.deepcopy({"multipack":self.multipack,"source_definitions":self.source_definitions})
+    def save_games_data(self,generation=None):
         save_data = {"games":{}}
-        for k in self.games:
-            if k == BAD_GAMEID:
+        #Listed first, games can change on another thread while a save runs
+        for k in list(self.games.keys()):
+            if k == BAD_GAMEID or k not in self.games:
+                continue
+            if not self.games.is_loaded(k):
+                save_data["games"][k] = self.games.raw(k)
                 continue
             save_data["games"][k] = self.games[k].dict()
             self.games[k].update_local_data(self.local.get("game_data",{}))
         save_data["multipack"] = self.multipack
         save_data["source_definitions"] = self.source_definitions
         save_data["revision"] = self.revision
+        save_data["version"] = DB_VERSION
+        save_data["generation"] = self.generation if generation is None else generation
         #return json.dumps(save_data)
         return ubjson.dumpb(save_data)
+    def journal_data(self,dirty,deleted):
+        """One journal record holding only what changed since the last save"""
+        batch = {"revision":self.revision,"generation":self.generation}
+        if deleted:
+            batch["deleted"] = sorted(deleted)
+        changed_games = []
+        for gameid in sorted(dirty):
+            if gameid == BAD_GAMEID or gameid not in self.games:
+                continue
+            changed_games.append(self.games[gameid].dict())
+            self.games[gameid].update_local_data(self.local.get("game_data",{}))
+        if changed_games:
+            batch["games"] = changed_games
+        meta = self.meta_data()
+        if meta != self.journal_meta:
+            batch.update(meta)
+            self.journal_meta = meta
+        return ubjson.dumpb(batch)
+    def write_journal(self,game_db_file,dirty,deleted):
+        append_journal(game_db_file,self.journal_data(dirty,deleted))
+        self.journal_records += 1
+    def take_unsynced(self):
+        """(changed gameids,deleted gameids) since the last call, for the sync server"""
+        changed,deleted = self.unsynced,self.unsynced_deleted
+        self.unsynced,self.unsynced_deleted = set(),set()
+        return changed,deleted
+    def change_record(self,gameids,deleted):
+        """A change record for the sync server, in the format of a journal record"""
+        batch = {"revision":self.revision,"deleted":sorted(deleted),"games":[]}
+        for gameid in sorted(gameids):
+            if gameid == BAD_GAMEID or gameid not in self.games:
+                continue
+            batch["games"].append(self.games[gameid].dict())
+        return batch
+    def apply_changes(self,batch):
+        """Apply a change record from the sync server. The changes aren't uploaded back"""
+        for gameid in batch.get("deleted",[]):
+            if gameid in self.games:
+                del self.games[gameid]
+                self.forget(gameid)
+            self.unsynced_deleted.discard(gameid)
+        for d in batch.get("games",[]):
+            self.games[d["gameid"]] = upgrade_record(d)
+            self.touch(self.games[d["gameid"]])
+            self.unsynced.discard(d["gameid"])
+        if "multipack" in batch:
+            self.multipack = batch["multipack"]
+        if "source_definitions" in batch:
+            self.source_definitions = batch["source_definitions"]
+        self.revision = max(self.revision,batch.get("revision",self.revision))
+    def write_snapshot(self,game_db_file):
+        sd = self.save_games_data(self.generation+1)
+        write_atomic(game_db_file,sd,compress=True)
+        self.generation += 1
+        if os.path.exists(journal_path(game_db_file)):
+            os.remove(journal_path(game_db_file))
+        self.journal_records = 0
+        self.journal_meta = self.meta_data()
+        self.version = DB_VERSION
+    def take_dirty(self):
+        """(changed gameids,deleted gameids) since the last save. Changes made while the save is
+        written go into the next one"""
+        dirty,deleted = self.dirty,self.deleted
+        self.dirty,self.deleted = set(),set()
+        return dirty,deleted
+    def keep_dirty(self,dirty,deleted):
+        """Put back what a failed save took"""
+        self.dirty |= dirty-self.deleted
+        self.deleted |= deleted-self.dirty
+    def compact(self,game_db_file):
+        """Fold any journaled changes into a full snapshot of the database"""
+        with self.save_lock:
+            dirty,deleted = self.take_dirty()
+            try:
+                self.write_snapshot(game_db_file)
+            except:
+                self.keep_dirty(dirty,deleted)
+                raise
     def save(self,game_db_file,local_db_file=None):
-        sd = self.save_games_data()
-        with gzip.open(game_db_file,"wb") as f:
-            f.write(sd)
-        if local_db_file:
-            sl = json.dumps(self.local)
-            with open(local_db_file,"w") as f:
-                f.write(sl)
-    def build_source_map(self):
-        """Builds a dictionary map of source_id:game to make it easier to search for a game from
-        a given source"""
-        self.source_map = {}
-        for gameid in self.games:
-            game = self.games[gameid]
-            keys = []
-            for s in game.sources:
-                keys.append(source_id(s))
-            for key in keys:
-                if key not in self.source_map:
-                    self.source_map[key] = []
-                self.source_map[key].append(game)
+        with self.save_lock:
+            dirty,deleted = self.take_dirty()
+            try:
+                #An upgraded database is written out in full once so the old format isn't journaled onto
+                if self.journal and self.version==DB_VERSION and os.path.exists(game_db_file) and self.journal_records<JOURNAL_COMPACT_RECORDS:
+                    self.write_journal(game_db_file,dirty,deleted)
+                else:
+                    self.write_snapshot(game_db_file)
+            except:
+                self.keep_dirty(dirty,deleted)
+                raise
+            if local_db_file:
+                write_atomic(local_db_file,json.dumps(self.local).encode("utf8"))
     def add_games(self,game_list):
-        self.build_source_map()
         for g in game_list:
             self.update_game(g.gameid,g)
     def get_similar_games(self,game):
@@ -554,8 +1042,8 @@ class Games:
 
         ids = []
         for s in game.sources:
-            for g in self.source_map.get(source_id(s),[]):
-                ids.append(g.gameid)
+            for gameid in self.source_map.get(source_id(s),[]):
+                ids.append(gameid)
 
         print(game.gameid,"should be in self.games")
         if game.gameid in self.games:
@@ -574,22 +1062,28 @@ class Games:
         newid = gameid
         next=0
         while newid in self.games:
-            collision = hmac.new(bytes("","utf8"))
+            collision = hmac.new(bytes("","utf8"),digestmod="md5")
             collision.update(bytes(str(oldid)+str(next),"utf8"))
             next+=1
             newid = collision.hexdigest()
         if newid!=oldid:
-            #TODO: kind of bad, Force all references to update their key
-            for chk_game in self.games.values():
-                for child in chk_game.package_data.get("contents",[]):
+            #Only games filed as referencing oldid need their package_data rewritten
+            for chk_gameid in list(self.package_map.get(oldid,[])):
+                package_data = self.games.field(chk_gameid,"package_data",{})
+                changed_refs = False
+                for child in package_data.get("contents",[]):
                     if child["gameid"] == oldid:
-                        print("changed child id",child["gameid"],"to",newid,"on",chk_game.gameid)
+                        print("changed child id",child["gameid"],"to",newid,"on",chk_gameid)
                         child["gameid"] = newid
-                parent = chk_game.package_data.get("parent",{})
+                        changed_refs = True
+                parent = package_data.get("parent",{})
                 if parent:
                     if parent.get("gameid",{}) == oldid:
-                        print("changed parent id",parent["gameid"],"to",newid,"on",chk_game.gameid)
+                        print("changed parent id",parent["gameid"],"to",newid,"on",chk_gameid)
                         parent["gameid"] = newid
+                        changed_refs = True
+                if changed_refs:
+                    self.touch(self.games[chk_gameid])
             if oldid in self.local["game_data"]:
                 self.local["game_data"][newid] = self.local["game_data"][oldid]
                 del self.local["game_data"][oldid]
@@ -621,7 +1115,9 @@ class Games:
                 print("UPDATE CHANGED GAME")
                 if oldid in self.games:
                     del self.games[oldid]
+                    self.forget(oldid)
                 self.games[game.gameid] = game
+                self.touch(game)
                 self.log.write("GAMEDB: Update ",cur_game.gameid," ",nicediff(diff))
             else:
                 print("UPDATE... did not change game")
@@ -630,44 +1126,46 @@ class Games:
             print("adding",game.gameid,game.source_match)
             game.data_changed_date = now()
             self.games[game.gameid] = game
+            self.touch(game)
             self.log.write("GAMEDB: Add (",game.gameid,",",game.name,")")
         return game
-    def update_game(self,gameid,game):
-        assert(isinstance(game,Game))
-        game.games = self
-
-        cur_game = self.find_matching_game(game)
-        assert game is not cur_game
-
-        if not cur_game:
-            game.gameid = self.correct_gameid(gameid,gameid)
-            print("ADD GAME ACTION")
-            print("adding",game.gameid,game.source_match)
-            game.data_changed_date = now()
-            self.games[game.gameid] = game
-            self.log.write("GAMEDB: Add (",game.gameid,",",game.name,")")
-            return game
-        previous_data = cur_game.dict()
-        gameid = self.update_id(cur_game.gameid,gameid)
-        if gameid!=cur_game.gameid:
-            del self.games[cur_game.gameid]
+    def add_game(self,game,gameid):
+        """Store a game that did not match anything in the database"""
+        game.gameid = self.correct_gameid(gameid,gameid)
+        game.data_changed_date = now()
+        self.games[game.gameid] = game
+        self.touch(game)
+        self.log.write("GAMEDB: Add (",game.gameid,",",game.name,")")
+        return game
+    def merge_game(self,cur_game,game,gameid):
+        """Fold game into cur_game, the stored game it matched, moving cur_game to gameid.
+        Returns the names of the fields that changed"""
+        changes = []
+        def update(key,value):
+            if getattr(cur_game,key) != value:
+                setattr(cur_game,key,value)
+                changes.append(key)
+        oldid = cur_game.gameid
+        if gameid!=oldid:
+            gameid = self.correct_gameid(oldid,gameid)
+        if gameid!=oldid:
+            del self.games[oldid]
+            self.forget(oldid)
             cur_game.gameid = gameid
             self.games[gameid] = cur_game
-        if game.name != cur_game.name:
-            cur_game.name = game.name
+            changes.append("gameid")
+        update("name",game.name)
         if game.images:
-            cur_game.images = game.images[:]
+            update("images",game.images[:])
         if "desteam" not in game.notes and game.playtime > cur_game.playtime:
-            cur_game.playtime = game.playtime
+            update("playtime",game.playtime)
         if game.finished:
-            cur_game.finished = 1
-        if game.lastplayed and (not cur_game.lastplayed or stot(game.lastplayed)>stot(cur_game.lastplayed)):
-            cur_game.lastplayed = game.lastplayed
-        if game.sources != cur_game.sources:
-            cur_game.sources = game.sources
-        if cur_game.priority_date and stot(game.lastplayed) > stot(game.priority_date):
-            cur_game.priority = -1
-            print("Set Game Priority")
+            update("finished",1)
+        if game.lastplayed and (not cur_game.lastplayed or game.seconds("lastplayed")>cur_game.seconds("lastplayed")):
+            update("lastplayed",game.lastplayed)
+        update("sources",game.sources)
+        if cur_game.priority_date and game.seconds("lastplayed") > game.seconds("priority_date"):
+            update("priority",-1)
         genres = []
         for g in [game,cur_game]:
             for x in g.genre.split(";"):
@@ -676,40 +1174,79 @@ class Games:
                     continue
                 if x not in genres:
                     genres.append(x)
-        cur_game.genre = "; ".join(genres)
-        cur_game.package_data = game.package_data.copy()
-        diff = changed(previous_data,cur_game.dict())
-        if diff:
+        update("genre","; ".join(genres))
+        update("package_data",game.package_data.copy())
+        if changes:
             cur_game.data_changed_date = now()
+            self.touch(cur_game)
+            self.log.write("GAMEDB: Update ",oldid," ",nicediff({"_set_":[{"k":k,"v":getattr(cur_game,k)} for k in changes]}))
+        return changes
+    def update_game(self,gameid,game):
+        assert(isinstance(game,Game))
+        game.games = self
+
+        cur_game = self.find_matching_game(game)
+        assert game is not cur_game
+
+        if not cur_game:
+            print("ADD GAME ACTION")
+            game = self.add_game(game,gameid)
+            print("adding",game.gameid,game.source_match)
+            return game
+        if self.merge_game(cur_game,game,gameid):
             print("update 2",cur_game.gameid,cur_game.source_match,">",game.name.encode("utf8"),game.source_match)
-            self.log.write("GAMEDB: Update ",previous_data["gameid"]," ",nicediff(diff))
         else:
             print("no updates to",cur_game.gameid,cur_game.source_match)
         return cur_game
+    def match_game(self,game):
+        """Stored game that game is logically the same as, looked up through source_map"""
+        ids = []
+        for s in game.sources:
+            ids.extend(self.source_map.get(source_id(s),[]))
+        if game.gameid in self.games:
+            ids.append(game.gameid)
+        for oid in ids:
+            if self.games[oid].same_game(game):
+                return self.games[oid]
+    def merge_games(self,game_list):
+        """Merge a whole importer result in one pass, without the per game diffs and printing
+        of update_game. Returns {"added":[gameid],"updated":{gameid:[field]},"unchanged":count}"""
+        report = {"added":[],"updated":{},"unchanged":0}
+        for game in game_list:
+            assert(isinstance(game,Game))
+            game.games = self
+            cur_game = self.match_game(game)
+            if not cur_game:
+                report["added"].append(self.add_game(game,game.gameid).gameid)
+                continue
+            changes = self.merge_game(cur_game,game,game.gameid)
+            if changes:
+                report["updated"][cur_game.gameid] = changes
+            else:
+                report["unchanged"] += 1
+        self.log.write("GAMEDB: Merged %s games, %s added, %s updated, %s unchanged"%(
+            len(game_list),len(report["added"]),len(report["updated"]),report["unchanged"]))
+        return report
     def list(self,sort="priority"):
-        v = self.games.values()
+        """Games in sort order. The ordering is kept up to date as games change, and only
+        games that are actually looked at in the returned list get built"""
         if not sort:
-            return v
-        elif sort=="priority":
-            def k(g):
-                if g.finished:
-                    return (g.finished,0,-time.mktime(stot(g.lastplayed)),g.name)
-                #return (g.finished,g.priority,-time.mktime(stot(g.lastplayed)),g.name)
-                return (g.finished,1,-time.mktime(stot(g.lastplayed)),g.name)
-            return sorted(v,key=k)
-        elif sort=="added":
-            def key(game):
-                if game.import_date:
-                    return -time.mktime(stot(game.import_date))
-                return -time.mktime(stot("23:39:03 1970-07-16"))
-            return sorted(v,key=key)            
-        elif sort=="changed":
-            #crash
-            def key(game):
-                if game.data_changed_date:
-                    return -time.mktime(stot(game.data_changed_date))
-                return -time.mktime(stot("23:39:03 1980-07-16"))
-            return sorted(v,key=key)
+            return self.games.values()
+        if sort not in ["priority","added","changed"]:
+            return None
+        if sort not in self.orderings:
+            keys = {}
+            for gameid in self.games:
+                if gameid != BAD_GAMEID:
+                    keys[gameid] = self.sort_key(sort,gameid)
+            self.order_keys[sort] = keys
+            self.orderings[sort] = sorted((keys[gameid],gameid) for gameid in keys)
+        return GameList(self.games,[gameid for key,gameid in self.orderings[sort]])
+    def position(self,sort,gameid):
+        """Row of gameid in list(sort), or None if it isn't in that ordering"""
+        keys = self.order_keys.get(sort,{})
+        if gameid in keys:
+            return bisect.bisect_left(self.orderings[sort],(keys[gameid],gameid))
     def get_package_for_game_converter(self,game):
         #TODO: Only implemented here for conversion from old data, once migrated can remove
         for p in self.games.values():
@@ -737,3 +1274,4 @@ class Games:
     def delete(self, game):
         if game.gameid in self.games:
             del self.games[game.gameid]
+            self.forget(game.gameid)
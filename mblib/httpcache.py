@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import requests
+
+DAY = 24*60*60
+
+def conditional_get(url,entry=None,session=None,**kwargs):
+    """GET url, asking the server only for changes since entry, a dict with the "etag" and
+    "last_modified" of the copy already held. A 304 answer means that copy is still good"""
+    headers = dict(kwargs.pop("headers",None) or {})
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return (session or requests).get(url,headers=headers,**kwargs)
+
+def validators(response):
+    """What to send back to revalidate the copy of response, and when it was checked"""
+    return {"etag":response.headers.get("ETag",None),
+            "last_modified":response.headers.get("Last-Modified",None),
+            "checked":int(time.time())}
+
+def is_stale(entry,ttl):
+    return time.time()-entry.get("checked",0)>=ttl
+
+def cache_key(url,params=None):
+    """url with params added the way requests sends them"""
+    if params:
+        return requests.Request("GET",url,params=params).prepare().url
+    return url
+
+class HttpCache:
+    """Values made from GET responses, kept with the ETag/Last-Modified of the response in the sqlite
+    database at path, under a namespace per api. A value is used without asking the server until it
+    is ttl seconds old. After that the server is asked with a conditional GET: a 304 just restarts
+    the ttl, a new response replaces the value. If the server can't be reached the old value is used.
+    Values are stored as json, so reading one never runs anything"""
+    def __init__(self,path,namespace,ttl=7*DAY,legacy_dir=None):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = threading.local()  #a connection per thread, sqlite locks the file between them
+        self.lock = threading.Lock()
+        self.preloaded = None           #url:entry of the whole namespace once preload() has run
+        self.legacy_dir = legacy_dir
+        self.legacy = set()             #files an older version cached in legacy_dir, see adopt_legacy()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        db = self.db()
+        db.execute("CREATE TABLE IF NOT EXISTS responses (namespace TEXT, url TEXT, value TEXT, etag TEXT, last_modified TEXT, checked INTEGER, PRIMARY KEY (namespace,url))")
+        db.commit()
+        if legacy_dir and os.path.isdir(legacy_dir):
+            self.legacy = set(os.listdir(legacy_dir))
+    def db(self):
+        if not hasattr(self.local,"db"):
+            db = sqlite3.connect(self.path,timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return self.local.db
+    def preload(self):
+        """Read the whole namespace in one query, so the gets of an import don't each go to the database"""
+        rows = self.db().execute("SELECT url,value,etag,last_modified,checked FROM responses WHERE namespace=?",(self.namespace,)).fetchall()
+        with self.lock:
+            self.preloaded = dict((row[0],make_entry(row[1:])) for row in rows)
+    def entry(self,url):
+        with self.lock:
+            if self.preloaded is not None:
+                return self.preloaded.get(url,None)
+        row = self.db().execute("SELECT value,etag,last_modified,checked FROM responses WHERE namespace=? AND url=?",(self.namespace,url)).fetchone()
+        if row:
+            return make_entry(row)
+    def store(self,url,entry):
+        with self.lock:
+            if self.preloaded is not None:
+                self.preloaded[url] = entry
+        db = self.db()
+        db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?)",
+            (self.namespace,url,json.dumps(entry["value"]),entry.get("etag",None),entry.get("last_modified",None),entry.get("checked",0)))
+        db.commit()
+    def adopt(self,url,value,checked):
+        """Take value for url from a cache kept before this one, treated as checked at checked"""
+        if not self.entry(url):
+            self.store(url,{"value":value,"etag":None,"last_modified":None,"checked":int(checked)})
+    def adopt_legacy(self,url,name,load):
+        """If an older version cached url in the file name in legacy_dir, move load(text of the file) into the database"""
+        if name not in self.legacy:
+            return
+        path = self.legacy_dir+"/"+name
+        try:
+            with open(path) as f:
+                self.adopt(url,load(f.read()),os.path.getmtime(path))
+        except (OSError,ValueError,SyntaxError):
+            pass
+        with self.lock:
+            self.legacy.discard(name)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    def get(self,url,parse,ttl=None,session=None,**kwargs):
+        """parse(response) of url, a json-able value. kwargs go to requests.get"""
+        ttl = self.ttl if ttl is None else ttl
+        key = cache_key(url,kwargs.get("params",None))
+        entry = self.entry(key)
+        if entry and not is_stale(entry,ttl):
+            return entry["value"]
+        try:
+            r = conditional_get(url,entry,session,**kwargs)
+        except requests.RequestException:
+            if entry:
+                return entry["value"]
+            raise
+        if entry and r.status_code == 304:
+            entry["checked"] = int(time.time())
+            self.store(key,entry)
+            return entry["value"]
+        if entry and r.status_code != 200:
+            #Keep what we had rather than an error page
+            return entry["value"]
+        value = parse(r)
+        if r.status_code == 200:
+            entry = validators(r)
+            entry["value"] = value
+            self.store(key,entry)
+        return value
+
+def make_entry(row):
+    return {"value":json.loads(row[0]),"etag":row[1],"last_modified":row[2],"checked":row[3]}
+
+caches = {}
+caches_lock = threading.Lock()
+def open_cache(cache_root,namespace,ttl=7*DAY):
+    """The HttpCache for namespace in cache_root/cache/http.sqlite, shared by every caller. Files
+    an older version cached in cache_root/cache/namespace can be moved into it with adopt_legacy()"""
+    with caches_lock:
+        if (cache_root,namespace) not in caches:
+            caches[(cache_root,namespace)] = HttpCache(cache_root+"/cache/http.sqlite",namespace,ttl,cache_root+"/cache/"+namespace)
+        return caches[(cache_root,namespace)]
@@ -11,14 +11,13 @@ def make_callback(f, *args):
     return lambda: f(*args)
     
 def ts_to_qtdt(s):
-    s = time.mktime(games.stot(s))
+    s = int(games.to_seconds(s))
     qtdt = QDateTime()
     qtdt.setTime_t(s)
     return qtdt
     
 def qtdt_to_ts(qtdt):
-    s = qtdt.toTime_t()
-    return games.ttos(time.localtime(s))
+    return qtdt.toTime_t()
 
 class ListGamesForPack(QWidget):
     def __init__(self, game, app, edit_widget):
@@ -298,8 +297,9 @@ class EditGame(QWidget):
             value = float(w.text())
         elif t == "d":
             value = qtdt_to_ts(w.dateTime())
-            if "1969" in value:
-                value = ""
+            #The unset date, or toTime_t() of one it can't give, which is uint(-1)
+            if value<=0 or value==0xffffffff:
+                value = 0
         elif t == "p":
             priorities = games.PRIORITIES
             pkeys = sorted(priorities.keys())
@@ -315,9 +315,7 @@ class EditGame(QWidget):
             setattr(self.game,field,value)
     def delete(self):
         self.games.delete(self.game)
-        row = self.app.get_row_for_game(self.game)
-        if row:
-            self.app.games_list_widget.removeRow(row)
+        self.app.games_model.game_changed(self.game.gameid)
         self.app.dosearch()
         self.app.save()
 
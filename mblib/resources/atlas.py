@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import threading
+import collections
+
+from PIL import Image
+
+try:
+    from PyQt5.QtGui import QImage
+except:
+    pass
+
+try:
+    import pygame
+except:
+    pass
+
+#Largest side of a sheet, small enough for any video card to take as one texture
+SHEET_SIZE = 1024
+
+class IconAtlas:
+    """Icons of one category and size packed side by side into a few sheet images, with an index
+    of where each one sits. A list loads a sheet per screenful of icons instead of a file per icon,
+    and the pygame frontend blits every icon out of the same surface. Sheets are loaded the first
+    time one of their icons is asked for, and only the max_sheets last used are kept"""
+    def __init__(self,root,size,category="icon",imode="qt",max_sheets=4):
+        self.root = root
+        self.size = size
+        self.category = category
+        self.imode = imode
+        self.max_sheets = max_sheets
+        self.cells = {}     #source:[sheet,x,y,w,h]
+        self.sheets = []    #sheet file names
+        self.loaded = collections.OrderedDict()     #sheet:QImage or pygame Surface, least recently used first
+        self.lock = threading.Lock()
+        self.sheet_loads = 0
+        try:
+            with open(self.index_path()) as f:
+                d = json.loads(f.read())
+            if d["size"] == size:
+                self.cells = d["cells"]
+                self.sheets = d["sheets"]
+        except (OSError,ValueError,KeyError):
+            pass
+    def name(self):
+        return atlas_name(self.size,self.category)
+    def index_path(self):
+        return "%s/%s.json"%(self.root,self.name())
+    def __contains__(self,source):
+        return source in self.cells
+    def __len__(self):
+        return len(self.cells)
+    def sheet(self,n):
+        with self.lock:
+            if n in self.loaded:
+                self.loaded.move_to_end(n)
+                return self.loaded[n]
+        path = (self.root+"/"+self.sheets[n]).replace("/",os.path.sep)
+        if self.imode == "qt":
+            image = QImage(path)
+            if image.isNull():
+                #A newer atlas replaced this one
+                return None
+        else:
+            try:
+                image = pygame.image.load(path)
+                if pygame.display.get_surface():
+                    #Blitting from a sheet in the screen's pixel format is many times faster
+                    if image.get_flags()&pygame.SRCALPHA:
+                        image = image.convert_alpha()
+                    else:
+                        image = image.convert()
+            except pygame.error:
+                return None
+        with self.lock:
+            self.loaded[n] = image
+            self.sheet_loads += 1
+            while len(self.loaded)>self.max_sheets:
+                self.loaded.popitem(last=False)
+        return image
+    def area(self,source):
+        """(sheet,(x,y,w,h)) to draw source from, None if it isn't in the atlas"""
+        cell = self.cells.get(source,None)
+        if not cell:
+            return None
+        sheet = self.sheet(cell[0])
+        if sheet is None:
+            return None
+        return sheet,tuple(cell[1:])
+    def image(self,source):
+        """QImage of source cut out of its sheet"""
+        found = self.area(source)
+        if found:
+            sheet,(x,y,w,h) = found
+            return sheet.copy(x,y,w,h)
+
+def atlas_name(size,category="icon"):
+    return "%s%d"%(category,size)
+
+def build_atlas(store,root,size,sources,category="icon"):
+    """Pack the icons for sources from the IconStore store at size into sheets under root. They are
+    packed in the order given, so a list shown in that order finds its first screen on the first
+    sheet. Atlases of other sizes are deleted, only the size in use is worth keeping.
+    Returns the number of icons packed"""
+    paths = []
+    seen = set()
+    for source in sources:
+        if source in seen:
+            continue
+        seen.add(source)
+        found = store.thumbnail(source,size,category)
+        if found:
+            paths.append((source,found[0],found[1]))
+    if not os.path.exists(root):
+        os.makedirs(root)
+    name = atlas_name(size,category)
+    #New sheets get new names so an IconAtlas still reading the old ones never gets the wrong icon
+    stamp = "%x"%int(time.time()*1000)
+    per_row = max(1,SHEET_SIZE//size)
+    per_sheet = per_row*per_row
+    cells = {}
+    sheets = []
+    for first in range(0,len(paths),per_sheet):
+        chunk = paths[first:first+per_sheet]
+        columns = min(per_row,len(chunk))
+        rows = (len(chunk)+per_row-1)//per_row
+        #Icons are stretched to fill their square, only logos leave space that needs to be transparent
+        pixels = "RGBA" if category == "logo" else "RGB"
+        sheet = Image.new(pixels,(columns*size,rows*size))
+        for i,(source,path,exact) in enumerate(chunk):
+            try:
+                pil_image = Image.open(path).convert(pixels)
+            except OSError:
+                continue
+            if not exact:
+                if category == "logo":
+                    pil_image.thumbnail((size,size),Image.LANCZOS)
+                else:
+                    pil_image = pil_image.resize((size,size),Image.LANCZOS)
+            x,y = (i%per_row)*size,(i//per_row)*size
+            sheet.paste(pil_image,(x,y))
+            cells[source] = [len(sheets),x,y,pil_image.width,pil_image.height]
+        sheet_name = "%s_%s_%d.png"%(name,stamp,len(sheets))
+        sheet.save(root+"/"+sheet_name,compress_level=1)
+        sheets.append(sheet_name)
+    with open(root+"/"+name+".json.tmp","w") as f:
+        f.write(json.dumps({"version":1,"size":size,"category":category,"sheets":sheets,"cells":cells}))
+    os.replace(root+"/"+name+".json.tmp",root+"/"+name+".json")
+    for fname in os.listdir(root):
+        if fname.startswith(category) and fname not in sheets and fname != name+".json":
+            try:
+                os.remove(root+"/"+fname)
+            except OSError:
+                pass
+    return len(cells)
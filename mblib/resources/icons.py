@@ -1,13 +1,20 @@
 import os
 import requests
 import textwrap
+import threading
+import collections
+import hashlib
+import json
+import time
+import email.utils
+from urllib.parse import urlparse
 
 from PIL import Image, ImageFont, ImageDraw
 from io import BytesIO
 
 try:
     from PyQt5.QtCore import Qt
-    from PyQt5.QtGui import QIcon,QPixmap,QImageReader
+    from PyQt5.QtGui import QIcon,QPixmap,QImageReader,QImage
 except:
     pass
     
@@ -17,12 +24,16 @@ except:
     pass
 
 from mblib.resources import extract_icons
+from mblib import httpcache
 
 headers = {
     'User-Agent': 'MyBacklog Game tracker and launcher v1.0',
     'From': 'saluk64007@gmail.com'
 }
 
+#Downloaded icons are checked for changes after this many seconds
+ICON_TTL = 30*httpcache.DAY
+
 def generate_icon(fpath,game,filecache_root):
     im = Image.new('RGB',[460,265])
     draw = ImageDraw.Draw(im)
@@ -57,26 +68,127 @@ def path_to_icon(game,filecache_root,category="icon"):
         name = "custom_"+str(game.gameid)+"_icon.png"
         return filecache_root+"/cache/icons/"+name,"generate",name
 
+def image_bytes(image):
+    """Memory held by a QPixmap, QImage or pygame Surface"""
+    if hasattr(image,"get_bytesize"):
+        return image.get_width()*image.get_height()*image.get_bytesize()
+    if hasattr(image,"depth"):
+        return image.width()*image.height()*max(image.depth(),8)//8
+    return 0
+
+def scale_down(image,size,category="icon"):
+    if hasattr(image,"get_bytesize"):
+        try:
+            return pygame.transform.smoothscale(image,[size,size])
+        except ValueError:
+            return pygame.transform.scale(image,[size,size])
+    if category == "logo": mode = Qt.KeepAspectRatio
+    else: mode = Qt.IgnoreAspectRatio
+    return image.scaled(size,size,mode,Qt.SmoothTransformation)
+
+class IconCache:
+    """(fpath,size):image cache which keeps the images it holds under max_bytes by dropping the
+    least recently used. An icon asked for at a size that isn't cached is made by scaling down
+    the next larger cached size of the same file, so zooming out doesn't go back to the disk"""
+    def __init__(self,max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()  #(fpath,size):image, least recently used first
+        self.sizes = {}                          #fpath:set(size) cached for it
+        self.bytes = 0
+        self.hits = 0
+        self.scaled = 0         #hits made by scaling down a larger size
+        self.misses = 0
+        self.evictions = 0
+    def __contains__(self,key):
+        return key in self.images
+    def __len__(self):
+        return len(self.images)
+    def __getitem__(self,key):
+        image = self.images[key]
+        self.images.move_to_end(key)
+        return image
+    def __setitem__(self,key,image):
+        if key in self.images:
+            self.discard(key)
+        self.images[key] = image
+        self.bytes += image_bytes(image)
+        if key[0] not in self.sizes:
+            self.sizes[key[0]] = set()
+        self.sizes[key[0]].add(key[1])
+        while self.bytes>self.max_bytes and len(self.images)>1:
+            self.discard(next(iter(self.images)))
+            self.evictions += 1
+    def discard(self,key):
+        image = self.images.pop(key)
+        self.bytes -= image_bytes(image)
+        self.sizes[key[0]].discard(key[1])
+        if not self.sizes[key[0]]:
+            del self.sizes[key[0]]
+    def lookup(self,fpath,size,category="icon"):
+        """Image for fpath at size, or None if neither it nor a larger size is cached"""
+        if (fpath,size) in self.images:
+            self.hits += 1
+            return self[(fpath,size)]
+        larger = [s for s in self.sizes.get(fpath,()) if s>size]
+        if larger:
+            image = scale_down(self[(fpath,min(larger))],size,category)
+            self[(fpath,size)] = image
+            self.hits += 1
+            self.scaled += 1
+            return image
+        self.misses += 1
+        return None
+    def stats(self):
+        return {"hits":self.hits,"scaled":self.scaled,"misses":self.misses,"evictions":self.evictions,
+                "images":len(self.images),"bytes":self.bytes,"max_bytes":self.max_bytes}
+
 def icon_in_cache(game,size,cache,filecache_root,category="icon",imode="qt"):
     fpath,mode,url = path_to_icon(game,filecache_root,category)
-    if (fpath,size) in cache:
+    if isinstance(cache,IconCache):
+        image = cache.lookup(fpath,size,category)
+    else:
+        image = cache.get((fpath,size),None)
+    if image is not None:
         if imode=="qt":
-            return QIcon(cache[(fpath,size)])
-        return cache[(fpath,size)]
+            return QIcon(image)
+        return image
     return None
 
-def icon_for_game(game,size,icon_cache,filecache_root,category="icon",imode="qt"):
-    cur = icon_in_cache(game,size,icon_cache,filecache_root,category,imode)
-    if cur:
-        return cur
-        
+def download_icon(url,session=None):
+    """Bytes of the image at url, session is a requests.Session to reuse a connection"""
+    print("Download icon:",url)
+    r = (session or requests).get(url,headers=headers)
+    return r.content
+
+def store_icon(fpath,p,url):
+    """Decode p (image bytes or a local file path that Image can .open()) and save it to fpath as .png"""
+    try:
+        pil_image = Image.open(p)
+    except OSError:
+        print("None image provided, no icon loaded:",url)
+    else:
+        pil_image.save(fpath)
+
+def revalidate_icon(fpath,url,session=None):
+    """Download url to fpath again if it changed since fpath was written, checking at most once per ICON_TTL"""
+    mtime = os.path.getmtime(fpath)
+    if time.time()-mtime<ICON_TTL:
+        return
+    try:
+        r = httpcache.conditional_get(url,{"last_modified":email.utils.formatdate(mtime,usegmt=True)},session,headers=headers)
+    except requests.RequestException:
+        return
+    if r.status_code == 200:
+        store_icon(fpath,BytesIO(r.content),url)
+    os.utime(fpath)
+
+def fetch_icon(game,filecache_root,category="icon",session=None):
+    """Make sure the icon file for game is in the file cache, return its path"""
     fpath,mode,url = path_to_icon(game,filecache_root,category)
     if not os.path.exists(fpath):
         p = None #p == image bytes or a local file path that Image can .open()
         if mode == "download":
-            print("Download icon:",url)
-            r = requests.get(url,headers=headers)
-            p = BytesIO(r.content)
+            p = BytesIO(download_icon(url,session))
         elif mode == "extract":
             print("Extract icon:",url.encode("ascii","backslashreplace"))
             p = extract_icons.get_icon(url,filecache_root)
@@ -88,12 +200,27 @@ def icon_for_game(game,size,icon_cache,filecache_root,category="icon",imode="qt"
             generate_icon(fpath,game,filecache_root)
         #Save all images as .png
         if p:
-            try:
-                pil_image = Image.open(p)
-            except OSError:
-                print("None image provided, no icon loaded:",url)
-            else:
-                pil_image.save(fpath)
+            store_icon(fpath,p,url)
+    elif mode == "download":
+        revalidate_icon(fpath,url,session)
+    return fpath
+
+def scale_image(fpath,size,category="icon"):
+    """QImage of the icon file at fpath scaled to size. Unlike a QPixmap this can be made off the GUI thread"""
+    img = QImageReader(fpath.replace("/",os.path.sep)).read()
+    if img.isNull():
+        print("error loading",repr(fpath))
+        return img
+    if category == "icon": mode = Qt.IgnoreAspectRatio
+    if category == "logo": mode = Qt.KeepAspectRatio
+    return img.scaled(size,size,mode,Qt.SmoothTransformation)
+
+def icon_for_game(game,size,icon_cache,filecache_root,category="icon",imode="qt"):
+    cur = icon_in_cache(game,size,icon_cache,filecache_root,category,imode)
+    if cur:
+        return cur
+        
+    fpath = fetch_icon(game,filecache_root,category)
     if os.path.exists(fpath) and not (fpath,size) in icon_cache:
         if imode=="path":
             return fpath.replace("/",os.path.sep)
@@ -117,4 +244,337 @@ def icon_for_game(game,size,icon_cache,filecache_root,category="icon",imode="qt"
                 icon_cache[(fpath,size)] = pygame.transform.scale(pygame.image.load(fpath),[size,size])
             except:
                 pass
-    return icon_in_cache(game,size,icon_cache,filecache_root,category,imode)
+    if (fpath,size) in icon_cache:
+        if imode=="qt":
+            return QIcon(icon_cache[(fpath,size)])
+        return icon_cache[(fpath,size)]
+    return None
+
+#Thumbnail sizes the store keeps on disk: the default icon_size of 300 and every zoom step of 12
+THUMBNAIL_SIZES = set(range(12,601,12))
+
+class IconStore:
+    """Icon files on disk keyed by a hash of where they came from (url, exe path or generated name).
+    Each icon is kept as a .png plus thumbnails at the THUMBNAIL_SIZES it has been shown at, so
+    showing it only loads a file of the right size. index.json records what is stored, so nothing
+    needs an os.path.exists per game, and when the files pass max_bytes the least recently used
+    icons are deleted"""
+    def __init__(self,root,max_bytes=512*1024*1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.index = collections.OrderedDict()  #key:{"source","bytes","thumbnails":[[category,size]],"used"}, least recently used first
+        self.bytes = 0
+        self.dirty = False
+        self.saved = 0
+        self.evictions = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+        try:
+            with open(self.index_path()) as f:
+                icons = json.loads(f.read())["icons"]
+        except (OSError,ValueError,KeyError):
+            icons = {}
+        for key in sorted(icons,key=lambda key:icons[key]["used"]):
+            self.index[key] = icons[key]
+            icons[key].setdefault("checked",icons[key]["used"])
+        self.bytes = sum(entry["bytes"] for entry in self.index.values())
+    def index_path(self):
+        return self.root+"/index.json"
+    def key(self,source):
+        return hashlib.sha1(source.encode("utf8")).hexdigest()
+    def path(self,key,size=None,category="icon"):
+        if size:
+            key += "_%s%d"%({"icon":""}.get(category,category),size)
+        return "%s/%s/%s.png"%(self.root,key[:2],key)
+    def has(self,source):
+        return self.key(source) in self.index
+    def entry(self,source):
+        return self.index.get(self.key(source),None)
+    def checked(self,source):
+        """The server says the icon for source hasn't changed"""
+        with self.lock:
+            entry = self.entry(source)
+            if entry:
+                entry["checked"] = int(time.time())
+                self.dirty = True
+    def put(self,source,p,sizes=(),category="icon",validators=None):
+        """Decode p (image bytes or a local file path that Image can .open()) and store it as the icon
+        for source, along with thumbnails at sizes. validators are the etag/last_modified/checked of
+        the response p came from. Returns False if p isn't an image"""
+        key = self.key(source)
+        try:
+            pil_image = Image.open(p)
+            pil_image.load()
+        except OSError:
+            print("None image provided, no icon loaded:",source)
+            return False
+        fpath = self.path(key)
+        if not os.path.exists(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath),exist_ok=True)
+        pil_image.save(fpath)
+        with self.lock:
+            if key in self.index:
+                self.bytes -= self.index[key]["bytes"]
+            self.index[key] = {"source":source,"bytes":os.path.getsize(fpath),"thumbnails":[],"used":int(time.time()),
+                            "etag":None,"last_modified":None,"checked":int(time.time())}
+            self.index[key].update(validators or {})
+            self.index.move_to_end(key)
+            self.bytes += self.index[key]["bytes"]
+            self.dirty = True
+        for size in sizes:
+            self.thumbnail(source,size,category)
+        self.evict()
+        return True
+    def thumbnail(self,source,size,category="icon"):
+        """(path,exact) of the file to show source at size. exact is False when size isn't one of
+        THUMBNAIL_SIZES and the file still has to be scaled. None if source isn't stored"""
+        key = self.key(source)
+        with self.lock:
+            entry = self.index.get(key,None)
+            if not entry:
+                return None
+            entry["used"] = int(time.time())
+            self.index.move_to_end(key)
+            self.dirty = True
+            if size not in THUMBNAIL_SIZES:
+                return self.path(key),False
+            if [category,size] in entry["thumbnails"]:
+                return self.path(key,size,category),True
+        tpath = self.path(key,size,category)
+        try:
+            pil_image = Image.open(self.path(key))
+            if category == "logo":
+                pil_image.thumbnail((size,size),Image.LANCZOS)
+            else:
+                pil_image = pil_image.resize((size,size),Image.LANCZOS)
+            pil_image.save(tpath)
+        except OSError:
+            #The files were removed from under the index
+            self.remove(key)
+            return None
+        with self.lock:
+            if key in self.index and [category,size] not in entry["thumbnails"]:
+                entry["thumbnails"].append([category,size])
+                entry["bytes"] += os.path.getsize(tpath)
+                self.bytes += os.path.getsize(tpath)
+        return tpath,True
+    def remove(self,key):
+        with self.lock:
+            entry = self.index.pop(key,None)
+            if not entry:
+                return
+            self.bytes -= entry["bytes"]
+            self.dirty = True
+            paths = [self.path(key)]+[self.path(key,size,category) for category,size in entry["thumbnails"]]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    def evict(self):
+        """Once over max_bytes, delete the least recently used icons in one batch that brings the
+        store back under 90% of max_bytes, so it isn't over again on the next put"""
+        if self.bytes<=self.max_bytes:
+            return
+        batch = []
+        with self.lock:
+            left = self.bytes
+            for key in self.index:
+                if left<=self.max_bytes*0.9 or len(batch)==len(self.index)-1:
+                    break
+                batch.append(key)
+                left -= self.index[key]["bytes"]
+        for key in batch:
+            self.remove(key)
+            self.evictions += 1
+    def save_index(self,min_interval=0):
+        """Write index.json if anything changed, at most once every min_interval seconds"""
+        if not self.dirty or time.time()-self.saved<min_interval:
+            return
+        with self.lock:
+            data = json.dumps({"version":1,"icons":self.index})
+            self.dirty = False
+            self.saved = time.time()
+        with open(self.index_path()+".tmp","w") as f:
+            f.write(data)
+        os.replace(self.index_path()+".tmp",self.index_path())
+
+class IconLoader:
+    """Loads icons in the background in two stages. download_workers threads fetch the icons that
+    aren't in the IconStore yet, sharing one requests.Session per host so connections are reused.
+    decode_workers threads decode them into the store and load the thumbnail at the size asked for
+    as a QImage, or cut it out of atlas (an IconAtlas) when that has it at the size.
+    Both stages take the icons of the rows on screen first (see show()), then the rest oldest first.
+    Finished icons are held until take_loaded() hands them over as one batch"""
+    def __init__(self,filecache_root,download_workers=8,decode_workers=2,category="icon",store=None,ttl=ICON_TTL):
+        self.filecache_root = filecache_root
+        self.category = category
+        self.ttl = ttl
+        self.store = store or IconStore(filecache_root+"/cache/icons/store")
+        self.download_workers = download_workers
+        self.lock = threading.Lock()
+        #stage:{(key,size):job} waiting for a worker of that stage, oldest first
+        self.waiting = {"download":collections.OrderedDict(),"decode":collections.OrderedDict()}
+        self.wake = {"download":threading.Condition(self.lock),"decode":threading.Condition(self.lock)}
+        self.visible = []       #(key,size) of the rows on screen, top first
+        self.requested = {}     #(key,size):time it was requested
+        self.latencies = collections.deque(maxlen=500)  #seconds from request to take_loaded() of recent icons
+        self.dropped = 0
+        self.sessions = {}      #host:requests.Session
+        self.pending = set()    #(key,size) requested and not yet handed over
+        self.failures = set()   #(key,size) that could not be loaded, not tried again
+        self.atlas = None
+        self.atlas_misses = 0   #icons loaded from the store that the atlas could have held
+        self.loaded = []        #[(key,fpath,size,QImage)] waiting for take_loaded()
+        self.downloaded = 0
+        self.revalidated = 0    #downloads answered with 304 Not Modified
+        self.decoded = 0
+        self.failed = 0
+        for i in range(download_workers):
+            threading.Thread(target=self.download_loop,daemon=True).start()
+        for i in range(decode_workers):
+            threading.Thread(target=self.decode_loop,daemon=True).start()
+    def session(self,url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                session.headers.update(headers)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=self.download_workers)
+                session.mount("http://",adapter)
+                session.mount("https://",adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+    def request(self,key,game,size):
+        """Load the icon for game at size, key comes back with it from take_loaded()"""
+        with self.lock:
+            if (key,size) in self.pending or (key,size) in self.failures:
+                return
+            self.pending.add((key,size))
+            self.requested[(key,size)] = time.time()
+        self.put("download",(key,size),(key,game,size))
+    def show(self,keys,size):
+        """keys are the rows on screen, top first. Their icons are loaded before any other, and
+        requests still waiting to download for rows that aren't on screen any more are dropped.
+        Those rows request their icon again if they come back"""
+        with self.lock:
+            self.visible = [(key,size) for key in keys]
+            shown = set(self.visible)
+            waiting = self.waiting["download"]
+            for item in list(waiting):
+                if item not in shown:
+                    del waiting[item]
+                    self.pending.discard(item)
+                    self.requested.pop(item,None)
+                    self.dropped += 1
+    def put(self,stage,item,job):
+        with self.lock:
+            self.waiting[stage][item] = job
+            self.wake[stage].notify()
+    def take(self,stage):
+        """Next job for a worker of stage, waiting for one if there are none"""
+        waiting = self.waiting[stage]
+        with self.lock:
+            while not waiting:
+                self.wake[stage].wait()
+            for item in self.visible:
+                if item in waiting:
+                    break
+            else:
+                item = next(iter(waiting))
+            return waiting.pop(item)
+    def download_loop(self):
+        while True:
+            key,game,size = self.take("download")
+            try:
+                fpath,mode,url = path_to_icon(game,self.filecache_root,self.category)
+                data = fresh = None
+                entry = self.store.entry(url)
+                if mode == "download" and (entry and httpcache.is_stale(entry,self.ttl) or not entry and not os.path.exists(fpath)):
+                    data,fresh = self.download(url,entry)
+                elif not entry:
+                    #Icons that aren't downloaded, and files from before the store, come from the file cache
+                    data = fetch_icon(game,self.filecache_root,self.category)
+                self.put("decode",(key,size),(key,fpath,url,size,data,fresh))
+            except:
+                import traceback
+                traceback.print_exc()
+                self.done(key,size)
+    def decode_loop(self):
+        while True:
+            key,fpath,url,size,data,fresh = self.take("decode")
+            try:
+                if isinstance(data,bytes):
+                    data = BytesIO(data)
+                image = None
+                atlas = self.atlas
+                if not data and atlas and atlas.size == size:
+                    image = atlas.image(url)
+                if data:
+                    self.store.put(url,data,[size],self.category,fresh)
+                found = image is None and self.store.thumbnail(url,size,self.category)
+                if found:
+                    path,exact = found
+                    if exact:
+                        image = QImageReader(path.replace("/",os.path.sep)).read()
+                    else:
+                        image = scale_image(path,size,self.category)
+                    with self.lock:
+                        self.atlas_misses += 1
+                if image is not None:
+                    with self.lock:
+                        self.loaded.append((key,fpath,size,image))
+                        self.decoded += 1
+                    continue
+            except:
+                import traceback
+                traceback.print_exc()
+            self.done(key,size)
+    def download(self,url,entry=None):
+        """(bytes,validators) of the icon at url, or (None,None) if entry (the stored copy) is still good"""
+        try:
+            r = httpcache.conditional_get(url,entry,self.session(url))
+        except requests.RequestException:
+            if entry:
+                return None,None
+            raise
+        with self.lock:
+            self.downloaded += 1
+            if r.status_code == 304:
+                self.revalidated += 1
+        if entry and r.status_code != 200:
+            #Not modified, or gone from the server: keep showing the stored icon
+            self.store.checked(url)
+            return None,None
+        return r.content,httpcache.validators(r)
+    def done(self,key,size):
+        with self.lock:
+            self.failed += 1
+            self.pending.discard((key,size))
+            self.requested.pop((key,size),None)
+            self.failures.add((key,size))
+    def take_loaded(self):
+        """[(key,fpath,size,QImage)] finished since the last call"""
+        with self.lock:
+            loaded = self.loaded
+            self.loaded = []
+            now = time.time()
+            for key,fpath,size,image in loaded:
+                self.pending.discard((key,size))
+                self.latencies.append(now-self.requested.pop((key,size),now))
+        return loaded
+    def busy(self):
+        return bool(self.pending)
+    def stats(self):
+        """Queue depths and how long recent icons took from request to being handed over, in ms"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {"downloads waiting":len(self.waiting["download"]),"decodes waiting":len(self.waiting["decode"]),
+                    "pending":len(self.pending),"dropped":self.dropped,
+                    "downloaded":self.downloaded,"revalidated":self.revalidated,"decoded":self.decoded,"failed":self.failed}
+        if latencies:
+            stats["latency median"] = int(latencies[len(latencies)//2]*1000)
+            stats["latency 95%"] = int(latencies[int(len(latencies)*0.95)]*1000)
+            stats["latency max"] = int(latencies[-1]*1000)
+        return stats
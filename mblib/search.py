@@ -0,0 +1,197 @@
+import re
+
+#Text fields of a game that can be searched, and the names a query can use for them
+FIELDS = ("name","genre","source")
+FIELD_ALIASES = {"name":"name","genre":"genre","source":"source","platform":"source","is":"is"}
+
+TOKEN = re.compile(r'\s*(\(|\)|-?(?:\w+:)?"[^"]*"?|[^\s()]+)')
+
+def tokenize(query):
+    return [t for t in TOKEN.findall(query.lower()) if t]
+
+def parse_query(query,field="name"):
+    """Parse a search string into a tree of tuples:
+        ("term",field,text) ("and",[nodes]) ("or",[nodes]) ("not",node)
+
+    Words are all required: witcher 3
+    or (or |) between words accepts either: gba or snes
+    - or not in front of a word or a bracket excludes it: -demo -(rpg or strategy)
+    "quotes" search for the words together: "the witcher"
+    field: searches something other than the default field: genre:rpg source:steam is:hidden
+    (brackets) group: (rpg or strategy) -demo
+    A ) without a ( before it is ignored
+
+    Returns None for an empty query"""
+    tokens = tokenize(query)
+    pos = [0]
+    def peek():
+        if pos[0]<len(tokens):
+            return tokens[pos[0]]
+    def take():
+        pos[0] += 1
+        return tokens[pos[0]-1]
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() in ("or","|"):
+            take()
+            nodes.append(parse_and())
+        nodes = [n for n in nodes if n]
+        if len(nodes)>1:
+            return ("or",nodes)
+        return nodes[0] if nodes else None
+    def parse_and():
+        nodes = []
+        while peek() is not None and peek() not in ("or","|",")"):
+            if peek() == "and":
+                take()
+                continue
+            node = parse_unary()
+            if node:
+                nodes.append(node)
+        if len(nodes)>1:
+            return ("and",nodes)
+        return nodes[0] if nodes else None
+    def parse_unary():
+        token = take()
+        if token == "not" or (token == "-" and peek() == "("):
+            if peek() is None or peek() in ("or","|",")"):
+                return None
+            node = parse_unary()
+            return ("not",node) if node else None
+        if token == "(":
+            node = parse_or()
+            if peek() == ")":
+                take()
+            return node
+        if token == ")":
+            return None
+        negate = False
+        if token.startswith("-") and len(token)>1:
+            negate = True
+            token = token[1:]
+        term_field = field
+        if ":" in token and not token.startswith('"'):
+            prefix,rest = token.split(":",1)
+            if prefix in FIELD_ALIASES and rest:
+                term_field = FIELD_ALIASES[prefix]
+                token = rest
+        text = token.strip('"') if token.startswith('"') else token
+        if not text:
+            return None
+        node = ("term",term_field,text)
+        if negate:
+            return ("not",node)
+        return node
+    #parse_or stops at a ), one that closes nothing is skipped and the rest is still required
+    nodes = []
+    while peek() is not None:
+        if peek() == ")":
+            take()
+            continue
+        node = parse_or()
+        if node:
+            nodes.append(node)
+    if len(nodes)>1:
+        return ("and",nodes)
+    return nodes[0] if nodes else None
+
+class SearchIndex:
+    """Search postings over the text of every game. Games are grouped by the distinct text of
+    each field, and every 3 letter run of a text is filed with the texts that contain it, so a
+    term is answered by intersecting a few postings and checking only those texts for the whole
+    term. Genres and sources repeat a lot, so those fields stay small"""
+    def __init__(self):
+        self.texts = {}     #gameid:{field:lowercase text}
+        self.values = {}    #field:{text:set(gameid)}
+        self.grams = {}     #field:{gram:set(text)}
+        self.tags = {}      #tag:set(gameid), searched with is:tag
+        self.game_tags = {} #gameid:tags the game is filed under
+        for field in FIELDS:
+            self.values[field] = {}
+            self.grams[field] = {}
+    def add(self,gameid,texts,tags=()):
+        """File gameid under texts {field:text} and tags, replacing what it was filed under"""
+        self.remove(gameid)
+        texts = dict((field,texts.get(field,"").lower()) for field in FIELDS)
+        self.texts[gameid] = texts
+        for field in FIELDS:
+            text = texts[field]
+            values = self.values[field]
+            if text not in values:
+                values[text] = set()
+                postings = self.grams[field]
+                for gram in grams(text):
+                    if gram not in postings:
+                        postings[gram] = set()
+                    postings[gram].add(text)
+            values[text].add(gameid)
+        self.game_tags[gameid] = tags
+        for tag in tags:
+            if tag not in self.tags:
+                self.tags[tag] = set()
+            self.tags[tag].add(gameid)
+    def remove(self,gameid):
+        if gameid not in self.texts:
+            return
+        texts = self.texts.pop(gameid)
+        for field in FIELDS:
+            text = texts[field]
+            values = self.values[field]
+            values[text].discard(gameid)
+            if not values[text]:
+                del values[text]
+                postings = self.grams[field]
+                for gram in grams(text):
+                    postings[gram].discard(text)
+                    if not postings[gram]:
+                        del postings[gram]
+        for tag in self.game_tags.pop(gameid):
+            self.tags[tag].discard(gameid)
+    def all(self):
+        return set(self.texts)
+    def lookup(self,field,text):
+        """set of gameids whose field contains text"""
+        if field == "is":
+            return set(self.tags.get(text,()))
+        values = self.values[field]
+        if len(text)<3:
+            #Too short to have a gram of its own, the distinct texts are few enough to check directly
+            matched = [value for value in values if text in value]
+        else:
+            postings = self.grams[field]
+            found = None
+            for gram in sorted(grams(text),key=lambda g:len(postings.get(g,()))):
+                if gram not in postings:
+                    return set()
+                found = set(postings[gram]) if found is None else found & postings[gram]
+                if not found:
+                    return set()
+            matched = [value for value in found if text in value]
+        return set().union(*[values[value] for value in matched])
+    def evaluate(self,node):
+        if node[0] == "term":
+            return self.lookup(node[1],node[2])
+        if node[0] == "not":
+            return self.all()-self.evaluate(node[1])
+        results = [self.evaluate(n) for n in node[1]]
+        if node[0] == "and":
+            return set.intersection(*results)
+        return set.union(*results)
+    def search(self,query,field="name"):
+        """set of gameids matching query, see parse_query for the syntax. An empty query matches everything"""
+        node = parse_query(query,field)
+        if node is None:
+            return self.all()
+        return self.evaluate(node)
+
+def grams(text):
+    """Every 3 letter run in text"""
+    return set([text[i:i+3] for i in range(len(text)-2)])
+
+assert parse_query("") is None
+assert parse_query("Witcher") == ("term","name","witcher")
+assert parse_query("gba or snes",field="source") == ("or",[("term","source","gba"),("term","source","snes")])
+assert parse_query('"the witcher" -demo genre:rpg') == ("and",[("term","name","the witcher"),("not",("term","name","demo")),("term","genre","rpg")])
+assert parse_query("(rpg | strategy) not is:hidden",field="genre") == ("and",[("or",[("term","genre","rpg"),("term","genre","strategy")]),("not",("term","is","hidden"))])
+assert parse_query("rpg ) witcher") == ("and",[("term","name","rpg"),("term","name","witcher")])
+assert parse_query("-(rpg or strategy)",field="genre") == ("not",("or",[("term","genre","rpg"),("term","genre","strategy")]))
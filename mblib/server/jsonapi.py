@@ -1,6 +1,12 @@
 import hug
 import sys,os,traceback
+import threading
 import base64
+import json
+import gzip
+import hashlib
+import ubjson
+import falcon
 sys.path.insert(0,"../..")
 import mblib
 from mblib import games
@@ -11,11 +17,22 @@ def nice_user(user):
         raise Exception("Username must only contain english alpha and digits")
     return fixed_user
         
+#Requests that change a user's files run one at a time
+user_locks = {}
+user_locks_lock = threading.Lock()
+
 class User:
     def __init__(self, user):
         self.user = nice_user(user)
         self.up = os.path.join("__users__",user)
         self.game_path = os.path.join(self.up,"games.json")
+        #Change records uploaded since games.json was written, in the journal format of games.Games
+        self.journal_path = games.journal_path(self.game_path)
+        #Revision of games.json with its change records, and how many there are, so they can be read without decoding it
+        self.index_path = os.path.join(self.up,"revision.json")
+    def lock(self):
+        with user_locks_lock:
+            return user_locks.setdefault(self.user,threading.RLock())
     def is_ready(self):
         return os.path.exists(self.game_path)
     def make_ready(self):
@@ -23,41 +40,190 @@ class User:
             os.mkdir("__users__")
         if not os.path.exists(self.up):
             os.mkdir(self.up)
+    def upload_path(self):
+        return "%s.%s.upload"%(self.game_path,threading.get_ident())
+    def load(self):
+        gdbm = games.Games()
+        gdbm.load_games(filename=self.game_path)
+        return gdbm
+    def changes(self):
+        return list(games.Games().read_journal(self.game_path))
+    def index(self):
+        """{"revision","changes","sha256"}, built from the database the first time for users saved before it was kept"""
+        try:
+            with open(self.index_path) as f:
+                index = json.loads(f.read())
+        except (OSError,ValueError):
+            index = {"revision":self.load().revision,"changes":len(self.changes())}
+        if "sha256" not in index:
+            index["sha256"] = games.file_hash(self.game_path)
+            self.write_index(index)
+        return index
+    def revision(self):
+        return self.index()["revision"]
+    def write_index(self,index):
+        with open(self.index_path+".tmp","w") as f:
+            f.write(json.dumps(index))
+        os.replace(self.index_path+".tmp",self.index_path)
+    def add_change(self,batch):
+        """Append a change record made at revision base, compacting once there are too many"""
+        index = self.index()
+        batch["base"] = index["revision"]
+        games.append_journal(self.game_path,ubjson.dumpb(batch))
+        index.update({"revision":batch["revision"],"changes":index["changes"]+1})
+        self.write_index(index)
+        if index["changes"]>games.JOURNAL_COMPACT_RECORDS:
+            self.compact()
+    def compact(self):
+        """Fold the change records into games.json"""
+        if os.path.exists(self.journal_path):
+            gdbm = self.load()
+            gdbm.compact(self.game_path)
+            self.write_index({"revision":gdbm.revision,"changes":0,"sha256":games.file_hash(self.game_path)})
+
+class FileRange:
+    """Reads the length bytes of f from where it is, so a range of a file can be streamed"""
+    def __init__(self,f,length):
+        self.f = f
+        self.left = length
+    def read(self,size=-1):
+        if size<0 or size>self.left:
+            size = self.left
+        data = self.f.read(size)
+        self.left -= len(data)
+        return data
+    def close(self):
+        self.f.close()
+
+def read_gzip(path):
+    """Decompress path a chunk at a time, which checks its crc without holding the database in memory"""
+    with gzip.open(path,"rb") as f:
+        while f.read(games.CHUNK_SIZE):
+            pass
 
 @hug.format.content_type('application/ubjson')            
 def raw(data, request=None, response=None):
     return data
 
 @hug.get(examples="user=saluk",output=raw)
-def game_database(user):
+def game_database(user,request,response):
+    """The database file, streamed. Its sha256 is the ETag, a Range from a download that was
+    cut off is answered with the rest of the file as long as If-Range still matches it"""
     user = User(user)
     if not user.is_ready():
         return {"error":"no_games_saved"}
-    with open(user.game_path,"rb") as gamef:
-        data = gamef.read()
-    return data
+    with user.lock():
+        user.compact()
+        sha256 = user.index()["sha256"]
+        #Opened under the lock, a new upload replaces the file instead of writing into this one
+        gamef = open(user.game_path,"rb")
+    size = os.fstat(gamef.fileno()).st_size
+    response.set_header("ETag",'"%s"'%sha256)
+    response.set_header("Accept-Ranges","bytes")
+    if request.range and request.if_range in (None,'"%s"'%sha256):
+        start,end = request.range
+        if end<0 or end>=size:
+            end = size-1
+        if start>=size:
+            gamef.close()
+            raise falcon.HTTPRangeNotSatisfiable(size)
+        gamef.seek(start)
+        response.status = falcon.HTTP_206
+        response.content_range = (start,end,size)
+        response.content_length = end-start+1
+        return FileRange(gamef,end-start+1)
+    response.content_length = size
+    return FileRange(gamef,size)
 
-@hug.put(examples="user=saluk")
-def game_database(body,user,input=raw):
+@hug.put(examples="user=saluk&revision=3")
+def game_database(body,user,request,revision:hug.types.number=None,input=raw):
+    """Replace the database with the uploaded one. It is streamed to a temporary file and checked
+    against the X-Content-SHA256 header and its gzip crc rather than decoded. Clients that don't
+    send its revision get it decoded once to read it"""
     user = User(user)
     user.make_ready()
+    upload_path = user.upload_path()
     try:
-        data = body.read()
-        gdbmu = games.Games()
-        gdbmu.load_games(filedata=data)
+        sha = hashlib.sha256()
+        size = 0
+        with open(upload_path,"wb") as f:
+            while 1:
+                data = body.read(games.CHUNK_SIZE)
+                if not data:
+                    break
+                sha.update(data)
+                size += len(data)
+                f.write(data)
+        expected = request.get_header("X-Content-SHA256")
+        if expected and expected != sha.hexdigest():
+            os.remove(upload_path)
+            return {"error":"Upload corrupted","sha256":sha.hexdigest()}
+        read_gzip(upload_path)
+        if revision is None:
+            gdbmu = games.Games()
+            gdbmu.load_games(filename=upload_path)
+            revision = gdbmu.revision
     except:
         traceback.print_exc()
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
         return {"error":"Not a valid game database"}
+    with user.lock():
+        try:
+            if user.is_ready() and user.revision()>revision:
+                os.remove(upload_path)
+                return {"error":"server has newer revision","client_revision":revision,"server_revision":user.revision()}
+        except:
+            pass
+        os.replace(upload_path,user.game_path)
+        #The new database replaces every change uploaded before it
+        if os.path.exists(user.journal_path):
+            os.remove(user.journal_path)
+        user.write_index({"revision":revision,"changes":0,"sha256":sha.hexdigest()})
+    return {"msg":"success","size":size,"sha256":sha.hexdigest()}
+
+@hug.get(examples="user=saluk&since=3",output=raw)
+def game_changes(user,since:hug.types.number):
+    """Change records taking a client at revision since to the server revision, or full if
+    the records don't go back that far and the whole database has to be downloaded"""
+    user = User(user)
+    if not user.is_ready():
+        return ubjson.dumpb({"error":"no_games_saved"})
+    try:
+        revision = user.revision()
+        changes = user.changes() if since != revision else []
+    except:
+        traceback.print_exc()
+        return ubjson.dumpb({"error":"Error loading game database"})
+    if since == revision:
+        return ubjson.dumpb({"server_revision":revision,"changes":[]})
+    for i,batch in enumerate(changes):
+        if batch.get("base",None) == since:
+            return ubjson.dumpb({"server_revision":revision,"changes":changes[i:]})
+    return ubjson.dumpb({"server_revision":revision,"full":True})
+
+@hug.post(examples="user=saluk&base=3")
+def game_changes(body,user,base:hug.types.number,input=raw):
+    """Add a change record made by a client that was in sync at revision base"""
+    user = User(user)
+    if not user.is_ready():
+        return {"error":"no_games_saved"}
     try:
-        gdbms = games.Games()
-        gdbms.load_games(filename=user.game_path)
-        if gdbms.revision>gdbmu.revision:
-            return {"error":"server has newer revision","client_revision":gdbmu.revision,"server_revision":gdbms.revision}
+        batch = ubjson.loadb(body.read())
+        assert isinstance(batch.get("games",[]),list) and isinstance(batch.get("deleted",[]),list)
     except:
-        pass
-    with open(user.game_path,"wb") as gamef:
-        gamef.write(data)
-    return {"msg":"success","size":len(data)}
+        traceback.print_exc()
+        return {"error":"Not a valid change record"}
+    with user.lock():
+        try:
+            revision = user.revision()
+        except:
+            traceback.print_exc()
+            return {"error":"Error loading game database"}
+        if base != revision or batch.get("revision",0)<=revision:
+            return {"error":"server has newer revision","client_revision":batch.get("revision",0),"server_revision":revision}
+        user.add_change(batch)
+    return {"msg":"success","server_revision":batch["revision"]}
     
 @hug.get(examples="user=saluk")
 def games_revision(user):
@@ -65,12 +231,11 @@ def games_revision(user):
     if not user.is_ready():
         return {"server_revision":None}
     try:
-        gdbm = games.Games()
-        gdbm.load_games(filename=user.game_path)
+        revision = user.revision()
     except:
         traceback.print_exc()
         return {"error":"Error loading game database"}
-    return {"server_revision":gdbm.revision}
+    return {"server_revision":revision}
     
 @hug.post(examples="user=saluk")
 def bump_revision(user):
@@ -78,11 +243,11 @@ def bump_revision(user):
     if not user.is_ready():
         return {"error":"user not initialized"}
     try:
-        gdbm = games.Games()
-        gdbm.load_games(filename=user.game_path)
-        gdbm.revision += 1
-        gdbm.save(user.game_path)
+        #An empty change record moves the revision on without rewriting the database
+        with user.lock():
+            revision = user.revision()+1
+            user.add_change({"revision":revision})
     except:
         traceback.print_exc()
         return {"error":"Error loading game database"}
-    return {"server_revision":gdbm.revision}
+    return {"server_revision":revision}
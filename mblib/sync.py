@@ -1,5 +1,8 @@
 import requests
 import shutil, os
+import json
+import hashlib
+import ubjson
 
 from mblib import games
 
@@ -7,24 +10,82 @@ app = None
 user = "saluk"
 host = "dawnsoft.org:8000"
 
+def state_path():
+    return app.config["games"]+".sync"
+
+def load_state():
+    """The server revision we last synced with, and changes not uploaded yet"""
+    try:
+        with open(state_path()) as f:
+            return json.loads(f.read())
+    except (OSError,ValueError):
+        return {"revision":None,"games":[],"deleted":[],"meta":None}
+
+def save_state(state):
+    with open(state_path()+".tmp","w") as f:
+        f.write(json.dumps(state))
+    os.replace(state_path()+".tmp",state_path())
+
+def meta_hash(gamedb):
+    return hashlib.md5(json.dumps(gamedb.meta_data(),sort_keys=True).encode("utf8")).hexdigest()
+
 def get_server_revision():
     r = requests.get("http://%s/games_revision?user=%s"%(host,user))
     return r.json()["server_revision"]
 
 def download_games():
+    """Stream the server database to the .d file. A download that was cut off is picked up where it
+    stopped if the server still has the same file, and the result is checked against its sha256"""
     print("DOWNLOAD GAMES")
     game_file = app.config["games"]
     downloading = game_file+".d"
-    r = requests.get("http://%s/game_database?user=%s"%(host,user),stream=True)
+    #The ETag of a download in progress, removed once the file is complete
+    etag_file = downloading+".etag"
+    headers = {}
+    if os.path.exists(downloading) and os.path.exists(etag_file):
+        with open(etag_file) as f:
+            headers["If-Range"] = f.read()
+        headers["Range"] = "bytes=%d-"%os.path.getsize(downloading)
+    r = requests.get("http://%s/game_database?user=%s"%(host,user),headers=headers,stream=True)
+    if r.status_code == 416:
+        #Nothing after the end of the file, the last download finished before the ETag was removed
+        r.close()
+        if headers["If-Range"].strip('"') == games.file_hash(downloading):
+            os.remove(etag_file)
+            return
+        os.remove(downloading)
+        os.remove(etag_file)
+        return download_games()
+    if r.status_code not in (200,206):
+        #The next download starts over
+        if os.path.exists(etag_file):
+            os.remove(etag_file)
+        raise Exception(r.text)
+    etag = r.headers.get("ETag","")
+    with open(etag_file,"w") as f:
+        f.write(etag)
+    if r.status_code == 206:
+        print("resuming download at",os.path.getsize(downloading))
+        sha = hashlib.sha256()
+        with open(downloading,"rb") as f:
+            for chunk in iter(lambda: f.read(games.CHUNK_SIZE),b""):
+                sha.update(chunk)
+        mode = "ab"
+    else:
+        sha = hashlib.sha256()
+        mode = "wb"
     read = 0
-    with open(downloading,"wb") as f:
-        while 1:
-            next = r.raw.read(128)
-            if not len(next):
-                break
-            read += len(next)
-            f.write(next)
+    with open(downloading,mode) as f:
+        for chunk in r.iter_content(games.CHUNK_SIZE):
+            sha.update(chunk)
+            read += len(chunk)
+            f.write(chunk)
     print("read",read)
+    if etag and etag.strip('"') != sha.hexdigest():
+        os.remove(downloading)
+        os.remove(etag_file)
+        raise Exception("Downloaded database is corrupted")
+    os.remove(etag_file)
     
 def refresh_games():
     print("REFRESHING GAMES")
@@ -33,39 +94,106 @@ def refresh_games():
     downloading = game_file+".d"
     downloaded = games.Games()
     downloaded.load(downloading)
-    #force update all games from server into games
-    for g in downloaded.games.values():
-        gamedb.force_update_game(g.gameid,g)
+    #Copy every game exactly as the server has it, later changes only come as deltas on top of this
     #Delete games that are gone on server
-    for gameid in list(gamedb.games.keys()):
-        if gameid in gamedb.games and gameid not in downloaded.games:
-            print("DELETING",gamedb.games[gameid])
-            del gamedb.games[gameid]
+    gamedb.apply_changes({
+        "games":[downloaded.games[gameid].dict() for gameid in downloaded.games],
+        "deleted":[gameid for gameid in gamedb.games if gameid not in downloaded.games]
+    })
     #Update local revision to match server
     gamedb.revision = downloaded.revision
+    #Everything local now matches the server
+    gamedb.take_unsynced()
+    save_state({"revision":gamedb.revision,"games":[],"deleted":[],"meta":meta_hash(gamedb)})
+
+def download_changes(since):
+    """Apply the changes the server got since revision since, False if it only has the full database"""
+    print("DOWNLOAD CHANGES SINCE",since)
+    r = requests.get("http://%s/game_changes?user=%s&since=%s"%(host,user,since))
+    d = ubjson.loadb(r.content)
+    if d.get("error",""):
+        raise Exception(d["error"])
+    if d.get("full",False):
+        return False
+    for batch in d["changes"]:
+        app.games.apply_changes(batch)
+    state = load_state()
+    state["revision"] = d["server_revision"]
+    state["meta"] = meta_hash(app.games)
+    save_state(state)
+    print("applied",len(d["changes"]),"changes")
+    return True
 
 def download():
+    """Bring app.games up to the server revision, True if that changed any games"""
     print("check to download")
     if not app:
-        return
+        return False
     games = app.games
     revision = get_server_revision()
     if not revision:
-        return
+        return False
+    synced = load_state()["revision"]
+    if synced is not None:
+        if revision == synced:
+            return False
+        if download_changes(synced):
+            return True
     if revision < games.revision:
         raise Exception("MAJOR ERROR, server is older than client. shouldn't happen")
     if revision == games.revision:
         #We are already in sync
-        return
+        if synced is None:
+            games.take_unsynced()
+            save_state({"revision":revision,"games":[],"deleted":[],"meta":meta_hash(games)})
+        return False
     download_games()
     refresh_games()
+    return True
     
 def upload():
+    """Send the games changed since the last sync, or the whole database if the server has none from us"""
+    state = load_state()
+    if state["revision"] is None:
+        return upload_games()
+    changed,deleted = app.games.take_unsynced()
+    changed = (set(state["games"])-deleted)|changed
+    deleted = (set(state["deleted"])-changed)|deleted
+    meta = meta_hash(app.games)
+    if not changed and not deleted and meta == state["meta"]:
+        return
+    print("UPLOAD CHANGES",len(changed),len(deleted))
+    batch = app.games.change_record(changed,deleted)
+    batch["revision"] = max(batch["revision"],state["revision"]+1)
+    if meta != state["meta"]:
+        batch.update(app.games.meta_data())
+    try:
+        r = requests.post("http://%s/game_changes?user=%s&base=%s"%(host,user,state["revision"]),data=ubjson.dumpb(batch),headers={"Content-Type":"application/ubjson"})
+        print(r.json())
+        if r.json().get("error",""):
+            raise Exception(r.text)
+    except:
+        #Keep them for the next upload
+        state["games"],state["deleted"] = sorted(changed),sorted(deleted)
+        save_state(state)
+        raise
+    app.games.revision = max(app.games.revision,batch["revision"])
+    save_state({"revision":batch["revision"],"games":[],"deleted":[],"meta":meta})
+
+def upload_games():
     print("UPLOAD GAMES")
     game_file = app.config["games"]
+    #Changes still waiting to be saved have to be in the file we send
+    app.saver.flush()
+    #Server expects a full database, fold in anything still sitting in the journal
+    if app.games.journal_records:
+        app.games.compact(game_file)
+    #Streamed from the file, the server checks what it got against the hash
+    headers = {"Content-Type":"application/ubjson","X-Content-SHA256":games.file_hash(game_file)}
     with open(game_file,"rb") as f:
-        data = f.read()
-    r = requests.put("http://%s/game_database?user=%s"%(host,user),data=data,headers={"Content-Type":"application/ubjson"})
+        r = requests.put("http://%s/game_database?user=%s&revision=%s"%(host,user,app.games.revision),data=f,headers=headers)
     print(r.json())
     if r.json().get("error",""):
         raise Exception(r.text)
+    app.games.take_unsynced()
+    save_state({"revision":app.games.revision,"games":[],"deleted":[],"meta":meta_hash(app.games)})
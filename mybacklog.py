@@ -9,11 +9,11 @@ import threading
 from mblib import sync
 
 #backloglib
-from mblib.apis import giantbomb, steamapi, gogapi, humbleapi, thegamesdb
+from mblib.apis import giantbomb, steamapi, gogapi, humbleapi, thegamesdb, importer
 from mblib.interface import account, gameoptions, base_paths, logwindow, sourcesform, emulatorform
 from mblib import games,syslog
 
-from mblib.resources import icons,enc
+from mblib.resources import icons,enc,atlas
 
 #os.environ["QT_QPA_PLATFORM_PLUGIN_PATH"] = "C:\\Python33\\Lib\\site-packages\\PyQt5\\plugins\\platforms"
 VERSION = "0.26 alpha"
@@ -34,25 +34,42 @@ class RunGameThread(QThread):
         while self.process and self.process.returncode is None:
             self.process.communicate()
 
-class ProcessIconsThread(QThread):
-    app = None
-    def run(self):
-        print("running icons")
-        try:
-            self.app.process_icons()
-        except:
-            import traceback
-            traceback.print_exc()
-            
-class ImportThread(QThread):
-    app = None
-    func = None
+class SearchWorker(threading.Thread):
+    """Runs the newest search handed to submit() and reports it through app.search_trigger.
+    A search is dropped as soon as a newer one is submitted"""
+    def __init__(self,app):
+        super(SearchWorker, self).__init__(daemon=True)
+        self.app = app
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+    def submit(self,request=None):
+        """Queue request, superseding whatever is queued or running. None only cancels"""
+        with self.condition:
+            self.generation += 1
+            self.request = request
+            self.condition.notify()
+            return self.generation
+    def superseded(self,generation):
+        return generation != self.generation
     def run(self):
-        try:
-            self.func(self.app)
-        except:
-            import traceback
-            traceback.print_exc()
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation,request = self.generation,self.request
+                self.request = None
+            cancelled = lambda: self.superseded(generation)
+            try:
+                shown = self.app.search_games(request,cancelled)
+                if shown is None:
+                    continue
+                played = self.app.games.playtime(shown)
+                if not cancelled():
+                    self.app.search_trigger.emit(generation,shown,played)
+            except:
+                import traceback
+                traceback.print_exc()
 
 class Cookies(QNetworkCookieJar):
     def __init__(self):
@@ -203,6 +220,8 @@ class MyBacklog(QMainWindow):
     def click_tray_icon(self):
         self.show()
     def really_close(self):
+        self.main_form.icon_store.save_index()
+        self.main_form.saver.flush()
         self.exit_requested = True
         self.trayicon.hide()
         self.close()
@@ -216,24 +235,96 @@ class MyBacklog(QMainWindow):
 DATA_GAMEID = 101
 DATA_SORT = 12
 DATA_EDIT = 145
-class SortableTableWidgetItem(QTableWidgetItem):
-    def __lt__(self, other):
-        first = self.data(DATA_SORT)
-        last = other.data(DATA_SORT)
-        if not first:
-            first = 0
-        if not last:
-            last = 0
-        return first<last
-
-a = SortableTableWidgetItem()
-b = SortableTableWidgetItem()
-a.setText("Wed")
-a.setData(DATA_SORT,"a")
-b.setText("Mon")
-b.setData(DATA_SORT,"b")
-assert a<b
-assert b>a
+class GameListModel(QAbstractTableModel):
+    """The games of app.games in app.sort order. Nothing is built for a row until the view
+    asks for it, so only the rows on screen cost anything"""
+    def __init__(self,app):
+        super(GameListModel, self).__init__()
+        self.app = app
+        self.gameids = []
+        self.stale = False      #True once games were merged into app.games since gameids was read
+    def refresh(self):
+        self.beginResetModel()
+        self.gameids = self.app.games.list(self.app.sort).gameids
+        self.stale = False
+        self.endResetModel()
+    def row_for_gameid(self,gameid):
+        try:
+            return self.gameids.index(gameid)
+        except ValueError:
+            return None
+    def icons_changed(self,first,last):
+        self.dataChanged.emit(self.index(first,1),self.index(last,1),[Qt.DecorationRole])
+    def row_changed(self,gameid):
+        row = self.row_for_gameid(gameid)
+        if row is not None:
+            self.dataChanged.emit(self.index(row,0),self.index(row,self.columnCount()-1))
+    def game_changed(self,gameid):
+        """Move, add or remove the row for gameid to match app.games, then redraw it"""
+        #Rows of a stale list don't line up with positions in app.games
+        if self.stale:
+            self.refresh()
+            return
+        row = self.row_for_gameid(gameid)
+        new_row = self.app.games.position(self.app.sort,gameid)
+        if row == new_row:
+            self.row_changed(gameid)
+            return
+        #A move is a remove and an insert: the proxy refilters every row on rowsMoved,
+        #but only the inserted one here
+        if row is not None:
+            self.beginRemoveRows(QModelIndex(),row,row)
+            del self.gameids[row]
+            self.endRemoveRows()
+        if new_row is not None:
+            self.beginInsertRows(QModelIndex(),new_row,new_row)
+            self.gameids.insert(new_row,gameid)
+            self.endInsertRows()
+    def rowCount(self,parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.gameids)
+    def columnCount(self,parent=QModelIndex()):
+        return len(self.app.columns)
+    def headerData(self,section,orientation,role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.app.columns[section][0]
+    def data(self,index,role=Qt.DisplayRole):
+        gameid = self.gameids[index.row()]
+        if role == DATA_GAMEID:
+            return gameid
+        if gameid not in self.app.games.games:
+            return None
+        game = self.app.games.games[gameid]
+        col = index.column()
+        if role == Qt.DisplayRole:
+            if col == 2:
+                return self.app.widget_name(game)
+            elif col == 3:
+                return game.genre
+            elif col == 4:
+                return game.playtime_hours_minutes
+            elif col == 5:
+                return game.last_played_nice
+        elif role == Qt.DecorationRole:
+            if col == 0:
+                return self.app.source_icon(game)
+            elif col == 1:
+                return self.app.game_icon(game)
+        elif role == Qt.BackgroundRole:
+            return self.app.row_color(game)
+        elif role == DATA_SORT:
+            return [0,0,game.name.lower(),game.genre.lower(),game.playtime,game.seconds("lastplayed")][col]
+
+class GameFilterProxy(QSortFilterProxyModel):
+    """Hides the games the search bar and view options filter out, and sorts by column
+    when a header is clicked"""
+    def __init__(self,app):
+        super(GameFilterProxy, self).__init__()
+        self.app = app
+        self.setSortRole(DATA_SORT)
+    def filterAcceptsRow(self,source_row,source_parent):
+        return self.app.game_visible(self.sourceModel().gameids[source_row])
 
 def make_callback(f, *args):
     return lambda: f(*args)
@@ -241,11 +332,17 @@ def make_callback(f, *args):
 class GamelistForm(QWidget):
     log_trigger = pyqtSignal(str)
     error_trigger = pyqtSignal(str)
+    search_trigger = pyqtSignal(int,object,object)
+    refresh_trigger = pyqtSignal()
+    merge_trigger = pyqtSignal(str,object)
+    finish_trigger = pyqtSignal(str,object)
     def __init__(self, parent=None):
         print(QImageReader.supportedImageFormats())
         super(GamelistForm, self).__init__(parent)
         
         sync.app = self
+        #Changes are written in the background, a burst of them at once
+        self.saver = games.Saver(self.write_save)
         
         self.browser = None
         self.cookies = {}
@@ -261,10 +358,16 @@ class GamelistForm(QWidget):
         self.log.write("Root config:",self.config)
         
         self.error_trigger.connect(self.handle_error)
+        self.search_trigger.connect(self.search_finished)
+        self.refresh_trigger.connect(self.update_gamelist_widget)
+        self.merge_trigger.connect(self.merge_import)
+        self.finish_trigger.connect(self.end_import)
         
         self.columns = [("s",None,None),("icon",None,None),("name","widget_name","name"),
                         ("genre","genre","genre"),("playtime",None,"playtime_hours_minutes"),("lastplay",None,None)]
         self.changed = []
+        self.shown = set()          #gameids the search bar and view options let through
+        self.installed = None       #gameids of installed games, found when show_installed is first needed
 
         self.hide_packages = True
         self.show_hidden = False
@@ -282,17 +385,28 @@ class GamelistForm(QWidget):
         self.search_name = QLineEdit()
         self.search_name.setPlaceholderText("Search: Name")
         self.searchbarlayout.addWidget(self.search_name,0,0)
-        self.search_name.textChanged.connect(self.dosearch)
+        self.search_name.textChanged.connect(self.search_typed)
         
         self.search_genre = QLineEdit()
         self.search_genre.setPlaceholderText("Search: Genre")
         self.searchbarlayout.addWidget(self.search_genre,0,1)
-        self.search_genre.textChanged.connect(self.dosearch)
+        self.search_genre.textChanged.connect(self.search_typed)
 
         self.search_platform = QLineEdit()
         self.search_platform.setPlaceholderText("Search: Source")
         self.searchbarlayout.addWidget(self.search_platform,0,2)
-        self.search_platform.textChanged.connect(self.dosearch)
+        self.search_platform.textChanged.connect(self.search_typed)
+
+        #Typing only searches once it pauses, and the search runs on search_worker
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.queue_search)
+        self.search_worker = SearchWorker(self)
+        self.search_worker.start()
+
+        for w in [self.search_name,self.search_genre,self.search_platform]:
+            w.setToolTip('witcher 3, "the witcher", gba or snes, -demo, (rpg or strategy), genre:rpg, source:steam, is:finished')
 
         sizer = QWidget()
         sizer.setMaximumWidth(48)
@@ -309,7 +423,19 @@ class GamelistForm(QWidget):
         self.searchbarlayout.addWidget(sizer,1,0)
 
         self.sort = "priority"
-        self.games_list_widget = QTableWidget()
+        self.games_model = GameListModel(self)
+        self.games_proxy = GameFilterProxy(self)
+        self.games_proxy.setSourceModel(self.games_model)
+        self.games_list_widget = QTableView()
+        self.games_list_widget.setModel(self.games_proxy)
+        self.games_list_widget.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.games_list_widget.horizontalHeader().setVisible(True)
+        self.games_list_widget.verticalHeader().setVisible(False)
+        #Rows are all one height, so the view never has to measure them
+        self.games_list_widget.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.games_list_widget.horizontalHeader().setSortIndicator(-1,Qt.AscendingOrder)
+        self.games_list_widget.setSortingEnabled(True)
+        self.games_list_widget.selectionModel().selectionChanged.connect(self.selected_row)
         self.total_played_list = QTableWidget()
         self.total_played_list.setRowCount(1)
         self.total_played_list.setColumnCount(5)
@@ -340,13 +466,29 @@ class GamelistForm(QWidget):
         for source in games.sources.all:
             if source not in self.icons:
                 self.icons[source] = QPixmap("icons/blank.png")
-        self.gicons = {}
-        self.icon_processes = []
-        self.icon_thread = ProcessIconsThread()
-        self.icon_thread.app = self
+        self.gicons = icons.IconCache(self.config["icon_cache_mb"]*1024*1024)
+        self.icon_store = icons.IconStore(self.config["root"]+"/cache/icons/store",self.config["icon_store_mb"]*1024*1024)
+        self.icon_loader = icons.IconLoader(self.config["root"],self.config["icon_workers"],store=self.icon_store)
+        self.atlas_thread = None
+        self.atlas_built = 0
+        self.load_icon_atlas()
+        #Icons the loader has finished are put in the list a batch at a time
+        self.icon_timer = QTimer(self)
+        self.icon_timer.setInterval(100)
+        self.icon_timer.timeout.connect(self.icons_loaded)
+        self.icon_timer.start()
+        #Once scrolling settles the loader is told which rows are on screen
+        self.visible_timer = QTimer(self)
+        self.visible_timer.setSingleShot(True)
+        self.visible_timer.setInterval(50)
+        self.visible_timer.timeout.connect(self.show_visible_icons)
+        self.games_list_widget.verticalScrollBar().valueChanged.connect(self.visible_timer.start)
+        self.game_scroller.verticalScrollBar().valueChanged.connect(self.visible_timer.start)
         
-        ImportThread.app = self
-        self.importer_threads = {"gog":ImportThread(),"steam":ImportThread(),"humble":ImportThread()}
+        #Importers run side by side and their games are merged as they come in,
+        #on this thread so the list and search never see the database half merged
+        self.importer = importer.ImportRuntime(self.merge_trigger.emit,self.finish_trigger.emit)
+        self.last_import_refresh = 0
 
         self.detected_game_start = False
         self.timer = QTimer(self)
@@ -370,6 +512,9 @@ class GamelistForm(QWidget):
         self.icon_size += amt
         self.config["icon_size"] = self.icon_size
         self.save_config()
+        self.log.write("Icon cache:",self.gicons.stats())
+        self.log.write("Icon loader:",self.icon_loader.stats())
+        self.load_icon_atlas()
         self.update_gamelist_widget()
         
     def log_if_window(self,text):
@@ -406,7 +551,13 @@ class GamelistForm(QWidget):
                     "root_config":self.path_base+"/root.json",
                     "root":self.path_base,
                     "rk":str(self.crypter.root_key),
-                    "icon_size":300
+                    "icon_size":300,
+                    "icon_workers":8,
+                    "icon_cache_mb":64,
+                    "icon_store_mb":512,
+                    "steam_scrape_rate":steamapi.SCRAPE_RATE,
+                    "journal_games":True,
+                    "lazy_games":True
                 }
         if os.path.exists(root["root_config"]):
             f = open(root["root_config"])
@@ -442,11 +593,12 @@ class GamelistForm(QWidget):
 
     def init_gamelist(self):
         self.games = games.Games(self.log)
+        self.games.journal = self.config["journal_games"]
+        self.games.lazy = self.config["lazy_games"]
         self.games_lock = threading.Lock()
         print("loading games",self.config["games"])
         self.games.load(self.config["games"],self.config["local"])
         sync.download()
-        self.gamelist = []
         self.update_gamelist_widget()
         
     def save_config(self):
@@ -464,26 +616,12 @@ class GamelistForm(QWidget):
         games.sources.SteamSource.api = self.steam
         games.sources.GogSource.api = self.gog
 
-    def disable_edit_notify(self):
-        return
-        try:
-            self.games_list_widget.cellChanged.disconnect(self.cell_changed)
-        except:
-            pass
-
-    def enable_edit_notify(self):
-        return
-        self.games_list_widget.cellChanged.connect(self.cell_changed)
-        
     def save(self):
-        #self.disable_edit_notify()
+        """Saving happens on the saver thread, a moment after the last change"""
+        self.saver.request()
+
+    def write_save(self):
         self.games.save(self.config["games"],self.config["local"])
-        #for row in range(self.games_list_widget.rowCount()):
-        #    gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
-        #    if gameid in self.changed:
-        #        self.update_game_row(self.games.games[gameid],row)
-        #self.changed = []
-        #self.enable_edit_notify()
 
     def file_options(self):
         print("start","SELF=",self)
@@ -521,42 +659,88 @@ class GamelistForm(QWidget):
         elif self.detected_game_start and not currently_running:
             self.stop_playing(self.running)
     def get_row_for_game(self,game):
-        for row in range(self.games_list_widget.rowCount()):
-            gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
-            if gameid == game.gameid:
-                return row
+        """Row of the game as currently shown in the list, None if it isn't shown"""
+        row = self.games_model.row_for_gameid(game.gameid)
+        if row is None:
+            return None
+        index = self.games_proxy.mapFromSource(self.games_model.index(row,0))
+        if index.isValid():
+            return index.row()
 
     def select_game(self,game):
         row = self.get_row_for_game(game)
-        self.games_list_widget.setCurrentCell(row,2)
-
-    def process_icons(self):
-        for widget,game,size in self.icon_processes:
-            #print("gen icon for",repr(game.name))
-            icon = icons.icon_for_game(game,self.icon_size,self.gicons,self.config["root"])
-            if icon:
-                try:
-                    widget.setIcon(icon)
-                except:
-                    pass
-
-    def set_icon(self,widget,game,size):
+        if row is not None:
+            self.games_list_widget.setCurrentIndex(self.games_proxy.index(row,2))
+
+    def icons_loaded(self):
+        rows = []
+        for gameid,fpath,size,image in self.icon_loader.take_loaded():
+            self.gicons[(fpath,size)] = QPixmap.fromImage(image)
+            if size == self.icon_size:
+                rows.append(self.games_model.row_for_gameid(gameid))
+        rows = [row for row in rows if row is not None]
+        if rows:
+            self.games_model.icons_changed(min(rows),max(rows))
+        self.icon_store.save_index(10)
+        self.update_icon_atlas()
+
+    def show_visible_icons(self):
+        """Load the icons of the rows on screen first and forget the ones scrolled past"""
+        view = self.games_list_widget
+        rect = view.viewport().visibleRegion().boundingRect()
+        gameids = []
+        if not rect.isEmpty():
+            first,last = view.rowAt(rect.top()),view.rowAt(rect.bottom())
+            if last<0:
+                last = self.games_proxy.rowCount()-1
+            gameids = [self.games_proxy.index(row,1).data(DATA_GAMEID) for row in range(max(first,0),last+1)]
+        self.icon_loader.show(gameids,self.icon_size)
+
+    def load_icon_atlas(self):
+        self.icon_atlas = atlas.IconAtlas(self.config["root"]+"/cache/icons/atlas",self.icon_size)
+        self.icon_loader.atlas = self.icon_atlas
+
+    def update_icon_atlas(self):
+        """When the loader is idle, pack the icons it had to load one at a time into the atlas,
+        so next time they come from a few sheets"""
+        if self.atlas_thread:
+            if self.atlas_thread.is_alive():
+                return
+            self.atlas_thread = None
+            self.load_icon_atlas()
+        if not self.icon_loader.atlas_misses or self.icon_loader.busy() or time.time()-self.atlas_built<60:
+            return
+        self.icon_loader.atlas_misses = 0
+        self.atlas_built = time.time()
+        sources = []
+        for gameid in self.games_model.gameids:
+            if gameid in self.shown and gameid in self.games.games:
+                sources.append(icons.path_to_icon(self.games.games[gameid],self.config["root"])[2])
+        self.atlas_thread = threading.Thread(target=atlas.build_atlas,args=(self.icon_store,self.config["root"]+"/cache/icons/atlas",self.icon_size,sources),daemon=True)
+        self.atlas_thread.start()
+
+    def game_icon(self,game):
         cached = icons.icon_in_cache(game,self.icon_size,self.gicons,self.config["root"])
         if cached:
-            widget.setIcon(cached)
-            return
-        self.icon_processes.append((widget,game,self.icon_size))
-        
-    def update_game_row(self,game,row=None,list_widget=None):
-        if list_widget is None:
-            list_widget = self.games_list_widget
-        if row is None:
-            row = self.get_row_for_game(game)
-        if row is None:
-            #Add a row
-            row = list_widget.rowCount()
-            list_widget.setRowCount(row+1)
+            return cached
+        self.icon_loader.request(game.gameid,game,self.icon_size)
+
+    def source_icon(self,game):
+        for s in game.sources:
+            if s["source"] in self.icons:
+                return QIcon(self.icons[s["source"]])
+        return QIcon(self.icons["blank"])
 
+    def row_color(self,game):
+        if game.finished:
+            return QColor(100,200,150)
+        elif game.is_package:
+            return QColor(100,100,200)
+        b = max(100,215-game.priority*40)
+        return QColor(285-b,285-b,285-b)
+        #return QColor(self.palette().Background)
+
+    def widget_name(self,game):
         def abreve(t,l):
             if len(t)<l:
                 return t
@@ -574,117 +758,34 @@ class GamelistForm(QWidget):
             if package:
                 game.widget_name = "["+abreve(package.name,25)+"] "+game.name
         game.widget_name = abreve(game.widget_name,100)
-        if game.finished:
-            bg = QColor(100,200,150)
-        elif game.is_package:
-            bg = QColor(100,100,200)
-        else:
-            b = max(100,215-game.priority*40)
-            bg = QColor(285-b,285-b,285-b)
-            #bg = QColor(self.palette().Background)
-
-        source = QTableWidgetItem("")
-        source.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        source.setBackground(bg)
-        source.setData(DATA_GAMEID,game.gameid)
-        for s in game.sources:
-            if s["source"] in self.icons:
-                source.setIcon(QIcon(self.icons[s["source"]]))
-                break
-            else:
-                source.setIcon(QIcon(self.icons["blank"]))
-        list_widget.setItem(row,0,source)
-            
-        label = QTableWidgetItem("")
-        label.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        label.setBackground(bg)
-        self.set_icon(label,game,self.icon_size)
-        self.icon_thread.start()
-        list_widget.setItem(row,1,label)
-            
-        name = QTableWidgetItem("GAME NAME")
-        name.setBackground(bg)
-        #TODO: Currently disabled
-        name.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        name.setText(game.widget_name)
-        list_widget.setItem(row,2,name)
-
-        genre = QTableWidgetItem("GAME GENRE")
-        #TODO: Currently disabled
-        genre.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        genre.setBackground(bg)
-        genre.setText(game.genre)
-        list_widget.setItem(row,3,genre)
-
-        hours = SortableTableWidgetItem("GAME HOURS")
-        #TODO: CURRENTLY DISABLED
-        hours.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        hours.setBackground(bg)
-        hours.setText(game.playtime_hours_minutes)
-        hours.setData(DATA_SORT,game.playtime)
-        list_widget.setItem(row,4,hours)
-
-        lastplayed = SortableTableWidgetItem("GAME LAST PLAYED")
-        lastplayed.setFlags(Qt.ItemIsSelectable|Qt.ItemIsEnabled)
-        lastplayed.setBackground(bg)
-        lastplayed.setText(game.last_played_nice)
-        #lastplayed.setText(game.priority_date)
-        lastplayed.setData(DATA_SORT,time.mktime(games.stot(game.lastplayed)))
-        list_widget.setItem(row,5,lastplayed)
+        return game.widget_name
 
     def update_gamelist_widget(self):
-        self.disable_edit_hooks()
-        self.gamelist = []
-        for g in self.games.list(self.sort):
-            self.gamelist.append({"game":g,"widget":None})
-        print(len(self.gamelist))
-        self.games_list_widget.sortItems(-1)
-        self.games_list_widget.setSortingEnabled(False)
-        self.games_list_widget.setSelectionMode(QAbstractItemView.SingleSelection)
-        #self.games_list_widget.clear()
-        self.games_list_widget.setRowCount(0)
+        self.installed = None
+        self.run_search()
+        self.games_model.refresh()
+        #Back to the order of self.sort until a header is clicked again
+        self.games_list_widget.horizontalHeader().setSortIndicator(-1,Qt.AscendingOrder)
+        self.games_proxy.sort(-1)
         self.games_list_widget.setIconSize(QSize(self.icon_size,self.icon_size))
-        self.games_list_widget.horizontalHeader().setVisible(True)
-        self.games_list_widget.verticalHeader().setVisible(False)
-        self.games_list_widget.setRowCount(len(self.gamelist))
-        self.games_list_widget.setColumnCount(6)
-        self.games_list_widget.itemSelectionChanged.connect(self.selected_row)
-        
-        i = -1
-        for i,g in enumerate(self.gamelist):
-            self.update_game_row(g["game"],i)
-        self.update_game_row(games.Game(name="Total Time Played"),0,list_widget=self.total_played_list)
-        self.dosearch()
+        self.games_list_widget.verticalHeader().setDefaultSectionSize(max(self.icon_size,self.fontMetrics().height())+6)
+
+        self.total_played_list.setItem(0,2,QTableWidgetItem("Total Time Played"))
+        self.update_total_played()
         self.total_played_list.resizeColumnsToContents()
 
         self.game_scroller.verticalScrollBar().setValue(0)
-        self.games_list_widget.setHorizontalHeaderLabels([x[0] for x in self.columns])
-        self.games_list_widget.resizeColumnsToContents()
+        self.games_list_widget.scrollToTop()
+        self.visible_timer.start()
         self.games_list_widget.setColumnWidth(0,self.icon_size+6)
         self.games_list_widget.setColumnWidth(1,self.icon_size+6)
         self.games_list_widget.setColumnWidth(2,200)
         self.games_list_widget.setColumnWidth(3,80)
         self.games_list_widget.setColumnWidth(4,60)
         self.games_list_widget.setColumnWidth(5,150)
-        self.games_list_widget.resizeRowsToContents()
-
-        self.games_list_widget.setSortingEnabled(True)
 
-        self.enable_edit_hooks()
-
-        self.dosearch()
         self.update()
         
-    def disable_edit_hooks(self):
-        try:
-            self.games_list_widget.cellChanged.disconnect(self.cell_changed)
-        except TypeError:
-            pass
-            
-    def enable_edit_hooks(self):
-        self.games_list_widget.cellChanged.connect(self.cell_changed)
-        self.games_list_widget.cellDoubleClicked.connect(self.cell_activated)
-        
     def edit_emulators(self):
         self.emulator_form = emulatorform.EmulatorForm(self)
         self.emulator_form.show()
@@ -703,54 +804,40 @@ class GamelistForm(QWidget):
 
     def import_steam(self):
         self.view_log()
-        def f(self):
-            self.log.write("STEAM IMPORT BEGUN... please wait...")
-            try:
-                games = self.steam.import_steam()
-            except steamapi.ApiError:
-                self.log.write("STEAM IMPORT... ERROR. Check options.")
-                self.error_trigger.emit("steam")
-                return
-            self.games.add_games(games)
-            self.update_gamelist_widget()
-            self.save()
-            self.log.write("STEAM IMPORT FINISHED")
-        self.importer_threads["steam"].func = f
-        self.importer_threads["steam"].start()
+        self.log.write("STEAM IMPORT BEGUN... please wait...")
+        self.importer.start("steam",importer.blocking("steam",self.steam.import_steam))
 
     def import_humble(self):
         self.view_log()
-        def f(self):
-            self.log.write("HUMBLE IMPORT BEGUN... please wait...")
-            try:
-                games = self.humble.get_gamelist()
-            except humbleapi.ApiError:
-                self.log.write("HUMBLE IMPORT... ERROR. Check options.")
-                self.error_trigger.emit("humble")
-                return
-            self.games.add_games(games)
-            self.update_gamelist_widget()
-            self.save()
-            self.log.write("HUMBLE IMPORT FINISHED")
-        self.importer_threads["humble"].func = f
-        self.importer_threads["humble"].start()
+        self.log.write("HUMBLE IMPORT BEGUN... please wait...")
+        self.importer.start("humble",self.humble.get_gamelist)
 
     def import_gog(self):
         self.view_log()
-        def f(self):
-            self.log.write("GOG IMPORT BEGUN... please wait...")
-            try:
-                games = self.gog.get_shelf(self.games.multipack, self.cookies.get("gog.com",{}))
-            except gogapi.BadAccount:
-                self.log.write("GOG IMPORT... ERROR. Check options.")
-                self.error_trigger.emit("gog")
-                return
-            self.games.add_games(games)
+        self.log.write("GOG IMPORT BEGUN... please wait...")
+        def f(runtime,emit):
+            return self.gog.get_shelf(runtime, emit, self.games.multipack, self.cookies.get("gog.com",{}))
+        self.importer.start("gog",f)
+
+    def merge_import(self,name,games):
+        self.games.merge_games(games)
+        self.games_model.stale = True
+        #Don't redraw the list for every batch of a long import
+        if time.time()-self.last_import_refresh>1:
+            self.last_import_refresh = time.time()
             self.update_gamelist_widget()
-            self.save()
-            self.log.write("GOG IMPORT FINISHED")
-        self.importer_threads["gog"].func = f
-        self.importer_threads["gog"].start()
+
+    def end_import(self,name,error):
+        if isinstance(error,(steamapi.ApiError,humbleapi.ApiError,gogapi.BadAccount)):
+            self.log.write("%s IMPORT... ERROR. Check options."%name.upper())
+            self.error_trigger.emit(name)
+        elif error:
+            import traceback
+            traceback.print_exception(type(error),error,error.__traceback__)
+        self.update_gamelist_widget()
+        self.save()
+        if not error:
+            self.log.write("%s IMPORT FINISHED"%name.upper())
         
     def cleanup_add_steam_shortcuts(self):
         self.steam.create_nonsteam_shortcuts(self.games.games)
@@ -768,6 +855,7 @@ class GamelistForm(QWidget):
     def gamesdb(self,game):
         #self.thegamesdb.update_game_data(game)
         self.giantbomb.update_game_data(game)
+        game.touch()
         
     def view_log(self):
         #self.log_dock = QDockWidget("Log Window",self)
@@ -835,14 +923,21 @@ class GamelistForm(QWidget):
             game.run_game(self.config["root"])
         
     def operation(self,message,obj,*args):
-        sync.download()
+        if sync.download():
+            #Remote adds and deletes moved rows under the list
+            self.games_model.stale = True
         getattr(obj,message)(*args)
         self.games.revision += 1
         self.save()
         self.upload_thread = QThread()
         self.upload_thread.run = lambda: sync.upload()
         self.upload_thread.start()
-        self.update_gamelist_widget()
+        if isinstance(obj,games.Game):
+            self.run_search()
+            self.games_model.game_changed(obj.gameid)
+            self.update_total_played()
+        else:
+            self.update_gamelist_widget()
         if isinstance(obj,games.Game) and self.game_options:
             self.update_game_options(obj)
             self.select_game(obj)
@@ -878,15 +973,9 @@ class GamelistForm(QWidget):
         return self.egw
 
     def selected_row(self):
-        #Clean up from before if we messed with a field
-        if getattr(self,"editing_section",None):
-            print("FIXING EDITING SECTION")
-            self.cell_changed(*self.editing_section)
-            self.editing_section = None
-        if self.games_list_widget.selectedItems():
-            item = self.games_list_widget.selectedItems()[0]
-            row = item.row()
-            gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
+        if self.games_list_widget.selectionModel().selectedIndexes():
+            index = self.games_list_widget.selectionModel().selectedIndexes()[0]
+            gameid = self.games_proxy.data(index,DATA_GAMEID)
             if gameid not in self.games.games:
                 return
             game = self.games.games[gameid]
@@ -896,50 +985,6 @@ class GamelistForm(QWidget):
                 self.game_options_dock.widget().layout().addWidget(self.stop_playing_button)
                 #self.stop_playing_button.clicked.connect(make_callback(self.stop_playing,game))
 
-    def cell_changed(self,row,col):
-        return
-        if getattr(self,"editing_section",None) == (row,col):
-            self.editing_section = None
-        print("changed",row,col)
-        gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
-        if gameid not in self.games.games:
-            return
-        self.disable_edit_hooks()
-        game = self.games.games[gameid]
-        changed = True
-        nv = self.games_list_widget.item(row,col).text()
-        #Reset title
-        if col==2:
-            changed = False
-            nv = self.games_list_widget.item(row,col).text()
-            if nv != game.name:
-                changed = True
-            print("setting widget name to",game.widget_name)
-        if changed:
-            if self.columns[col][2]:
-                print("setting",gameid,self.columns[col][2],"to",nv)
-                setattr(game,self.columns[col][2],nv)
-            self.changed.append(gameid)
-            self.update_game_row(game,row)
-            self.games_list_widget.item(row,col).setBackground(QColor(200,10,10))
-        else:
-            oldbg = self.games_list_widget.item(row,col).background()
-            self.update_game_row(game,row)
-            self.games_list_widget.item(row,col).setBackground(oldbg)
-        #self.selected_row()
-        self.enable_edit_hooks()
-
-    def cell_activated(self,row,col):
-        return
-        self.disable_edit_hooks()
-        if self.columns[col][2]:
-            gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
-            game = self.games.games[gameid]
-            print("SETTING EDITING SECTION")
-            self.editing_section = (row,col)
-            self.games_list_widget.item(row,col).setText(getattr(game,self.columns[col][2]))
-        self.enable_edit_hooks()
-
     def update_game_options(self,game,new=False):
         self.game_options = gameoptions.GameOptions(game,self,new)
         self.game_options_dock.setWidget(self.game_options)
@@ -952,49 +997,76 @@ class GamelistForm(QWidget):
     def add_game(self,source):
         print("adding game with source:",source)
         game = games.Game(sources=[{"source":source}],import_date=games.now(),games=self.games)
-        self.gamelist.append({"game":game,"widget":None})
         #self.show_edit_widget(game,self,new=True)
         self.update_game_options(game,new=True)
 
-    def dosearch(self):
-        played = 0
+    def game_visible(self,gameid):
+        return gameid in self.shown
 
-        sn = self.search_name.text().lower()
-        sg = self.search_genre.text().lower()
-        sp = self.search_platform.text().lower()
-        if sp == "emu":
+    def installed_games(self):
+        """Only called on the GUI thread, which is the one changing self.games"""
+        if self.installed is None:
+            self.installed = set(gameid for gameid in self.games.games if self.games.games[gameid].is_installed())
+        return self.installed
+
+    def search_request(self):
+        sp = self.search_platform.text()
+        if sp.lower() == "emu":
             sp = "gba or snes or n64 or nds"
-        row = -1 #For when game list is empty
-        for row in range(self.games_list_widget.rowCount()):
-            gameid = self.games_list_widget.item(row,0).data(DATA_GAMEID)
-            if gameid not in self.games.games:
-                self.games_list_widget.setRowHidden(row,True)
-                continue
-            game = self.games.games[gameid]
-            self.games_list_widget.setRowHidden(row,False)
-            if game.is_package and self.hide_packages:
-                self.games_list_widget.setRowHidden(row,True)
-                continue
-            if self.show_installed:
-                if not game.is_installed():
-                    self.games_list_widget.setRowHidden(row,True)
-                    continue
-            if game.hidden and not self.show_hidden:
-                self.games_list_widget.setRowHidden(row,True)
-                continue
-            def match(search,field):
-                searches = search.split(" or ")
-                for s in searches:
-                    if s in field:
-                        return True
-            if (sn and not (match(sn,game.name.lower()) or match(sn,game.package_data.get("parent",{}).get("name","").lower()) )) or \
-            (sg and not match(sg,game.genre.lower())) or \
-            (sp and not match(sp," ".join([s["source"] for s in game.sources]))):
-                self.games_list_widget.setRowHidden(row,True)
-                continue
-
-            played += game.playtime
+        #The installed set is found here rather than on search_worker, which can't walk self.games
+        #while an import or operation changes it
+        installed = self.installed_games() if self.show_installed else None
+        return (self.search_name.text(),self.search_genre.text(),sp,
+                self.hide_packages,self.show_hidden,installed)
+
+    def search_games(self,request,cancelled=lambda: False):
+        """gameids that request from search_request() lets through, or None if cancelled()
+        turns True on the way"""
+        sn,sg,sp,hide_packages,show_hidden,installed = request
+        shown = self.games.search(sn,"name")
+        for query,field in [(sg,"genre"),(sp,"source")]:
+            if cancelled():
+                return None
+            if query:
+                shown &= self.games.search(query,field)
+        if hide_packages:
+            shown -= self.games.search("is:package")
+        if not show_hidden:
+            shown -= self.games.search("is:hidden")
+        if installed is not None:
+            shown &= installed
+        if cancelled():
+            return None
+        return shown
+
+    def run_search(self):
+        """Search right away on this thread, dropping any search still running on search_worker"""
+        self.search_timer.stop()
+        self.search_worker.submit(None)
+        self.shown = self.search_games(self.search_request())
+
+    def search_typed(self,text):
+        self.search_timer.start()
+
+    def queue_search(self):
+        self.search_worker.submit(self.search_request())
+
+    def search_finished(self,generation,shown,played):
+        if self.search_worker.superseded(generation):
+            return
+        self.shown = shown
+        self.games_proxy.invalidateFilter()
+        self.show_total_played(played)
+
+    def dosearch(self):
+        self.run_search()
+        self.games_proxy.invalidateFilter()
+        self.update_total_played()
+
+    def update_total_played(self):
+        self.show_total_played(self.games.playtime(self.shown))
 
+    def show_total_played(self,played):
         #Total playtime
         total_hours = QTableWidgetItem("GAME HOURS")
         min = played/60.0
@@ -6,17 +6,17 @@ import pygame.freetype
 import json
 import time
 
-from code.apis import giantbomb, steamapi, gogapi, humbleapi, thegamesdb
-#from code.interface import account, gameoptions, base_paths, logwindow, sourcesform, emulatorform
-from code import games,syslog
-from code.resources import icons,enc
+from mblib.apis import giantbomb, steamapi, gogapi, humbleapi, thegamesdb
+#from mblib.interface import account, gameoptions, base_paths, logwindow, sourcesform, emulatorform
+from mblib import games,syslog
+from mblib.resources import icons,enc,atlas
 
 screen = pygame.display.set_mode([1920,1080],pygame.FULLSCREEN|pygame.DOUBLEBUF)
 pygame.freetype.init()
 
 def init_config(app):
     crypter = enc.Crypter()
-    from code.appdirs import appdirs
+    from mblib.appdirs import appdirs
     path_base = appdirs.user_data_dir("MyBacklog").replace("\\","/")
     if not os.path.exists(path_base):
         os.makedirs(path_base)
@@ -76,10 +76,29 @@ def init_gamelist(app,config):
     return gamelist
     
 font = pygame.freetype.SysFont("JosefinSlab-Regular.ttf",16)
+icon_size = font.get_sized_height()
 
 icon_cache = {}
 text_cache = {}
 
+def load_icon_atlas(config,game_list,size):
+    """Atlas of every game's icon at size. Icons already in the file cache that the atlas doesn't
+    have yet are packed into it first, so they are all drawn from a few sheets"""
+    store = icons.IconStore(config["root"]+"/cache/icons/store")
+    root = config["root"]+"/cache/icons/atlas_pygame"
+    icon_atlas = atlas.IconAtlas(root,size,imode="pygame")
+    sources = []
+    for game in game_list:
+        fpath,mode,url = icons.path_to_icon(game,config["root"])
+        if url not in icon_atlas and not store.has(url) and os.path.exists(fpath):
+            store.put(url,fpath)
+        sources.append(url)
+    if [url for url in sources if url not in icon_atlas and store.has(url)]:
+        print("packing icons:",atlas.build_atlas(store,root,size,sources))
+        icon_atlas = atlas.IconAtlas(root,size,imode="pygame")
+    store.save_index()
+    return icon_atlas
+
 def get_text(game,selected):
     if (game.name,selected) not in text_cache:
         text = game.name+" ... "+game.playtime_hours_minutes+" last:"+game.last_played_nice
@@ -101,6 +120,7 @@ class MyBacklogApp:
     offset = 0
     show = 20
     game_list = []
+    icon_atlas = None
     def __init__(self):
         pass
     def log(self,*text):
@@ -108,6 +128,7 @@ class MyBacklogApp:
     def input(self):
         if not self.game_list:
             self.game_list = self.gamelist.list()
+            self.icon_atlas = load_icon_atlas(self.config,self.game_list,icon_size)
         for evt in pygame.event.get():
             if evt.type==pygame.QUIT or (evt.type==pygame.KEYDOWN and evt.key==pygame.K_ESCAPE):
                 self.running = False
@@ -150,9 +171,13 @@ class MyBacklogApp:
             for i,game in enumerate(self.game_list[self.offset:self.offset+self.show]):
                 graphic,size = get_text(game,i+self.offset==self.selected)
                 screen.blit(graphic,dest=[x,y])
-                icon = icons.icon_for_game(game,size[1],icon_cache,self.config["root"],"icon","pygame")
-                if icon:
-                    screen.blit(icon,dest=[0,y])
+                area = self.icon_atlas and self.icon_atlas.area(icons.path_to_icon(game,self.config["root"])[2])
+                if area:
+                    screen.blit(area[0],dest=[0,y],area=area[1])
+                else:
+                    icon = icons.icon_for_game(game,icon_size,icon_cache,self.config["root"],"icon","pygame")
+                    if icon:
+                        screen.blit(icon,dest=[0,y])
                 y += size[1]+2
         pygame.display.flip()
     def run_game(self,game,track_time=True,launch=True):
@@ -0,0 +1,72 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from mblib.apis import gogapi, importer
+
+def product(slug,title):
+    return {"isGame":True,"slug":slug,"id":len(slug),"title":title,"image":"//images.gog.com/"+slug,"category":"Role-playing"}
+
+PAGES = {1:[product("witcher","The Witcher")],
+    2:[product("fallout","Fallout"),product("planescape","Planescape: Torment")],
+    3:[product("gothic","Gothic")]}
+
+class Log:
+    def write(self,*args):
+        pass
+
+class App:
+    def __init__(self,root):
+        self.config = {"root":root}
+        self.log = Log()
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path/"cache"/"browser").mkdir(parents=True)
+    conn = sqlite3.connect(str(tmp_path/"cache"/"browser"/"Cookies"))
+    conn.execute("create table cookies (id,host,name,value)")
+    conn.execute("insert into cookies values (1,'gog.com','gog_us','1')")
+    conn.commit()
+    conn.close()
+    return str(tmp_path)
+
+def run_shelf(root,username="user",multipack={}):
+    merged = []
+    finished = []
+    runtime = importer.ImportRuntime(lambda name,games: merged.append(games),lambda name,error: finished.append(error))
+    gog = gogapi.Gog(App(root),username,"password")
+    cookies = {"user_agent":"test","cookies":{}}
+    future = runtime.start("gog",lambda runtime,emit: gog.get_shelf(runtime,emit,multipack,cookies))
+    future.result(10)
+    return merged,finished[0]
+
+def test_shelf_pages_fetched_together_and_read_in_order(root,monkeypatch):
+    #Pages 2 and 3 only get past the barrier if they are fetched at the same time
+    both = threading.Barrier(2)
+    def fetch(self,url,params={},cache=False,cache_root=""):
+        if "getFilteredProducts" in url and "page=" not in url:
+            return {"json":{"totalProducts":4},"text":"","url":url}
+        page = int(url.rsplit("page=",1)[1].split("&")[0])
+        if page>1:
+            both.wait(5)
+        if page==2:
+            time.sleep(0.1)
+        return {"json":{"totalPages":3,"products":PAGES[page]},"text":"","url":url}
+    monkeypatch.setattr(gogapi.Browser,"fetch",fetch)
+    merged,error = run_shelf(root,multipack={"fallout":["Fallout","Fallout 2"]})
+    assert error is None
+    #A multipack and its contents come with the page it is on
+    assert [[game.name for game in games] for games in merged] == [
+        ["The Witcher"],["Fallout","Fallout","Fallout 2","Planescape: Torment"],["Gothic"]]
+    package = merged[1][0]
+    assert package.package_data["contents"] == [{"gameid":game.gameid,"name":game.name} for game in merged[1][1:3]]
+
+def test_login_failure_raises_bad_account(root,monkeypatch):
+    monkeypatch.setattr(gogapi.Browser,"fetch",lambda self,url,params={},cache=False,cache_root="": {"json":{},"text":"","url":url})
+    merged,error = run_shelf(root)
+    assert isinstance(error,gogapi.BadAccount)
+    assert merged == []
+    merged,error = run_shelf(root,username="")
+    assert isinstance(error,gogapi.BadAccount)
@@ -0,0 +1,48 @@
+import os
+
+from mblib import games
+from mblib.apis import humbleapi, importer
+
+ORDERS = {"key1":{"gamekey":"key1","product":{"human_name":"Bundle 1","machine_name":"bundle1"},
+        "subproducts":[{"human_name":"Braid","url":"","icon":"","machine_name":"braid"}]},
+    "key2":{"gamekey":"key2","product":{"human_name":"Bundle 2","machine_name":"bundle2"},
+        "subproducts":[{"human_name":"Limbo","url":"","icon":"","machine_name":"limbo"}]}}
+
+class Log:
+    def write(self,*args):
+        pass
+
+class App:
+    def __init__(self,root):
+        self.config = {"root":root}
+        self.log = Log()
+        self.games = games.Games(self.log)
+        self.games.local = {"game_data":{},"emulators":{}}
+
+def run_import(app,monkeypatch):
+    monkeypatch.setattr(humbleapi,"login",lambda log,username,password,cache_root: (humbleapi.Browser(),list(ORDERS)))
+    monkeypatch.setattr(humbleapi.Browser,"fetch",lambda self,url,params={},cache=False,cache_root="": {"json":ORDERS[url.rsplit("/",1)[1]],"text":"","url":url})
+    emitted = []
+    def merge(name,order_games):
+        emitted.extend(game.name for game in order_games)
+        app.games.merge_games(order_games)
+    runtime = importer.ImportRuntime(merge,lambda name,error: None)
+    runtime.start("humble",humbleapi.Humble(app,"user","password").get_gamelist).result(10)
+    return emitted
+
+def test_unchanged_orders_skipped_after_gameid_changes(tmp_path,monkeypatch):
+    os.makedirs(str(tmp_path/"cache"))
+    app = App(str(tmp_path))
+    #A game from elsewhere holding the gameid Braid is read with, so Braid is stored under another
+    braid = humbleapi.read_order(ORDERS["key1"])[1]
+    other = games.Game(name="Braid (steam)",sources=[{"source":"steam","id":"26800"}])
+    other.gameid = braid.gameid
+    app.games.add_game(other,other.gameid)
+    assert run_import(app,monkeypatch) == ["Bundle 1","Braid","Bundle 2","Limbo"]
+    app.games.delete(other)
+    assert braid.gameid not in app.games.games
+    assert run_import(app,monkeypatch) == []
+
+    #A game removed from the database brings its order back
+    app.games.delete(app.games.find("Limbo"))
+    assert run_import(app,monkeypatch) == ["Bundle 2","Limbo"]
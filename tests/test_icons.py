@@ -0,0 +1,34 @@
+import io
+
+from PIL import Image
+
+from mblib.resources import icons
+
+def png(color):
+    buf = io.BytesIO()
+    Image.new("RGB",(32,32),color).save(buf,"PNG")
+    buf.seek(0)
+    return buf
+
+def test_store_evicts_least_recently_used_in_a_batch(tmp_path):
+    store = icons.IconStore(str(tmp_path/"store"))
+    store.put("first",png((1,0,0)))
+    for i in range(2,11):
+        store.put("icon%d"%i,png((i,0,0)))
+    store.max_bytes = store.bytes
+    #Showing it makes the first icon the most recently used
+    store.thumbnail("first",33)
+    store.put("icon11",png((11,0,0)))
+    assert store.bytes<=store.max_bytes*0.9
+    assert store.has("first") and store.has("icon11")
+    assert not store.has("icon2") and not store.has("icon3")
+    evicted = store.evictions
+    assert evicted>1
+    #The batch left room, the next put doesn't evict again
+    store.put("icon12",png((12,0,0)))
+    assert store.evictions == evicted
+
+    #Reloaded in the same order
+    store.save_index()
+    reloaded = icons.IconStore(str(tmp_path/"store"))
+    assert list(reloaded.index) == list(store.index)
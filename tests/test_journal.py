@@ -0,0 +1,70 @@
+import pytest
+
+from PyQt5.QtWidgets import QApplication
+
+from mblib import games
+from mblib.interface import gameoptions
+
+@pytest.fixture(scope="module")
+def qapp():
+    return QApplication.instance() or QApplication([])
+
+class App:
+    """Just what EditGame needs from GamelistForm"""
+    def __init__(self,db):
+        self.db = db
+        self.games = load(db)
+    def operation(self,message,obj,*args):
+        getattr(obj,message)(*args)
+        self.games.revision += 1
+        self.save()
+    def force_update(self,game,oldid):
+        self.games.force_update_game(oldid,game)
+    def save(self):
+        self.games.save(self.db)
+
+def load(db):
+    g = games.Games()
+    g.journal = True
+    g.load_games(db)
+    return g
+
+@pytest.fixture
+def db(tmp_path):
+    db = str(tmp_path/"games.gz")
+    g = games.Games()
+    g.journal = True
+    game = games.Game(name="Witcher",sources=[{"source":"steam","id":"20900"}])
+    game.generate_gameid()
+    g.update_game(game.gameid,game)
+    g.save(db)
+    return db
+
+def test_edit_game_survives_reload(qapp,db):
+    app = App(db)
+    gameid, = app.games.games
+    edit = gameoptions.EditGame(app.games.games[gameid],app,parented=True)
+    edit.fields["name"]["w"].setText("The Witcher")
+    edit.save_close()
+    assert games.os.path.exists(games.journal_path(db))
+    game = load(db).games[gameid]
+    assert game.name == "The Witcher"
+    assert game.website == "http://store.steampowered.com/app/20900"
+
+def test_dynamic_fields_survive_reload(qapp,db):
+    app = App(db)
+    gameid, = app.games.games
+    gameoptions.EditGame(app.games.games[gameid],app,parented=True)
+    app.save()
+    assert load(db).games[gameid].website == "http://store.steampowered.com/app/20900"
+
+def test_dates_in_1970_kept(qapp,db):
+    app = App(db)
+    gameid, = app.games.games
+    edit = gameoptions.EditGame(app.games.games[gameid],app,parented=True)
+    edit.fields["finish_date"]["w"].setDateTime(gameoptions.ts_to_qtdt(180*24*60*60))
+    edit.save_close()
+    game = load(db).games[gameid]
+    assert game.finish_date == 180*24*60*60
+    #Never played stays unset
+    assert game.lastplayed == 0
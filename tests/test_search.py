@@ -0,0 +1,24 @@
+from mblib import search
+
+GAMES = {"w1":{"name":"The Witcher","genre":"rpg","source":"gog"},
+    "w3":{"name":"The Witcher 3","genre":"rpg","source":"steam"},
+    "p":{"name":"Portal","genre":"puzzle","source":"steam"},
+    "xc":{"name":"XCOM","genre":"strategy","source":"steam"}}
+
+def index():
+    index = search.SearchIndex()
+    for gameid,texts in GAMES.items():
+        index.add(gameid,texts)
+    return index
+
+def test_unmatched_bracket_keeps_the_rest():
+    assert search.parse_query(") witcher") == ("term","name","witcher")
+    assert index().search(") witcher") == {"w1","w3"}
+    assert index().search("genre:rpg ) 3") == {"w3"}
+    assert index().search(")") == set(GAMES)
+
+def test_negated_brackets():
+    assert search.parse_query("-(rpg)",field="genre") == ("not",("term","genre","rpg"))
+    assert index().search("-(rpg)",field="genre") == {"p","xc"}
+    assert index().search("-(rpg or puzzle)",field="genre") == {"xc"}
+    assert index().search("source:steam -(genre:rpg)") == {"p","xc"}
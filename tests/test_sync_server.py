@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+
+import pytest
+import ubjson
+from falcon import testing
+import hug
+
+from mblib import games, sync
+from mblib.server import jsonapi
+
+@pytest.fixture
+def server(tmp_path,monkeypatch):
+    #Users are kept under __users__ in the working directory
+    monkeypatch.chdir(tmp_path)
+    return testing.TestClient(hug.API(jsonapi).http.server())
+
+def make_game(name,appid):
+    game = games.Game(name=name,sources=[{"source":"steam","id":appid}])
+    game.generate_gameid()
+    return game
+
+def database(tmp_path,revision):
+    g = games.Games()
+    for game in [make_game("Witcher","20900"),make_game("Portal","400"),make_game("Braid","26800")]:
+        g.update_game(game.gameid,game)
+    g.revision = revision
+    g.save(str(tmp_path/"client.gz"))
+    g.take_unsynced()
+    return g
+
+def upload(server,path,revision):
+    with open(path,"rb") as f:
+        data = f.read()
+    return server.simulate_put("/game_database",query_string="user=test&revision=%d"%revision,body=data,
+        headers={"Content-Type":"application/ubjson","X-Content-SHA256":hashlib.sha256(data).hexdigest()})
+
+def post_changes(server,base,batch):
+    return server.simulate_post("/game_changes",query_string="user=test&base=%d"%base,body=ubjson.dumpb(batch),
+        headers={"Content-Type":"application/ubjson"})
+
+def get_changes(server,since):
+    return ubjson.loadb(server.simulate_get("/game_changes",query_string="user=test&since=%d"%since).content)
+
+def download(server,tmp_path):
+    r = server.simulate_get("/game_database",query_string="user=test")
+    assert r.headers["ETag"] == '"%s"'%hashlib.sha256(r.content).hexdigest()
+    with open(str(tmp_path/"download.gz"),"wb") as f:
+        f.write(r.content)
+    g = games.Games()
+    g.load_games(str(tmp_path/"download.gz"))
+    return g
+
+def records(g):
+    return {gameid:g.games[gameid].dict() for gameid in g.games}
+
+def test_delta_protocol(server,tmp_path):
+    assert server.simulate_get("/games_revision",query_string="user=test").json == {"server_revision":None}
+    assert get_changes(server,0) == {"error":"no_games_saved"}
+
+    #Full upload to an empty server
+    client = database(tmp_path,1)
+    r = upload(server,str(tmp_path/"client.gz"),1)
+    assert r.json["msg"] == "success"
+    assert server.simulate_get("/games_revision",query_string="user=test").json == {"server_revision":1}
+    assert get_changes(server,1) == {"server_revision":1,"changes":[]}
+
+    #One edit and one delete sent as a change record
+    witcher,portal,braid = [client.find(name) for name in ["Witcher","Portal","Braid"]]
+    witcher.set("notes","finished the prologue")
+    client.delete(portal)
+    client.revision = 2
+    batch = client.change_record(*client.take_unsynced())
+    assert [d["gameid"] for d in batch["games"]] == [witcher.gameid]
+    assert batch["deleted"] == [portal.gameid]
+    assert post_changes(server,1,batch).json == {"msg":"success","server_revision":2}
+
+    #A client still at revision 1, from the first upload, gets just that record
+    changes = get_changes(server,1)
+    assert changes["server_revision"] == 2
+    assert len(changes["changes"]) == 1
+    other = games.Games()
+    other.load_games(str(tmp_path/"client.gz"))
+    for change in changes["changes"]:
+        other.apply_changes(change)
+    assert records(other) == records(client)
+    assert other.revision == 2
+
+    #Too far behind for the records to reach, the whole database has to be downloaded
+    assert get_changes(server,0) == {"server_revision":2,"full":True}
+    assert get_changes(server,2) == {"server_revision":2,"changes":[]}
+
+    #A client that missed revision 2 is turned away instead of overwriting it
+    braid.set("notes","stale")
+    stale = {"revision":2,"deleted":[],"games":[braid.dict()]}
+    r = post_changes(server,1,stale).json
+    assert r == {"error":"server has newer revision","client_revision":2,"server_revision":2}
+    r = upload(server,str(tmp_path/"client.gz"),1).json
+    assert r["error"] == "server has newer revision"
+
+    #The full download folds the records into the database
+    downloaded = download(server,tmp_path)
+    assert downloaded.revision == 2
+    assert records(downloaded) == records(other)
+
+
+class Response:
+    """A falcon test result, read like the requests response sync.py gets"""
+    def __init__(self,result):
+        self.status_code = result.status_code
+        self.headers = result.headers
+        self.content = result.content
+        self.text = result.content.decode("utf8","replace")
+    def iter_content(self,size):
+        for i in range(0,len(self.content),size):
+            yield self.content[i:i+size]
+    def json(self):
+        return json.loads(self.text)
+    def close(self):
+        pass
+
+class App:
+    def __init__(self,game_file):
+        self.config = {"games":game_file}
+
+@pytest.fixture
+def synced(server,tmp_path,monkeypatch):
+    """sync.py talking to the test server, which has a database uploaded"""
+    database(tmp_path,1)
+    upload(server,str(tmp_path/"client.gz"),1)
+    requests = []
+    def get(url,headers={},stream=False):
+        path,query = url.split(sync.host,1)[1].split("?",1)
+        requests.append(dict(headers))
+        return Response(server.simulate_get(path,query_string=query,headers=headers))
+    monkeypatch.setattr(sync,"app",App(str(tmp_path/"games.gz")))
+    monkeypatch.setattr(sync,"user","test")
+    monkeypatch.setattr(sync.requests,"get",get)
+    return requests
+
+def test_download_resumes_after_complete_file(synced,tmp_path):
+    downloading = str(tmp_path/"games.gz.d")
+    sync.download_games()
+    with open(str(tmp_path/"client.gz"),"rb") as f:
+        uploaded = f.read()
+    with open(downloading,"rb") as f:
+        assert f.read() == uploaded
+    assert not os.path.exists(downloading+".etag")
+
+    #Stopped after the last byte but before the ETag was removed, the server has nothing past the end
+    with open(downloading+".etag","w") as f:
+        f.write('"%s"'%hashlib.sha256(uploaded).hexdigest())
+    sync.download_games()
+    assert synced[-1]["Range"] == "bytes=%d-"%len(uploaded)
+    assert not os.path.exists(downloading+".etag")
+    with open(downloading,"rb") as f:
+        assert f.read() == uploaded
+
+    #A file longer than the one on the server is downloaded again from the start
+    with open(downloading,"ab") as f:
+        f.write(b"junk")
+    with open(downloading+".etag","w") as f:
+        f.write('"%s"'%hashlib.sha256(uploaded).hexdigest())
+    sync.download_games()
+    assert "Range" not in synced[-1]
+    assert not os.path.exists(downloading+".etag")
+    with open(downloading,"rb") as f:
+        assert f.read() == uploaded
+
+def test_download_error_starts_over(synced,tmp_path,monkeypatch):
+    downloading = str(tmp_path/"games.gz.d")
+    with open(downloading,"wb") as f:
+        f.write(b"part")
+    with open(downloading+".etag","w") as f:
+        f.write('"old"')
+    class Error:
+        status_code = 500
+        text = "server error"
+    monkeypatch.setattr(sync.requests,"get",lambda url,headers={},stream=False: Error())
+    with pytest.raises(Exception):
+        sync.download_games()
+    assert not os.path.exists(downloading+".etag")
+
+def test_download_reports_changes(synced,server,tmp_path):
+    local = games.Games()
+    local.load_games(str(tmp_path/"client.gz"))
+    sync.app.games = local
+    sync.save_state({"revision":1,"games":[],"deleted":[],"meta":sync.meta_hash(local)})
+    assert sync.download() is False
+
+    #Another client deletes a game, the list rows no longer match app.games
+    other = games.Games()
+    other.load_games(str(tmp_path/"client.gz"))
+    portal = other.find("Portal")
+    other.delete(portal)
+    other.revision = 2
+    post_changes(server,1,other.change_record(*other.take_unsynced()))
+    assert sync.download() is True
+    assert portal.gameid not in local.games
+    assert sync.download() is False